@@ -2,6 +2,12 @@ import modules.aliases as aliases
 from celery import Celery
 import configparser
 import modules.currency as currency
+import modules.ledger as ledger
+import modules.notify as notify
+import modules.rain as rain
+import modules.ratelimit as ratelimit
+import modules.db as db
+import modules.shards as shards
 from modules.db import db_init
 from decimal import Decimal, InvalidOperation
 import discord
@@ -9,6 +15,8 @@ from discord.ext import commands
 import tasks
 import modules.util as util
 from web3 import Web3, HTTPProvider
+import asyncio
+import os
 
 # Read config and parse constants
 config = configparser.ConfigParser()
@@ -24,9 +32,19 @@ ETHERSCAN_ROUTE = config.get(ENV, 'etherscan_route')
 
 logger = util.get_logger("main")
 
-# Initialize discord bot
-bot = commands.Bot(command_prefix='!')
+# Initialize discord bot.  SHARD_COUNT and SHARD_IDS are set per process by launcher.py.  Shard count 0 lets
+# discord decide, which only works when this process runs every shard.
+SHARD_COUNT = int(os.environ.get('SHARD_COUNT', config.get('shard', 'count', fallback='0'))) or None
+SHARD_IDS = shards.parse_shard_ids(os.environ.get('SHARD_IDS', config.get('shard', 'ids', fallback='')))
+if SHARD_IDS and not SHARD_COUNT:
+    raise ValueError("[shard] ids needs [shard] count set, or start the bot with launcher.py")
+# The members intent lets !rain see a role's members.  Guilds are chunked on first use rather than at startup.
+intents = discord.Intents.default()
+intents.members = True
+bot = commands.AutoShardedBot(command_prefix='!', shard_count=SHARD_COUNT, shard_ids=SHARD_IDS, intents=intents,
+                              chunk_guilds_at_startup=False)
 bot.remove_command("help")
+shard_stats = shards.ShardStats()
 
 TOKEN = config.get('main', 'token')
 FEE = int(config.get('main', 'fee'))
@@ -39,6 +57,29 @@ BOT_TOKEN = config.get('main', 'bot_token')
 w3 = Web3(HTTPProvider("{}{}".format(INFURA_ROUTE, INFURA)))
 
 
+@bot.event
+async def on_ready():
+    """
+    Bot connected to discord.  Warm the liability notification cache.
+    """
+    warmed = await util.warm_notify_cache()
+    logger.info("Loaded {} notified users into cache".format(warmed))
+
+    notify.NOTIFIER.start(bot)
+
+    # on_ready fires again after reconnects, only start reporting once
+    if not getattr(bot, 'stats_task', None):
+        bot.stats_task = bot.loop.create_task(shard_stats.report_forever(bot))
+
+
+@bot.event
+async def on_command_completion(ctx):
+    """
+    Count completed commands per shard.  DMs are handled by shard 0.
+    """
+    shard_stats.command(ctx.guild.shard_id if ctx.guild else 0)
+
+
 @bot.event
 async def on_message(message):
     """
@@ -48,6 +89,13 @@ async def on_message(message):
     if message.author.id == bot.user.id:
         return
 
+    if message.guild is not None and not message.author.bot:
+        rain.ACTIVITY.seen(message.guild.id, message.author)
+
+    # only commands need the liability check, skip everything else without touching the DB
+    if not message.content.startswith(bot.command_prefix):
+        return
+
     # if the user was not notified of liability, send the notification
     notified = await util.check_user_notify(message)
     if not notified:
@@ -56,6 +104,38 @@ async def on_message(message):
     await bot.process_commands(message)
 
 
+class RateLimited(commands.CheckFailure):
+    def __init__(self, retry_after):
+        self.retry_after = retry_after
+        super(RateLimited, self).__init__("Rate limited, retry in {:.0f}s".format(retry_after))
+
+
+@bot.check
+async def rate_limit(ctx):
+    """
+    Token bucket limits shared by every shard through Redis, per user, per guild and for !balance.
+    """
+    guild_id = ctx.guild.id if ctx.guild else None
+    allowed, retry_after = await asyncio.get_event_loop().run_in_executor(
+        None, ratelimit.check_command, ctx.author.id, guild_id, ctx.command.name)
+    if not allowed:
+        raise RateLimited(retry_after)
+    return True
+
+
+@bot.event
+async def on_command_error(ctx, error):
+    """
+    Let rate limited users know when to try again, log anything else.
+    """
+    if isinstance(error, RateLimited):
+        await ctx.message.add_reaction('⏳')
+        await ctx.author.send("You're sending commands too quickly, try again in "
+                              "{:.0f} seconds.".format(max(error.retry_after, 1)))
+        return
+    logger.error("Error in command {}: {}".format(ctx.command, error))
+
+
 @bot.command(aliases=util.get_aliases(aliases.HELP, exclude='help'))
 async def help(ctx):
     """
@@ -73,6 +153,9 @@ async def help(ctx):
               '-- **!tip or !t <@PERSON> <AMOUNT>**\n'
               '*IN CHAT ONLY*\n'
               'Tips the person the provided amount of {0}.  The minimum tip amount is {3}\n\n'
+              '-- **!rain or !r <AMOUNT> <@ROLE>** or **!rain active <AMOUNT>**\n'
+              '*IN CHAT ONLY*\n'
+              'Splits AMOUNT of {0} between everyone in the role, or everyone who has chatted here recently.\n\n'
               '-- **!withdraw or !w <ADDRESS> <OPTIONAL:AMOUNT>**\n'
               '*DM ONLY*\n'
               'Withdraws AMOUNT to ADDRESS, charging a {1} {0} fee.  If no amount is provided, withdraw '
@@ -94,35 +177,38 @@ async def help(ctx):
 @bot.command(aliases=util.get_aliases(aliases.ACCOUNT, exclude='account'))
 async def account(ctx):
     """
-    Retrieve the user's account from the DB.  If it doesn't exist, create a new one and store it.
+    Retrieve the user's account from the snapshot cache.  If it doesn't exist, create a new one and store it.
     """
     message = ctx.message
 
-    # Retrieve the user's account from the DB
-    account_return = await currency.get_account(message.author.id)
-    if account_return == () or account_return[0][0] is None:
-        await currency.generate_new_account(message, w3)
+    # Retrieve the user's account, only hitting the DB on a cache miss
+    snapshot = await db.run_async(util.get_snapshot, message.author.id)
+    address = snapshot['address'] if snapshot else None
+    if address is None:
+        address = await db.run_async(currency.claim_pooled_address, message.author.id)
+        if address is None:
+            await currency.generate_new_account(message, w3)
+            return
 
-    elif account_return[0][0] == 'GENERATING':
+    if address == 'GENERATING':
         await message.author.send("Your account is still generating, check back in a few minutes.")
 
-    elif account_return[0][0] == 'ERROR':
+    elif address == 'ERROR':
         await message.author.send("There was an error generating your account, please reach out to bot admin.")
 
     else:
-        address = w3.toChecksumAddress(account_return[0][0])
-        await message.author.send("Your reusable deposit address is: {}".format(address))
+        await message.author.send("Your reusable deposit address is: {}".format(w3.toChecksumAddress(address)))
 
 
 @bot.command(aliases=util.get_aliases(aliases.BALANCE, exclude='balance'))
 async def balance(ctx):
     """
-    Check for unseen transactions and then retrieve user balance from database and respond.
+    Check for unseen transactions and then retrieve user balance from the snapshot cache and respond.
     """
     message = ctx.message
 
-    account_return = await currency.get_account(message.author.id)
-    address = account_return[0][0]
+    snapshot = await db.run_async(util.get_snapshot, message.author.id)
+    address = snapshot['address'] if snapshot else None
     if address == 'GENERATING':
         await message.author.send("Your account is still generating.  Check back in a few minutes.")
         return
@@ -130,20 +216,17 @@ async def balance(ctx):
         await message.author.send("There was an error generating your account, please reach out to bot admin.")
         return
 
-    new_balance = await currency.check_pending(message)
-    user_balance, pending = tasks.get_balance(message.author.id)
+    # Crediting new deposits invalidates the snapshot, otherwise this is another cache hit
+    await currency.check_pending(message)
+    snapshot = await db.run_async(util.get_snapshot, message.author.id)
 
-    if user_balance == () or user_balance is None:
+    if snapshot is None:
         await message.author.send("There was an error retrieving your account balance.  Please reach out to the "
                                   "administrator of this bot.  ERROR: Balance was empty for "
                                   "user {}".format(message.author.id))
     else:
-        await message.author.send("Your balance is {0} {1}.  You have {2} {1} pending withdraw".format(user_balance,
-                                                                                                       TOKEN,
-                                                                                                       pending))
-
-    if new_balance > 0:
-        tasks.forward_to_master.delay(address, new_balance)
+        await message.author.send("Your balance is {0} {1}.  You have {2} {1} pending "
+                                  "withdraw".format(snapshot['balance'], TOKEN, snapshot['pending']))
 
 
 @bot.command(aliases=util.get_aliases(aliases.TIP, exclude='tip'))
@@ -153,7 +236,8 @@ async def tip(ctx):
     """
     message = {'content': ctx.message.content,
                'author': ctx.message.author.id,
-               'author_name': ctx.message.author}
+               'author_name': ctx.message.author,
+               'mentions': ctx.message.mentions}
     # Ignore private message tips
     if util.is_private(ctx.message.channel):
         await ctx.message.add_reaction('❌')
@@ -189,6 +273,65 @@ async def tip(ctx):
     await currency.send_tip(message, users_to_tip, ctx, bot)
 
 
+@bot.command(name='rain', aliases=util.get_aliases(aliases.RAIN, exclude='rain'))
+async def rain_tip(ctx):
+    """
+    Split a tip between every member of a role or everyone recently active in the server.  Everyone is credited
+    in one bulk transaction and notified through the DM queue.
+    """
+    message = ctx.message
+    incorrect_rain = ("Your rain has an incorrect syntax.  Please resend with the format "
+                      "!rain <amount> <@role> or !rain active <amount>")
+    if util.is_private(message.channel):
+        await message.add_reaction('❌')
+        await message.author.send("Rain can only be made in public channels.")
+        return
+
+    msg_list = message.content.split()
+    if len(msg_list) >= 3 and msg_list[1].lower() == 'active':
+        amount_text = msg_list[2]
+        recipients = rain.ACTIVITY.active(message.guild.id)
+    elif len(msg_list) >= 3 and message.role_mentions:
+        amount_text = msg_list[1]
+        recipients = await rain.role_recipients(message.role_mentions[0])
+    else:
+        await message.add_reaction('❌')
+        await message.author.send(incorrect_rain)
+        return
+
+    recipients = [(user_id, username) for user_id, username in recipients
+                  if user_id != message.author.id and str(user_id) != BOT_ID]
+    try:
+        total_amount = Decimal(amount_text)
+    except InvalidOperation:
+        await message.add_reaction('❌')
+        await message.author.send(incorrect_rain)
+        return
+    if not recipients:
+        await message.add_reaction('❌')
+        await message.author.send("We couldn't find anyone to rain on.  Please review and resend.")
+        return
+    if total_amount < MIN_TIP:
+        await message.add_reaction('❌')
+        await message.author.send("The minimum tip amount is {} {} and you tried "
+                                  "to send {}.  Nice try!".format(MIN_TIP, TOKEN, total_amount))
+        return
+
+    amount = rain.split_amount(total_amount, len(recipients))
+    if amount <= 0 or not await db.run_async(ledger.transfer, message.author.id, recipients, amount, 'rain'):
+        await message.add_reaction('❌')
+        await message.author.send("You don't have enough {0} to cover this "
+                                  "{1} {0} rain.".format(TOKEN, total_amount))
+        return
+
+    for user_id, _ in recipients:
+        notify.NOTIFIER.dm(user_id, "You just received a {} {} rain from <@{}>".format(amount, TOKEN,
+                                                                                       message.author.id))
+    notify.NOTIFIER.react(message, '☑')
+    await message.channel.send("<@{}> rained {} {} on {} users.".format(message.author.id, amount, TOKEN,
+                                                                       len(recipients)))
+
+
 @bot.command(aliases=util.get_aliases(aliases.WITHDRAW, exclude='withdraw'))
 async def withdraw(ctx):
     """
@@ -205,7 +348,10 @@ async def withdraw(ctx):
         return
     try:
         to = w3.toChecksumAddress(msg_list[1])
-        user_balance, _ = tasks.get_balance(message.author.id)
+        if to.lower() == MASTER.lower() or await db.run_async(tasks.own_account, to):
+            await message.author.send("You can't withdraw to a deposit address owned by this bot.")
+            return
+        user_balance, _ = await db.run_async(tasks.get_balance, message.author.id)
         user_balance = Decimal(user_balance)
         if user_balance <= 0:
             await message.author.send("You have 0 {} balance.  Please fund your account "
@@ -213,29 +359,29 @@ async def withdraw(ctx):
             return
         elif len(msg_list) > 2:
             # User provided an amount, send the whole amount.
-            print(msg_list)
             amount = Decimal(msg_list[2])
             total_amount = amount
             remove_amount = amount + FEE
-            tasks.add_pending(message.author.id, amount)
-            tasks.remove_balance(message.author.id, remove_amount)
 
         else:
             # User didn't provide an amount, send their whole balance - FEE
-            amount, _ = tasks.get_balance(message.author.id)
-            amount = Decimal(amount)
-            total_amount = amount - FEE
-            remove_amount = amount
-            tasks.add_pending(message.author.id, remove_amount)
-            tasks.remove_balance(message.author.id, amount)
-
-        if user_balance < total_amount or user_balance < FEE:
+            total_amount = user_balance - FEE
+            remove_amount = user_balance
+
+        # The balance check and the move to pending happen in one transaction, so racing withdraws or tips
+        # can't spend the same tokens twice.
+        reserved = total_amount > 0 and await db.run_async(ledger.reserve_withdraw, message.author.id,
+                                                           remove_amount, total_amount)
+        if not reserved:
             await message.author.send("You were trying to withdraw {1} {0} + a fee of {3} {0} and you "
                                       "only have {2} {0}.  Please review the your "
                                       "balance before withdrawing.".format(TOKEN, total_amount, user_balance, FEE))
             return
 
-        tasks.send_tokens.delay(to, total_amount, message.author.id)
+        if tasks.SETTLEMENT_MODE == 'batch':
+            await db.run_async(tasks.queue_withdraw, to, total_amount, message.author.id)
+        else:
+            tasks.send_tokens.delay(to, total_amount, message.author.id)
 
         await message.author.send("Your withdraw request for {2} {3} + {4} {3} fee has been queued.  You can check "
                                   "https://{0}/address/{1}#tokentxns for your transaction hash.  Please give a minute "
@@ -0,0 +1,132 @@
+import argparse
+import collections
+from concurrent.futures import ThreadPoolExecutor
+import configparser
+import modules.indexer as indexer
+import modules.ledger as ledger
+import modules.rpc as rpc
+import modules.util as util
+import requests
+import sys
+import time
+
+config = configparser.ConfigParser()
+config.read('config.ini')
+
+TOKEN = config.get('main', 'token')
+CHUNK_SIZE = config.getint('backfill', 'chunk_size', fallback=2000)
+MAX_CHUNK_SIZE = config.getint('backfill', 'max_chunk_size', fallback=100000)
+TARGET_LOGS = config.getint('backfill', 'target_logs', fallback=5000)
+WORKERS = config.getint('backfill', 'workers', fallback=4)
+PROGRESS_INTERVAL = config.getint('backfill', 'progress_interval', fallback=10)
+
+logger = util.get_logger('backfill')
+
+
+def fetch_range(from_block, to_block, recipients=None):
+    """
+    Fetch the Transfer logs for an inclusive block range, splitting it in half whenever the node refuses or
+    times out on it.  Returns (logs, split) where split says whether the range had to be divided.
+    """
+    try:
+        return indexer.get_transfer_logs(from_block, to_block, recipients), False
+    except (rpc.RPCError, requests.exceptions.RequestException) as e:
+        if from_block == to_block:
+            raise
+        logger.info("Splitting blocks {}-{}: {}".format(from_block, to_block, e))
+        middle = (from_block + to_block) // 2
+        first, _ = fetch_range(from_block, middle, recipients)
+        second, _ = fetch_range(middle + 1, to_block, recipients)
+        return first + second, True
+
+
+def next_chunk_size(chunk_size, split, log_count):
+    """
+    Halve the chunk size after a range had to be split and double it while ranges return well under
+    TARGET_LOGS logs.
+    """
+    if split:
+        return max(chunk_size // 2, 1)
+    if log_count < TARGET_LOGS // 2:
+        return min(chunk_size * 2, MAX_CHUNK_SIZE)
+    return chunk_size
+
+
+def backfill(start_block, end_block, name, workers=WORKERS, chunk_size=CHUNK_SIZE, recipients=None):
+    """
+    Credit every deposit between start_block and end_block.  Ranges are fetched ahead in parallel but written
+    in block order, each in one credit_deposits transaction that also advances the name checkpoint in
+    indexer_state, so an interrupted run resumes where it stopped.  Deposits that are already credited are
+    skipped, so overlapping the live indexer or an earlier run is safe.  Returns (blocks, credited deposits).
+    """
+    started = last_progress = time.monotonic()
+    blocks = credited = 0
+    next_block = start_block
+    in_flight = collections.deque()
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        while next_block <= end_block or in_flight:
+            # Keep every worker busy with the ranges after the one being written
+            while next_block <= end_block and len(in_flight) < workers * 2:
+                to_block = min(next_block + chunk_size - 1, end_block)
+                in_flight.append((next_block, to_block, pool.submit(fetch_range, next_block, to_block, recipients)))
+                next_block = to_block + 1
+
+            from_block, to_block, fetch = in_flight.popleft()
+            logs, split = fetch.result()
+            chunk_size = next_chunk_size(chunk_size, split, len(logs))
+
+            deposits = [indexer.parse_transfer(log) for log in logs if not log.get('removed')]
+            credited += len(ledger.credit_deposits(deposits, (name, to_block, None)))
+            blocks += to_block - from_block + 1
+
+            now = time.monotonic()
+            if now - last_progress >= PROGRESS_INTERVAL or not in_flight:
+                last_progress = now
+                logger.info("Backfilled through block {} ({}/{} blocks, {:.1f} blocks/s, chunk size {}, "
+                            "{} deposits credited)".format(to_block, blocks, end_block - start_block + 1,
+                                                           blocks / max(now - started, 0.001), chunk_size,
+                                                           credited))
+    return blocks, credited
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Credit historical {} deposits from Transfer logs.'.format(TOKEN))
+    parser.add_argument('--from', dest='start_block', type=int,
+                        help='first block to scan, defaults to resuming from the checkpoint or [indexer] start_block')
+    parser.add_argument('--to', dest='end_block', type=int,
+                        help='last block to scan, defaults to the latest confirmed block')
+    parser.add_argument('--name', default='backfill', help='checkpoint name in indexer_state (default: backfill)')
+    parser.add_argument('--restart', action='store_true', help='ignore the checkpoint and start from --from')
+    parser.add_argument('--address', action='append', dest='addresses', metavar='ADDRESS',
+                        help='only re-sync deposits to this address, can be given several times')
+    parser.add_argument('--workers', type=int, default=WORKERS, help='parallel log fetches')
+    parser.add_argument('--chunk-size', type=int, default=CHUNK_SIZE, help='initial blocks per eth_getLogs call')
+    args = parser.parse_args(argv)
+
+    try:
+        checkpoint, _ = indexer.get_cursor(args.name)
+    except ValueError:
+        # No checkpoint and no [indexer] start_block, --from is required
+        if args.start_block is None:
+            raise
+        checkpoint = args.start_block - 1
+    start_block = args.start_block if args.start_block is not None else checkpoint + 1
+    if not args.restart and args.start_block is not None and checkpoint >= args.start_block:
+        start_block = checkpoint + 1
+    end_block = args.end_block
+    if end_block is None:
+        end_block = int(rpc.call('eth_blockNumber'), 16) - indexer.CONFIRMATIONS
+    if start_block > end_block:
+        print("Nothing to backfill, checkpoint {} is at block {}".format(args.name, checkpoint))
+        return 0
+
+    started = time.monotonic()
+    blocks, credited = backfill(start_block, end_block, args.name, args.workers, args.chunk_size, args.addresses)
+    elapsed = max(time.monotonic() - started, 0.001)
+    print("Scanned blocks {}-{} in {:.1f}s ({:.1f} blocks/s), credited {} new deposits".format(
+        start_block, end_block, elapsed, blocks / elapsed, credited))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -1,4 +1,4 @@
 #!/bin/bash
 
-# Init the celery work queue
-./venv/bin/celery -A tasks worker --loglevel=info
\ No newline at end of file
+# Init the celery work queue.  Run exactly one worker with --beat for the periodic maintenance tasks.
+./venv/bin/celery -A tasks worker --beat --loglevel=info
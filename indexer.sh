@@ -0,0 +1,5 @@
+#!/bin/bash
+
+# Start the deposit indexer
+source venv/bin/activate
+python3 -m modules.indexer
@@ -0,0 +1,69 @@
+import configparser
+import modules.db as db
+import modules.shards as shards
+import os
+import signal
+import subprocess
+import sys
+import time
+
+config = configparser.ConfigParser()
+config.read('config.ini')
+
+SHARD_COUNT = config.getint('shard', 'count', fallback=0)
+PROCESSES = config.getint('shard', 'processes', fallback=1)
+RESTART_DELAY = config.getint('shard', 'restart_delay', fallback=10)
+
+
+def shard_ranges(shard_count, processes):
+    """
+    Split shards 0..shard_count-1 into contiguous "first-last" specs, one per process.
+    """
+    per_process, extra = divmod(shard_count, processes)
+    ranges = []
+    first = 0
+    for i in range(processes):
+        size = per_process + (1 if i < extra else 0)
+        if size:
+            ranges.append("{}-{}".format(first, first + size - 1))
+        first += size
+    return ranges
+
+
+def spawn(shard_spec, shard_count):
+    env = dict(os.environ, SHARD_IDS=shard_spec, SHARD_COUNT=str(shard_count))
+    return subprocess.Popen([sys.executable, 'app.py'], env=env)
+
+
+def main():
+    """
+    Run one bot process per shard range and restart any that exit.  With [shard] count = 0 the count Discord
+    recommends is used, so every process agrees on it.
+    """
+    shard_count = SHARD_COUNT or shards.recommended_shard_count(config.get('main', 'bot_token'))
+    if shard_count < 1:
+        raise ValueError("Shard count must be at least 1, got {}".format(shard_count))
+    shards.logger.info("Running {} shards in {} processes".format(shard_count, PROCESSES))
+
+    # Set up the schema before the bots start so they don't all try at once
+    db.db_init()
+    children = {spec: spawn(spec, shard_count) for spec in shard_ranges(shard_count, PROCESSES)}
+
+    def stop(signum, frame):
+        for child in children.values():
+            child.terminate()
+        sys.exit(0)
+
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+
+    while True:
+        time.sleep(RESTART_DELAY)
+        for spec, child in list(children.items()):
+            if child.poll() is not None:
+                shards.logger.error("Shards {} exited with {}, restarting".format(spec, child.returncode))
+                children[spec] = spawn(spec, shard_count)
+
+
+if __name__ == '__main__':
+    main()
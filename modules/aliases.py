@@ -21,4 +21,9 @@ WITHDRAW = {
 ACCOUNT = {
     'TRIGGER': ['account', 'deposit', 'address', 'a', 'd'],
     'DESCRIPTION': 'Provide your deposit address'
-}
\ No newline at end of file
+}
+
+RAIN = {
+    'TRIGGER': ['rain', 'r'],
+    'DESCRIPTION': 'Split an amount between everyone in a role or everyone recently active'
+}
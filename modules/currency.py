@@ -1,10 +1,17 @@
 import modules.aliases as aliases
 from celery import Celery
+import asyncio
 import configparser
+import functools
 import modules.db as db
+import modules.indexer as indexer
+import modules.keys as keys
+import modules.ledger as ledger
+import modules.notify as notify
+import modules.rpc as rpc
 from decimal import Decimal, InvalidOperation
-import eth_keyfile
 import json
+import re
 import requests
 import tasks
 import modules.util as util
@@ -28,21 +35,31 @@ ETHERSCAN_KEY = config.get('main', 'etherscan_key')
 INFURA = config.get('main', 'infura')
 INFURA_ROUTE = config.get(ENV, 'infura_route')
 BOT_ID = config.get('main', 'bot_id')
+INDEXER_ENABLED = config.getboolean('indexer', 'enabled', fallback=False)
 
 with open('static/abi.json', 'r') as abi_file:
     ABI = json.load(abi_file)
+
+TIP_TRIGGERS = frozenset('!' + alias for alias in aliases.TIP['TRIGGER'])
+# <@id> for users, <@!id> for members with a nickname
+MENTION = re.compile(r'<@!?(\d+)>$')
     
 
 async def get_all_txs(address):
+    """
+    Fetch the token transfers involving the address since the last block credited to its owner.
+    """
     get_blockno_call = "SELECT block_number FROM users WHERE address = %s"
     get_blockno_values = [address, ]
-    blockno_return = db.get_db_data(get_blockno_call, get_blockno_values)
+    blockno_return = await db.get_db_data_async(get_blockno_call, get_blockno_values)
     if blockno_return is not ():
         blockno = blockno_return[0][0]
         route = "{}api?module=account&action=tokentx&contractaddress={}" \
-                "&address={}&startblock={}&sort=asc&apikey={}".format(ETHERSCAN_ROUTE, CONTRACT_ADDRESS, address[0][0],
+                "&address={}&startblock={}&sort=asc&apikey={}".format(ETHERSCAN_ROUTE, CONTRACT_ADDRESS, address,
                                                                       blockno + 1, ETHERSCAN_KEY)
-        r = requests.get(route)
+        # A hung request would hold every coalesced !balance for this user, so give up after RPC_TIMEOUT
+        r = await asyncio.get_event_loop().run_in_executor(None, functools.partial(requests.get, route,
+                                                                                   timeout=rpc.RPC_TIMEOUT))
         rx = r.json()
 
         return rx, blockno
@@ -51,39 +68,40 @@ async def get_all_txs(address):
 
 async def set_tip_list(message, bot):
     """
-    Find the list of users to tip and add it to a dictionary.
+    Find the list of users to tip and add it to a dictionary.  Mentions are read in a single pass over the
+    words after the tip command, with names taken from discord's parsed mentions.
     """
     message['msg_list'] = message['content'].lower().split(' ')
-    message['starting_point'] = -1
-
-    for alias in aliases.TIP['TRIGGER']:
-        if ("!" + alias) in message['msg_list']:
-            message['starting_point'] = message['msg_list'].index("!" + alias)
+    message['starting_point'] = next((index for index, word in enumerate(message['msg_list'])
+                                      if word in TIP_TRIGGERS), -1)
 
     if message['starting_point'] == -1:
         return None
 
-    first_user_flag = False
+    mentioned = {str(user.id): user.name for user in message.get('mentions', ())}
+    skip = {str(message['author']), str(BOT_ID)}
+    seen = set()
     users_to_tip = []
 
     for t_index in range(message['starting_point'] + 1, len(message['msg_list'])):
-        if (first_user_flag
-                and len(message['msg_list'][t_index]) > 0
-                and str(message['msg_list'][t_index][0:2]) != "<@"):
-            # non-user found in tipping, break the loop
-            message['last_user'] = t_index
-            break
-        if (len(message['msg_list'][t_index]) > 0
-                and str(message['msg_list'][t_index][0:2]) == "<@"
-                and message['msg_list'][t_index] != ("<@" + str(message['author']) + ">")
-                and message['msg_list'][t_index] != ("<@" + str(BOT_ID) + ">")):
-            if not first_user_flag:
-                first_user_flag = True
-            user = message['msg_list'][t_index][2:-1]
-            username = bot.get_user(int(user))
-            user_dict = {'user': user, 'username': username.name}
-            if user_dict not in users_to_tip:
-                users_to_tip.append(user_dict)
+        word = message['msg_list'][t_index]
+        if not word:
+            continue
+        mention = MENTION.match(word)
+        if mention is None:
+            if users_to_tip:
+                # non-user found in tipping, break the loop
+                message['last_user'] = t_index
+                break
+            continue
+        user = mention.group(1)
+        if user in skip or user in seen:
+            continue
+        seen.add(user)
+        username = mentioned.get(user)
+        if username is None:
+            username = bot.get_user(int(user)).name
+        users_to_tip.append({'user': user, 'username': username})
 
     return users_to_tip
 
@@ -94,7 +112,7 @@ async def get_account(user_id):
     """
     get_account_sql = "SELECT address FROM users WHERE user_id = %s"
     get_account_values = [str(user_id), ]
-    account_return = db.get_db_data(get_account_sql, get_account_values)
+    account_return = await db.get_db_data_async(get_account_sql, get_account_values)
 
     return account_return
 
@@ -107,7 +125,7 @@ async def get_user_id(address):
     user_sql = "SELECT user_id FROM users WHERE address = %s"
     user_values = [address, ]
 
-    user_return = db.get_db_data(user_sql, user_values)
+    user_return = await db.get_db_data_async(user_sql, user_values)
 
     if user_return is ():
         return None
@@ -115,57 +133,65 @@ async def get_user_id(address):
     return user_return[0][0]
 
 
+def parse_token_txs(address, transactions):
+    """
+    Return the (tx_hash, log_index, block_number, address, amount) deposits to the address among Etherscan
+    tokentx results.  tokentx doesn't report log indexes, so the transfers are read from the transaction
+    receipts instead, keying each deposit exactly as the indexer and backfill do.
+    """
+    tx_hashes = sorted({transfer['hash'] for transfer in transactions if transfer['to'].lower() == address})
+    return [deposit for deposit in indexer.get_receipt_transfers(tx_hashes) if deposit[3] == address]
+
+
+# In-flight check_pending calls by user ID, so concurrent checks for the same user share one request
+_pending_checks = {}
+
+
 async def check_pending(message):
     """
-    Check to see if the current nonce is the same as the tracked nonce.  If not, update the balance and nonce
+    Check for new deposits for the message author.  Concurrent calls for the same user wait on the check
+    already in flight instead of repeating the Etherscan and DB calls.
     """
-    address = await get_account(message.author.id)
+    user_id = message.author.id
+    check = _pending_checks.get(user_id)
+    if check is None:
+        check = asyncio.ensure_future(check_user_pending(message))
+        _pending_checks[user_id] = check
+        check.add_done_callback(lambda _: _pending_checks.pop(user_id, None))
+    return await asyncio.shield(check)
 
-    if (address[0][0] is not None and address != ()
-            and address[0][0] != 'GENERATING' and address[0][0] != 'ERROR'):
 
-        transactions, blockno = await get_all_txs(address)
+async def check_user_pending(message):
+    """
+    Credit any new deposits Etherscan reports for the user's address.  Returns the amount credited.
+    """
+    if INDEXER_ENABLED:
+        # The deposit indexer credits balances as blocks confirm, polling Etherscan would only double up
+        return 0
 
-        new_balance = 0
-        new_blockno = 0
-        try:
-            for block in transactions['result']:
-                if block['to'].lower() == address[0][0].lower() and Decimal(block['blockNumber']) > Decimal(blockno):
-                    decimals = Decimal(10**18)
-                    new_balance += Decimal(Decimal(block['value']) / decimals)
-                    new_blockno = block['blockNumber']
-
-            if Decimal(new_balance) > 0 and Decimal(new_blockno) > 0:
-                balance, _ = tasks.get_balance(message.author.id)
-                balance = balance + new_balance
-
-                update_balance_sql = "UPDATE users SET block_number = %s, balance = %s WHERE user_id = %s"
-                update_balance_values = [new_blockno, balance, message.author.id]
-                success = db.set_db_data(update_balance_sql, update_balance_values)
-                if success is not None:
-                    logger.error("Error in setting DB data: {}".format(success))
-                    await message.author.send("There was an error setting your new balance, please reach "
-                                              "out to bot admin: {}".format(success))
-        except Exception as e:
-            await message.author.send("There was an error setting your new balance, please reach out to "
-                                      "bot admin: {}".format(e))
-        return new_balance
-
-    return 0
+    account_return = await get_account(message.author.id)
+    if account_return == () or account_return[0][0] is None or not account_return[0][0].startswith('0x'):
+        return 0
+
+    address = account_return[0][0].lower()
+    transactions, _ = await get_all_txs(address)
+    try:
+        deposits = await asyncio.get_event_loop().run_in_executor(None, parse_token_txs, address,
+                                                                  transactions['result'])
+        # Deposits are keyed on tx hash and log index, so anything a concurrent check already credited is skipped
+        credited = await db.run_async(ledger.credit_deposits, deposits)
+    except Exception as e:
+        await message.author.send("There was an error setting your new balance, please reach out to "
+                                  "bot admin: {}".format(e))
+        return 0
+    return sum((amount for _, _, _, _, _, amount in credited), Decimal(0))
 
 
 async def add_balance(user, username, amount):
     """
     Add the balance to the provided user.
     """
-    current_balance, _ = tasks.get_balance(user)
-    if current_balance is not None and current_balance is not ():
-        new_balance = current_balance + Decimal(amount)
-        tasks.set_balance(user, new_balance)
-    else:
-        new_user_sql = "INSERT INTO users (balance, user_id, username) VALUES (%s, %s, %s)"
-        new_user_values = [amount, user, username]
-        db.set_db_data(new_user_sql, new_user_values)
+    await db.run_async(ledger.credit, user, amount, username)
 
 
 async def validate_tip_amount(message, users_to_tip):
@@ -196,44 +222,67 @@ async def send_tip(message, users_to_tip, ctx, bot):
     """
     Update the database with new balances and respond with emojis.
     """
-    sender_new_balance = message['sender_balance'] - message['total_tip_amount']
+    recipients = [(receiver['user'], receiver['username']) for receiver in users_to_tip]
+    if not await db.run_async(ledger.transfer, message['author'], recipients, message['tip_amount']):
+        await ctx.message.add_reaction('❌')
+        await ctx.message.author.send("You don't have enough {0} to cover this "
+                                      "{1} {0} tip.".format(TOKEN, message['total_tip_amount']))
+        return
+
+    # Delivery happens in the background, the tip is complete once the ledger has committed
+    tip_dm = "You just received a {} {} tip from <@{}>".format(message['tip_amount'], TOKEN, message['author'])
     for receiver in users_to_tip:
-        try:
-            await add_balance(receiver['user'], receiver['username'], message['tip_amount'])
-            dm_user = bot.get_user(int(receiver['user']))
-            logger.info("dm user: {}".format(dm_user))
-            logger.info("dm user id: {}".format(dm_user.id))
-            await dm_user.send("You just received a {} {} tip from <@{}>".format(message['tip_amount'],
-                                                                                 TOKEN,
-                                                                                 message['author']))
-        except Exception as e:
-            logger.error("Error adding balance / sending dm: {}".format(e))
-            continue
+        notify.NOTIFIER.dm(receiver['user'], tip_dm)
 
-    tasks.set_balance(message['author'], sender_new_balance)
-
-    await ctx.message.add_reaction('☑')
     # Note, these have unicode that does not show in IDE.  Do not modify
-    await ctx.message.add_reaction('🇸')
-    await ctx.message.add_reaction('🇪')
-    await ctx.message.add_reaction('🇳')
-    await ctx.message.add_reaction('🇹')
+    notify.NOTIFIER.react(ctx.message, '☑', '🇸', '🇪', '🇳', '🇹')
 
 
 async def validate_user(message):
     """
     Validate the user has enough tokens to send the tip.
     """
-    message['sender_balance'], _ = tasks.get_balance(message['author'])
+    snapshot = await db.run_async(util.get_snapshot, message['author'])
+    if snapshot is None:
+        return False
 
-    if (message['sender_balance'] is None
-            or message['sender_balance'] is ()
-            or message['total_tip_amount'] > message['sender_balance']):
+    message['sender_balance'] = snapshot['balance']
+    if message['total_tip_amount'] > message['sender_balance']:
         return False
 
     return True
 
 
+def claim_pooled_address(user_id):
+    """
+    Give the user a ready, funded and approved address from the pool.  Returns the address the user already has
+    if another command gave them one first, or None if the pool is empty.
+    """
+    with db.transaction() as db_cursor:
+        # Lock the user's row so concurrent !account commands claim one address between them
+        db_cursor.execute("SELECT address FROM users WHERE user_id = %s FOR UPDATE", [str(user_id), ])
+        user_return = db_cursor.fetchone()
+        if user_return is not None and user_return[0] is not None:
+            return user_return[0]
+
+        # The UPDATE ... LIMIT 1 both picks and locks the address, so two users can never claim the same one.
+        # LAST_INSERT_ID(id) hands back exactly the row claimed here, not some older claim for this user.
+        claimed = db_cursor.execute("UPDATE address_pool SET status = 'claimed', user_id = %s, id = LAST_INSERT_ID(id) "
+                                    "WHERE status = 'ready' ORDER BY id LIMIT 1", [str(user_id), ])
+        if claimed != 1:
+            return None
+        db_cursor.execute("SELECT address FROM address_pool WHERE id = LAST_INSERT_ID()")
+        address = db_cursor.fetchone()[0]
+        db_cursor.execute("UPDATE users SET address = %s WHERE user_id = %s", [address, str(user_id)])
+        db_cursor.execute("SELECT COUNT(*) FROM address_pool WHERE status = 'ready'")
+        depth = db_cursor.fetchone()[0]
+
+    util.invalidate_snapshots([user_id, ])
+    if depth < tasks.ADDRESS_POOL_LOW_WATERMARK:
+        tasks.fill_address_pool.delay()
+    return address
+
+
 async def generate_new_account(message, w3):
     """
     Generates a new account and gives privileges to the master account.
@@ -242,15 +291,14 @@ async def generate_new_account(message, w3):
     await message.author.send("No account, generating one.  Please check back in a few minutes by sending the "
                               "!account command again.")
 
-    db.set_db_data("UPDATE users SET address = 'GENERATING' WHERE user_id = %s", [message.author.id, ])
+    await db.set_db_data_async("UPDATE users SET address = 'GENERATING' WHERE user_id = %s", [message.author.id, ])
+    await db.run_async(util.invalidate_snapshots, [message.author.id, ])
 
     new_account = w3.eth.account.create('')
 
-    # Store the user's address in a keyfile
-    keyfile_return = eth_keyfile.create_keyfile_json(new_account.key, b'')
+    # Store the user's address in a keyfile.  The keyfile KDF is slow, so keep it off the event loop.
     address = w3.toChecksumAddress(new_account.address)
-    with open('keyfiles/{}.json'.format(address), 'w') as local_keyfile:
-        json.dump(keyfile_return, local_keyfile)
+    await asyncio.get_event_loop().run_in_executor(None, keys.write_keyfile, address, new_account.key)
 
     # Update user's account
     tasks.set_account.delay(message.author.id, address)
@@ -1,5 +1,15 @@
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+import asyncio
+import collections
 import configparser
+import functools
+import os
+import threading
+import time
 import MySQLdb
+import MySQLdb.cursors
+from MySQLdb.constants import CLIENT
 
 # Read config and parse constants
 config = configparser.ConfigParser()
@@ -10,18 +20,236 @@ DB_SCHEMA = config.get('db', 'schema')
 DB_HOST = config.get('db', 'host')
 DB_USER = config.get('db', 'user')
 DB_PW = config.get('db', 'pw')
+DB_POOL_SIZE = config.getint('db', 'pool_size', fallback=10)
+DB_POOL_TIMEOUT = config.getint('db', 'pool_timeout', fallback=10)
+DB_MAX_IDLE = config.getint('db', 'max_idle', fallback=300)
+DB_HEALTH_CHECK = config.getint('db', 'health_check', fallback=30)
+DB_MIGRATION_CHUNK = config.getint('db', 'migration_chunk', fallback=1000)
+DB_STREAM_CHUNK = config.getint('db', 'stream_chunk', fallback=1000)
+DB_INIT_LOCK_TIMEOUT = config.getint('db', 'init_lock_timeout', fallback=600)
+
+
+class PoolTimeout(Exception):
+    """
+    Raised when no connection could be checked out of the pool in time.
+    """
+    pass
+
+
+class ConnectionPool(object):
+    """
+    Bounded, thread-safe pool of MySQL connections.
+
+    Idle connections are reused most-recently-used first, pinged before reuse if they have sat longer than
+    `health_check` seconds and closed once they have been idle longer than `max_idle` seconds.  The pool is
+    recreated after a fork so celery's prefork workers never share a socket with their parent.
+    """
+    def __init__(self, size, timeout, max_idle, health_check, **connect_kwargs):
+        self.size = size
+        self.timeout = timeout
+        self.max_idle = max_idle
+        self.health_check = health_check
+        self.connect_kwargs = connect_kwargs
+        self._cond = threading.Condition()
+        self._reset()
+
+    def _reset(self):
+        self._pid = os.getpid()
+        self._idle = collections.deque()
+        self._open = 0
+        self.metrics = collections.Counter()
+
+    def _connect(self):
+        db = MySQLdb.connect(**self.connect_kwargs)
+        db.autocommit(True)
+        self.metrics['created'] += 1
+        return db
+
+    def _evict_idle(self):
+        """
+        Close connections idle past max_idle.  The oldest connections sit at the left of the deque.
+        """
+        now = time.monotonic()
+        while self._idle and now - self._idle[0][1] > self.max_idle:
+            db, _ = self._idle.popleft()
+            self._open -= 1
+            self.metrics['evicted'] += 1
+            try:
+                db.close()
+            except MySQLdb.Error:
+                pass
+
+    def acquire(self):
+        """
+        Check a connection out of the pool, opening a new one if the pool is below its bound.
+        """
+        deadline = time.monotonic() + self.timeout
+        with self._cond:
+            if self._pid != os.getpid():
+                self._reset()
+            while True:
+                self._evict_idle()
+                if self._idle:
+                    db, last_used = self._idle.pop()
+                    break
+                if self._open < self.size:
+                    self._open += 1
+                    db, last_used = None, None
+                    break
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    self.metrics['timeouts'] += 1
+                    raise PoolTimeout("No DB connection available after {}s".format(self.timeout))
+                self.metrics['waits'] += 1
+                self._cond.wait(remaining)
+
+        try:
+            if db is None:
+                return self._connect()
+            if time.monotonic() - last_used > self.health_check:
+                try:
+                    db.ping()
+                except MySQLdb.Error:
+                    self.metrics['failed_checks'] += 1
+                    try:
+                        db.close()
+                    except MySQLdb.Error:
+                        pass
+                    return self._connect()
+            self.metrics['reused'] += 1
+            return db
+        except Exception:
+            self._discard()
+            raise
+
+    def release(self, db, discard=False):
+        """
+        Return a connection to the pool, or close it if it is broken.
+        """
+        if discard:
+            try:
+                db.close()
+            except MySQLdb.Error:
+                pass
+            self._discard()
+            return
+        with self._cond:
+            if self._pid != os.getpid():
+                return
+            self._idle.append((db, time.monotonic()))
+            self._cond.notify()
+
+    def _discard(self):
+        with self._cond:
+            if self._pid == os.getpid():
+                self._open -= 1
+                self.metrics['discarded'] += 1
+            self._cond.notify()
+
+    @contextmanager
+    def connection(self):
+        """
+        Context manager yielding a pooled connection.  Open transactions are rolled back on error and
+        connections that lost the server are dropped instead of returned.
+        """
+        db = self.acquire()
+        try:
+            yield db
+        except MySQLdb.OperationalError:
+            self.release(db, discard=True)
+            raise
+        except Exception:
+            try:
+                db.rollback()
+            except MySQLdb.Error:
+                self.release(db, discard=True)
+                raise
+            self.release(db)
+            raise
+        else:
+            self.release(db)
+
+    def stats(self):
+        """
+        Return a snapshot of the pool's gauges and counters.
+        """
+        with self._cond:
+            stats = dict(self.metrics)
+            stats.update({'size': self.size, 'open': self._open, 'idle': len(self._idle),
+                          'in_use': self._open - len(self._idle)})
+        return stats
+
+
+POOL = ConnectionPool(DB_POOL_SIZE, DB_POOL_TIMEOUT, DB_MAX_IDLE, DB_HEALTH_CHECK,
+                      host=DB_HOST, port=3306, user=DB_USER, passwd=DB_PW, db=DB_SCHEMA, use_unicode=True,
+                      charset="utf8mb4", client_flag=CLIENT.FOUND_ROWS)
+
+
+_executor = None
+
+
+def get_executor():
+    """
+    Return the executor that runs DB calls for the event loop.  It has one thread per pooled connection so
+    a queued call never sits on a thread that is itself waiting for a connection.
+    """
+    global _executor
+    if _executor is None:
+        _executor = ThreadPoolExecutor(max_workers=DB_POOL_SIZE, thread_name_prefix='db')
+    return _executor
+
+
+async def run_async(func, *args, **kwargs):
+    """
+    Run a blocking DB function on the DB executor so the discord event loop is never stalled by a query.
+    """
+    loop = asyncio.get_event_loop()
+    return await loop.run_in_executor(get_executor(), functools.partial(func, *args, **kwargs))
+
+
+def pool_stats():
+    """
+    Return the connection pool metrics for this process.
+    """
+    return POOL.stats()
 
 
 def db_init():
     """
-    Check for tables and triggers, if they don't exist, create them
+    Check for tables and triggers, if they don't exist, create them.  A server-wide lock makes bot processes
+    started together take turns, so only the first one creates the schema and runs the migrations.
     """
-    if not check_db_exist():
-        print("DB did not exist.")
-        create_db()
-    print("db did exist: {}".format(DB_SCHEMA))
-    create_tables()
-    create_triggers()
+    with init_lock():
+        if not check_db_exist():
+            print("DB did not exist.")
+            create_db()
+        print("db did exist: {}".format(DB_SCHEMA))
+        create_tables()
+        create_triggers()
+        run_migrations()
+
+
+@contextmanager
+def init_lock():
+    """
+    Hold the MySQL named lock for DB_SCHEMA's initialisation.  It belongs to this connection's session, so it is
+    released if the process dies while holding it.
+    """
+    db = MySQLdb.connect(host=DB_HOST, port=3306, user=DB_USER, passwd=DB_PW, use_unicode=True,
+                         charset="utf8mb4")
+    lock_name = "{}.db_init".format(DB_SCHEMA)
+    try:
+        db_cursor = db.cursor()
+        db_cursor.execute("SELECT GET_LOCK(%s, %s)", [lock_name, DB_INIT_LOCK_TIMEOUT])
+        if db_cursor.fetchone()[0] != 1:
+            raise RuntimeError("Timed out waiting for another process to initialise {}".format(DB_SCHEMA))
+        try:
+            yield
+        finally:
+            db_cursor.execute("SELECT RELEASE_LOCK(%s)", [lock_name, ])
+            db_cursor.close()
+    finally:
+        db.close()
 
 
 def check_db_exist():
@@ -58,37 +286,22 @@ def check_table_exists(table_name):
     """
     Check if the provided table exists
     """
-    db = MySQLdb.connect(host=DB_HOST, port=3306, user=DB_USER, passwd=DB_PW, db=DB_SCHEMA, use_unicode=True,
-                         charset="utf8mb4")
-    db_cursor = db.cursor()
     sql = "SHOW TABLES LIKE '{}'".format(table_name)
-    db_cursor.execute(sql)
-    result = db_cursor.fetchall()
-    db_cursor.close()
-    db.close()
-    return result
+    return get_db_data(sql, None)
 
 
 def create_triggers():
     """
     Create predefined triggers
     """
-    db = MySQLdb.connect(host=DB_HOST, port=3306, user=DB_USER, passwd=DB_PW, db=DB_SCHEMA, use_unicode=True,
-                         charset="utf8mb4")
-    db_cursor = db.cursor()
     # TODO: Add triggers
-    db.commit()
-    db_cursor.close()
-    db.close()
+    pass
 
 
 def create_tables():
     """
     Create predefined tables
     """
-    db = MySQLdb.connect(host=DB_HOST, port=3306, user=DB_USER, passwd=DB_PW, db=DB_SCHEMA, use_unicode=True,
-                         charset="utf8mb4")
-    db_cursor = db.cursor()
     # TODO: Add tables
     exists = check_table_exists('users')
     if not exists:
@@ -97,32 +310,258 @@ def create_tables():
                   `user_id` varchar(64) NOT NULL,
                   `username` varchar(45) DEFAULT NULL,
                   `address` varchar(64) DEFAULT NULL,
-                  `balance` varchar(64) DEFAULT NULL,
-                  `pending_withdraw` varchar(64) DEFAULT '0',
+                  `balance` decimal(65,18) NOT NULL DEFAULT '0',
+                  `pending_withdraw` decimal(65,18) NOT NULL DEFAULT '0',
                   `notify` tinyint(1) DEFAULT NULL,
                   `block_number` int(64) DEFAULT '0',
                   PRIMARY KEY (`user_id`),
                   UNIQUE KEY `address_UNIQUE` (`address`)
               ) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4;
               """
-        db_cursor.execute(sql)
+        set_db_data(sql, None)
         print("Confirming user table created: {}".format(check_table_exists('users')))
-    db.commit()
-    db_cursor.close()
-    db.close()
+
+
+def get_column_type(table_name, column_name):
+    """
+    Return the data type of a column, or None if the column doesn't exist
+    """
+    sql = ("SELECT DATA_TYPE FROM information_schema.COLUMNS "
+           "WHERE TABLE_SCHEMA = %s AND TABLE_NAME = %s AND COLUMN_NAME = %s")
+    result = get_db_data(sql, [DB_SCHEMA, table_name, column_name])
+    if result == ():
+        return None
+    return result[0][0]
+
+
+def migrate_decimal_balances():
+    """
+    Convert users.balance and users.pending_withdraw from varchar(64) to decimal(65,18).
+
+    Values are copied into shadow columns in user_id chunks so no single statement locks the whole table,
+    then the columns are swapped in one ALTER.  Safe to rerun if interrupted.  Stop the bot and workers
+    first so no balance changes between the copy and the swap.
+    """
+    if get_column_type('users', 'balance') == 'decimal':
+        return
+
+    if get_column_type('users', 'balance_dec') is None:
+        set_db_data("ALTER TABLE users "
+                    "ADD COLUMN balance_dec decimal(65,18) NOT NULL DEFAULT '0', "
+                    "ADD COLUMN pending_dec decimal(65,18) NOT NULL DEFAULT '0'", None)
+
+    last_id = ''
+    while True:
+        chunk = get_db_data("SELECT user_id FROM users WHERE user_id > %s ORDER BY user_id LIMIT %s",
+                            [last_id, DB_MIGRATION_CHUNK])
+        if chunk == ():
+            break
+        set_db_data("UPDATE users SET "
+                    "balance_dec = CAST(COALESCE(NULLIF(balance, ''), '0') AS DECIMAL(65,18)), "
+                    "pending_dec = CAST(COALESCE(NULLIF(pending_withdraw, ''), '0') AS DECIMAL(65,18)) "
+                    "WHERE user_id > %s AND user_id <= %s", [last_id, chunk[-1][0]])
+        last_id = chunk[-1][0]
+        print("Migrated balances through user {}".format(last_id))
+
+    set_db_data("ALTER TABLE users "
+                "DROP COLUMN balance, DROP COLUMN pending_withdraw, "
+                "CHANGE COLUMN balance_dec balance decimal(65,18) NOT NULL DEFAULT '0', "
+                "CHANGE COLUMN pending_dec pending_withdraw decimal(65,18) NOT NULL DEFAULT '0'", None)
+
+
+def create_deposit_tables():
+    """
+    Create the tables the deposit indexer writes: credited transfers and per-indexer block cursors.
+    """
+    set_db_data("""
+                CREATE TABLE IF NOT EXISTS `deposits` (
+                    `tx_hash` char(66) NOT NULL,
+                    `log_index` int NOT NULL,
+                    `block_number` int NOT NULL,
+                    `user_id` varchar(64) NOT NULL,
+                    `address` varchar(64) NOT NULL,
+                    `amount` decimal(65,18) NOT NULL,
+                    PRIMARY KEY (`tx_hash`, `log_index`),
+                    KEY `block_number_idx` (`block_number`),
+                    KEY `user_id_idx` (`user_id`)
+                ) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4;
+                """, None)
+    set_db_data("""
+                CREATE TABLE IF NOT EXISTS `indexer_state` (
+                    `name` varchar(32) NOT NULL,
+                    `block_number` int NOT NULL,
+                    `block_hash` char(66) DEFAULT NULL,
+                    PRIMARY KEY (`name`)
+                ) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4;
+                """, None)
+
+
+def create_withdrawals_table():
+    """
+    Create the queue of withdrawals waiting to be paid out in a batch.
+    """
+    set_db_data("""
+                CREATE TABLE IF NOT EXISTS `withdrawals` (
+                    `id` bigint NOT NULL AUTO_INCREMENT,
+                    `user_id` varchar(64) NOT NULL,
+                    `address` varchar(64) NOT NULL,
+                    `amount` decimal(65,18) NOT NULL,
+                    `status` varchar(16) NOT NULL DEFAULT 'queued',
+                    `batch_id` char(32) DEFAULT NULL,
+                    `tx_hash` char(66) DEFAULT NULL,
+                    `created_at` timestamp NOT NULL DEFAULT CURRENT_TIMESTAMP,
+                    PRIMARY KEY (`id`),
+                    KEY `status_idx` (`status`, `id`),
+                    KEY `batch_id_idx` (`batch_id`)
+                ) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4;
+                """, None)
+
+
+def create_pending_txs_table():
+    """
+    Create the table of broadcast transactions awaiting a receipt.
+    """
+    set_db_data("""
+                CREATE TABLE IF NOT EXISTS `pending_txs` (
+                    `tx_hash` char(66) NOT NULL,
+                    `kind` varchar(16) NOT NULL,
+                    `payload` text NOT NULL,
+                    `nonce` int DEFAULT NULL,
+                    `status` varchar(16) NOT NULL DEFAULT 'pending',
+                    `created_at` timestamp NOT NULL DEFAULT CURRENT_TIMESTAMP,
+                    PRIMARY KEY (`tx_hash`),
+                    KEY `status_idx` (`status`, `created_at`)
+                ) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4;
+                """, None)
+
+
+def create_address_pool_table():
+    """
+    Create the pool of funded and approved deposit addresses waiting to be handed out.
+    """
+    set_db_data("""
+                CREATE TABLE IF NOT EXISTS `address_pool` (
+                    `id` bigint NOT NULL AUTO_INCREMENT,
+                    `address` varchar(64) NOT NULL,
+                    `status` varchar(16) NOT NULL DEFAULT 'funding',
+                    `user_id` varchar(64) DEFAULT NULL,
+                    `created_at` timestamp NOT NULL DEFAULT CURRENT_TIMESTAMP,
+                    PRIMARY KEY (`id`),
+                    UNIQUE KEY `address_UNIQUE` (`address`),
+                    KEY `status_idx` (`status`, `id`),
+                    KEY `user_id_idx` (`user_id`)
+                ) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4;
+                """, None)
+
+
+def create_ledger_tables():
+    """
+    Create the append-only ledger of balance changes and its periodic per-user snapshots.  Existing balances
+    are recorded as opening entries so the ledger sums to the users table from the start.
+    """
+    set_db_data("""
+                CREATE TABLE IF NOT EXISTS `ledger` (
+                    `id` bigint NOT NULL AUTO_INCREMENT,
+                    `user_id` varchar(64) NOT NULL,
+                    `kind` varchar(16) NOT NULL,
+                    `amount` decimal(65,18) NOT NULL DEFAULT '0',
+                    `pending` decimal(65,18) NOT NULL DEFAULT '0',
+                    `ref` varchar(128) DEFAULT NULL,
+                    `created_at` timestamp NOT NULL DEFAULT CURRENT_TIMESTAMP,
+                    PRIMARY KEY (`id`),
+                    KEY `user_id_idx` (`user_id`, `id`)
+                ) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4;
+                """, None)
+    set_db_data("""
+                CREATE TABLE IF NOT EXISTS `ledger_snapshots` (
+                    `ledger_id` bigint NOT NULL,
+                    `user_id` varchar(64) NOT NULL,
+                    `balance` decimal(65,18) NOT NULL,
+                    `pending_withdraw` decimal(65,18) NOT NULL,
+                    `created_at` timestamp NOT NULL DEFAULT CURRENT_TIMESTAMP,
+                    PRIMARY KEY (`ledger_id`, `user_id`)
+                ) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4;
+                """, None)
+    set_db_data("INSERT INTO ledger (user_id, kind, amount, pending) "
+                "SELECT user_id, 'opening', balance, pending_withdraw FROM users "
+                "WHERE balance <> 0 OR pending_withdraw <> 0", None)
+
+
+def add_legacy_block_numbers():
+    """
+    Freeze each user's block_number as legacy_block_number.  Deposits credited before the deposits table
+    existed have no row there, so ledger.credit_deposits treats anything at or below this block as already
+    credited.
+    """
+    if get_column_type('users', 'legacy_block_number') is None:
+        set_db_data("ALTER TABLE users ADD COLUMN legacy_block_number int NOT NULL DEFAULT '0'", None)
+    set_db_data("UPDATE users SET legacy_block_number = COALESCE(block_number, 0)", None)
+
+
+def track_replacement_hashes():
+    """
+    Keep every hash broadcast for a tracked transaction.  A stuck transaction's replacement gets its own row
+    in pending_tx_hashes pointing at the original, since either one may be the one that gets mined.
+    checked_at lets the confirmation tracker poll the least recently checked transactions first.
+    """
+    set_db_data("""
+                CREATE TABLE IF NOT EXISTS `pending_tx_hashes` (
+                    `tx_hash` char(66) NOT NULL,
+                    `pending_hash` char(66) NOT NULL,
+                    PRIMARY KEY (`tx_hash`),
+                    KEY `pending_hash_idx` (`pending_hash`)
+                ) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4;
+                """, None)
+    if get_column_type('pending_txs', 'checked_at') is None:
+        set_db_data("ALTER TABLE pending_txs ADD COLUMN `checked_at` timestamp NULL DEFAULT NULL, "
+                    "ADD KEY `checked_idx` (`status`, `checked_at`)", None)
+    set_db_data("INSERT IGNORE INTO pending_tx_hashes (tx_hash, pending_hash) "
+                "SELECT tx_hash, tx_hash FROM pending_txs", None)
+
+
+# Ordered list of (version, migration).  Append new migrations to the end, never reorder.
+MIGRATIONS = [
+    (1, migrate_decimal_balances),
+    (2, create_deposit_tables),
+    (3, create_withdrawals_table),
+    (4, create_pending_txs_table),
+    (5, create_address_pool_table),
+    (6, create_ledger_tables),
+    (7, add_legacy_block_numbers),
+    (8, track_replacement_hashes),
+]
+
+
+def run_migrations():
+    """
+    Apply any migrations that haven't been recorded in schema_migrations yet
+    """
+    set_db_data("CREATE TABLE IF NOT EXISTS `schema_migrations` ("
+                "`version` int NOT NULL, "
+                "`name` varchar(64) NOT NULL, "
+                "`applied_at` timestamp NOT NULL DEFAULT CURRENT_TIMESTAMP, "
+                "PRIMARY KEY (`version`)"
+                ") ENGINE=InnoDB DEFAULT CHARSET=utf8mb4", None)
+    applied = {row[0] for row in get_db_data("SELECT version FROM schema_migrations", None)}
+
+    for version, migration in MIGRATIONS:
+        if version in applied:
+            continue
+        print("Running migration {}: {}".format(version, migration.__name__))
+        migration()
+        set_db_data("INSERT INTO schema_migrations (version, name) VALUES (%s, %s)",
+                    [version, migration.__name__])
 
 
 def get_db_data(db_call, values):
     """
     Retrieve data from DB
     """
-    db = MySQLdb.connect(host=DB_HOST, port=3306, user=DB_USER, passwd=DB_PW, db=DB_SCHEMA, use_unicode=True,
-                         charset="utf8mb4")
-    db_cursor = db.cursor()
-    db_cursor.execute(db_call, values)
-    db_data = db_cursor.fetchall()
-    db_cursor.close()
-    db.close()
+    with POOL.connection() as db:
+        db_cursor = db.cursor()
+        db_cursor.execute(db_call, values)
+        db_data = db_cursor.fetchall()
+        db_cursor.close()
     return db_data
 
 
@@ -130,14 +569,82 @@ def set_db_data(db_call, values):
     """
     Enter data into DB
     """
-    db = MySQLdb.connect(host=DB_HOST, port=3306, user=DB_USER, passwd=DB_PW, db=DB_SCHEMA, use_unicode=True,
-                         charset="utf8mb4")
     try:
-        db_cursor = db.cursor()
-        db_cursor.execute(db_call, values)
-        db.commit()
-        db_cursor.close()
-        db.close()
+        with POOL.connection() as db:
+            db_cursor = db.cursor()
+            db_cursor.execute(db_call, values)
+            db.commit()
+            db_cursor.close()
         return None
     except MySQLdb.ProgrammingError as e:
         return e
+
+
+def update_db_data(db_call, values):
+    """
+    Enter data into DB and return the number of matched rows
+    """
+    with POOL.connection() as db:
+        db_cursor = db.cursor()
+        rows = db_cursor.execute(db_call, values)
+        db.commit()
+        db_cursor.close()
+    return rows
+
+
+async def get_db_data_async(db_call, values):
+    """
+    Retrieve data from DB without blocking the event loop
+    """
+    return await run_async(get_db_data, db_call, values)
+
+
+async def set_db_data_async(db_call, values):
+    """
+    Enter data into DB without blocking the event loop
+    """
+    return await run_async(set_db_data, db_call, values)
+
+
+@contextmanager
+def transaction():
+    """
+    Run several statements on one pooled connection as a single transaction.  Yields a cursor; the
+    transaction commits when the block exits and rolls back if it raises.
+    """
+    with POOL.connection() as db:
+        db.begin()
+        db_cursor = db.cursor()
+        yield db_cursor
+        db_cursor.close()
+        db.commit()
+
+
+@contextmanager
+def read_snapshot():
+    """
+    Yield a pooled connection inside a read-only transaction with a consistent snapshot, so several scans
+    see the database as of the same moment.
+    """
+    with POOL.connection() as db:
+        db.query("START TRANSACTION WITH CONSISTENT SNAPSHOT, READ ONLY")
+        yield db
+        db.commit()
+
+
+def stream(db, db_call, values, size=DB_STREAM_CHUNK):
+    """
+    Yield the rows of a query from a server-side cursor, size rows at a time, so large scans don't load the
+    whole result into memory.  The rows must be consumed before the connection runs another query.
+    """
+    db_cursor = db.cursor(MySQLdb.cursors.SSCursor)
+    try:
+        db_cursor.execute(db_call, values)
+        while True:
+            rows = db_cursor.fetchmany(size)
+            if not rows:
+                break
+            for row in rows:
+                yield row
+    finally:
+        db_cursor.close()
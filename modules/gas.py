@@ -0,0 +1,82 @@
+import configparser
+import json
+import modules.rpc as rpc
+import modules.util as util
+
+config = configparser.ConfigParser()
+config.read('config.ini')
+
+EIP1559 = config.getboolean('gas', 'eip1559', fallback=False)
+FEE_TTL = config.getint('gas', 'ttl', fallback=15)
+HISTORY_BLOCKS = config.getint('gas', 'history_blocks', fallback=20)
+PRIORITY_PERCENTILE = config.getint('gas', 'percentile', fallback=50)
+ESTIMATE_MARGIN = float(config.get('gas', 'estimate_margin', fallback='1.2'))
+
+FEES_KEY = 'gas:fees'
+
+
+def median(values):
+    values = sorted(values)
+    return values[len(values) // 2] if values else 0
+
+
+def fetch_fees():
+    """
+    Work out fees from the node.  With EIP-1559 the tip is the median of the PRIORITY_PERCENTILE rewards
+    paid over the last HISTORY_BLOCKS blocks and the fee cap leaves room for the base fee to double.
+    Otherwise it's the node's gas price.
+    """
+    if not EIP1559:
+        return {'gasPrice': int(rpc.call('eth_gasPrice'), 16)}
+
+    history = rpc.call('eth_feeHistory', [hex(HISTORY_BLOCKS), 'latest', [PRIORITY_PERCENTILE]])
+    # The last base fee is the one the next block will charge
+    next_base_fee = int(history['baseFeePerGas'][-1], 16)
+    priority_fee = median(int(reward[0], 16) for reward in history['reward'] if reward)
+    return {'maxPriorityFeePerGas': priority_fee, 'maxFeePerGas': 2 * next_base_fee + priority_fee}
+
+
+def fee_params():
+    """
+    Return the fee fields for a new transaction, shared by every process through Redis for FEE_TTL seconds.
+    """
+    redis = util.get_redis()
+    cached = redis.get(FEES_KEY)
+    if cached is not None:
+        return json.loads(cached)
+    fees = fetch_fees()
+    redis.setex(FEES_KEY, FEE_TTL, json.dumps(fees))
+    return fees
+
+
+def max_fee(fees):
+    """
+    The most a transaction with these fee fields can pay per unit of gas.
+    """
+    return fees.get('maxFeePerGas', fees.get('gasPrice'))
+
+
+def bump_fees(tx, fees):
+    """
+    Raise a stuck transaction's fees enough for nodes to accept it as a replacement (at least 10%), and to at
+    least the current fees.
+    """
+    for field in ('gasPrice', 'maxFeePerGas', 'maxPriorityFeePerGas'):
+        if field in tx:
+            tx[field] = max(int(tx[field] * 1.125) + 1, fees.get(field, 0))
+    return tx
+
+
+def estimate(function, sender, default=None):
+    """
+    Return a gas limit for this exact contract call: the node's estimate plus ESTIMATE_MARGIN.  Estimates
+    aren't shared between calls, since a transfer to an address without tokens costs far more gas than one
+    to an address that already holds some.  If the node can't estimate the call, default is returned when
+    given.
+    """
+    try:
+        return int(function.estimateGas({'from': sender}) * ESTIMATE_MARGIN)
+    except Exception:
+        if default is None:
+            raise
+        return default
@@ -0,0 +1,140 @@
+import configparser
+import modules.db as db
+import modules.ledger as ledger
+import modules.rpc as rpc
+import modules.util as util
+from decimal import Decimal
+import time
+
+config = configparser.ConfigParser()
+config.read('config.ini')
+
+CONTRACT_ADDRESS = config.get('main', 'contract')
+BATCH_SIZE = config.getint('indexer', 'batch_size', fallback=2000)
+CONFIRMATIONS = config.getint('indexer', 'confirmations', fallback=12)
+REORG_DEPTH = config.getint('indexer', 'reorg_depth', fallback=64)
+POLL_INTERVAL = config.getint('indexer', 'poll_interval', fallback=15)
+# No default: scanning from genesis is pointless, and the right block depends on when the token was deployed
+START_BLOCK = config.get('indexer', 'start_block', fallback='').strip()
+START_BLOCK = int(START_BLOCK) if START_BLOCK else None
+
+CURSOR_NAME = 'deposits'
+# keccak256("Transfer(address,address,uint256)")
+TRANSFER_TOPIC = '0xddf252ad1be2c89b69c2b068fc378daa952ba7f163c4a11628f55a4df523b3ef'
+DECIMALS = Decimal(10**18)
+
+logger = util.get_logger('indexer')
+
+
+def get_cursor(name=CURSOR_NAME):
+    """
+    Return the (block_number, block_hash) the named indexer has processed through.
+    """
+    cursor_return = db.get_db_data("SELECT block_number, block_hash FROM indexer_state WHERE name = %s", [name, ])
+    if cursor_return == ():
+        if START_BLOCK is None:
+            raise ValueError("No {} cursor yet, set start_block under [indexer] to the block the token contract "
+                             "was deployed in".format(name))
+        return START_BLOCK - 1, None
+    return cursor_return[0]
+
+
+def get_transfer_logs(from_block, to_block, recipients=None):
+    """
+    Fetch the token's Transfer logs for an inclusive block range, optionally only those to the recipients.
+    """
+    topics = [TRANSFER_TOPIC]
+    if recipients:
+        topics += [None, ['0x' + address.lower()[2:].rjust(64, '0') for address in recipients]]
+    return rpc.call('eth_getLogs', [{'fromBlock': hex(from_block),
+                                     'toBlock': hex(to_block),
+                                     'address': CONTRACT_ADDRESS,
+                                     'topics': topics}])
+
+
+def parse_transfer(log):
+    """
+    Turn a Transfer log into (tx_hash, log_index, block_number, to_address, amount).
+    """
+    return (log['transactionHash'],
+            int(log['logIndex'], 16),
+            int(log['blockNumber'], 16),
+            '0x' + log['topics'][2][-40:].lower(),
+            Decimal(int(log['data'], 16)) / DECIMALS)
+
+
+def get_receipt_transfers(tx_hashes, chunk_size=100):
+    """
+    Fetch the receipts of the transactions in batches and return the token's Transfer logs in them, parsed
+    like parse_transfer.
+    """
+    transfers = []
+    for start in range(0, len(tx_hashes), chunk_size):
+        receipts = rpc.batch([('eth_getTransactionReceipt', [tx_hash])
+                              for tx_hash in tx_hashes[start:start + chunk_size]])
+        for receipt in receipts:
+            for log in (receipt or {}).get('logs', []):
+                if (log['address'].lower() == CONTRACT_ADDRESS.lower() and len(log['topics']) == 3
+                        and log['topics'][0] == TRANSFER_TOPIC):
+                    transfers.append(parse_transfer(log))
+    return transfers
+
+
+def get_block_hash(block_number):
+    block = rpc.call('eth_getBlockByNumber', [hex(block_number), False])
+    return block['hash'] if block else None
+
+
+def check_reorg(cursor_block, cursor_hash):
+    """
+    If the block the cursor points at is no longer canonical, revert everything credited in the last
+    REORG_DEPTH blocks and move the cursor back so those blocks are indexed again.  Returns True on a reorg.
+    """
+    if cursor_hash is None or get_block_hash(cursor_block) == cursor_hash:
+        return False
+
+    rewind_to = max(cursor_block - REORG_DEPTH, (START_BLOCK or 0) - 1)
+    logger.error("Reorg detected at block {}, rewinding deposits to block {}".format(cursor_block, rewind_to))
+    ledger.revert_deposits(rewind_to, (CURSOR_NAME, rewind_to, None))
+    return True
+
+
+def index_once():
+    """
+    Index the next batch of confirmed blocks.  Returns the number of blocks processed.
+    """
+    cursor_block, cursor_hash = get_cursor()
+    if check_reorg(cursor_block, cursor_hash):
+        return 0
+
+    head = int(rpc.call('eth_blockNumber'), 16) - CONFIRMATIONS
+    from_block = cursor_block + 1
+    if from_block > head:
+        return 0
+    to_block = min(from_block + BATCH_SIZE - 1, head)
+
+    # credit_deposits resolves the receiving addresses and drops transfers to addresses no user owns
+    deposits = [parse_transfer(log) for log in get_transfer_logs(from_block, to_block) if not log.get('removed')]
+
+    credited = ledger.credit_deposits(deposits, (CURSOR_NAME, to_block, get_block_hash(to_block)))
+    if credited:
+        logger.info("Credited {} deposits in blocks {}-{}".format(len(credited), from_block, to_block))
+    return to_block - from_block + 1
+
+
+def run():
+    """
+    Index forever, sleeping only once caught up with the chain.
+    """
+    while True:
+        try:
+            processed = index_once()
+        except Exception as e:
+            logger.error("Error indexing deposits: {}".format(e))
+            processed = 0
+        if processed < BATCH_SIZE:
+            time.sleep(POLL_INTERVAL)
+
+
+if __name__ == '__main__':
+    run()
@@ -0,0 +1,103 @@
+import collections
+import configparser
+import eth_keyfile
+import json
+import threading
+import time
+
+config = configparser.ConfigParser()
+config.read('config.ini')
+
+MAX_CACHED_KEYS = config.getint('keys', 'max_cached', fallback=100)
+KEY_TTL = config.getint('keys', 'ttl', fallback=600)
+
+
+def zeroize(key):
+    """
+    Overwrite a key's bytes in place.
+    """
+    for i in range(len(key)):
+        key[i] = 0
+
+
+class KeyStore(object):
+    """
+    Decrypted private keys held in memory so the keyfile KDF runs once per key instead of once per task.
+
+    Keys are kept in bytearrays and zeroed when evicted.  Pinned keys (the master) stay until cleared, other
+    keys are dropped least recently used first beyond max_keys or ttl seconds after they were decrypted.
+    """
+    def __init__(self, max_keys, ttl):
+        self.max_keys = max_keys
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._keys = collections.OrderedDict()
+        self._pinned = {}
+        self._lock = threading.Lock()
+
+    def get(self, name, keyfile_path, pin=False):
+        """
+        Return the key for name, decrypting keyfile_path on a miss.
+        """
+        with self._lock:
+            key = self._pinned.get(name)
+            if key is None:
+                entry = self._keys.get(name)
+                if entry is not None and entry[1] >= time.monotonic():
+                    self._keys.move_to_end(name)
+                    key = entry[0]
+                elif entry is not None:
+                    self._evict(name)
+            if key is not None:
+                self.hits += 1
+                return bytes(key)
+
+            # Decrypt under the lock so two threads never pay the KDF for the same key
+            self.misses += 1
+            with open(keyfile_path, 'rb') as keyfile:
+                key = bytearray(eth_keyfile.decode_keyfile_json(json.load(keyfile), b''))
+            if pin:
+                self._pinned[name] = key
+            else:
+                self._keys[name] = (key, time.monotonic() + self.ttl)
+                while len(self._keys) > self.max_keys:
+                    self._evict(next(iter(self._keys)))
+            return bytes(key)
+
+    def _evict(self, name):
+        key, _ = self._keys.pop(name)
+        zeroize(key)
+
+    def evict(self, name):
+        with self._lock:
+            if name in self._keys:
+                self._evict(name)
+
+    def clear(self):
+        """
+        Zero and drop every key, including pinned ones.
+        """
+        with self._lock:
+            for name in list(self._keys):
+                self._evict(name)
+            for key in self._pinned.values():
+                zeroize(key)
+            self._pinned.clear()
+
+    def stats(self):
+        with self._lock:
+            return {'cached': len(self._keys), 'pinned': len(self._pinned), 'hits': self.hits,
+                    'misses': self.misses}
+
+
+KEYS = KeyStore(MAX_CACHED_KEYS, KEY_TTL)
+
+
+def write_keyfile(address, key):
+    """
+    Encrypt the private key into a keystore file named after its address.
+    """
+    keyfile_return = eth_keyfile.create_keyfile_json(key, b'')
+    with open('keyfiles/{}.json'.format(address), 'w') as local_keyfile:
+        json.dump(keyfile_return, local_keyfile)
@@ -0,0 +1,307 @@
+import modules.db as db
+import modules.util as util
+from decimal import Decimal
+
+
+def credit(user_id, amount, username=None, kind='credit', ref=None):
+    """
+    Add the amount to the user's balance, creating the user if they don't exist yet.
+    """
+    amount = Decimal(amount)
+    with db.transaction() as db_cursor:
+        db_cursor.execute("INSERT INTO users (user_id, username, balance) VALUES (%s, %s, %s) "
+                          "ON DUPLICATE KEY UPDATE balance = balance + VALUES(balance)",
+                          [user_id, username, amount])
+        _record(db_cursor, [(user_id, kind, amount, 0, ref)])
+    util.invalidate_snapshots([user_id, ])
+
+
+def debit(user_id, amount, kind='debit', ref=None):
+    """
+    Remove the amount from the user's balance.  Returns False without changing anything if the balance
+    doesn't cover it.
+    """
+    amount = Decimal(amount)
+    with db.transaction() as db_cursor:
+        rows = db_cursor.execute("UPDATE users SET balance = balance - %s WHERE user_id = %s AND balance >= %s",
+                                 [amount, user_id, amount])
+        if rows == 1:
+            _record(db_cursor, [(user_id, kind, -amount, 0, ref)])
+    util.invalidate_snapshots([user_id, ])
+    return rows == 1
+
+
+def adjust_pending(user_id, amount, kind='pending', ref=None):
+    """
+    Add the amount (negative to remove) to the user's pending withdraw.
+    """
+    amount = Decimal(amount)
+    with db.transaction() as db_cursor:
+        rows = db_cursor.execute("UPDATE users SET pending_withdraw = pending_withdraw + %s WHERE user_id = %s",
+                                 [amount, user_id])
+        if rows == 1:
+            _record(db_cursor, [(user_id, kind, 0, amount, ref)])
+    util.invalidate_snapshots([user_id, ])
+    return rows == 1
+
+
+def set_balance(user_id, balance=None, pending=None, kind='adjustment', ref=None):
+    """
+    Overwrite the user's balance and/or pending withdraw, recording the difference as a ledger entry.
+    """
+    with db.transaction() as db_cursor:
+        db_cursor.execute("SELECT balance, pending_withdraw FROM users WHERE user_id = %s FOR UPDATE", [user_id, ])
+        current = db_cursor.fetchone()
+        if current is None:
+            return False
+        balance = current[0] if balance is None else Decimal(balance)
+        pending = current[1] if pending is None else Decimal(pending)
+        db_cursor.execute("UPDATE users SET balance = %s, pending_withdraw = %s WHERE user_id = %s",
+                          [balance, pending, user_id])
+        _record(db_cursor, [(user_id, kind, balance - current[0], pending - current[1], ref)])
+    util.invalidate_snapshots([user_id, ])
+    return True
+
+
+def reserve_withdraw(user_id, debit_amount, pending_amount):
+    """
+    Take debit_amount (withdraw + fee) from the user's balance and add pending_amount to their pending
+    withdraw in one step.  Returns False if the balance doesn't cover debit_amount.
+    """
+    debit_amount = Decimal(debit_amount)
+    pending_amount = Decimal(pending_amount)
+    with db.transaction() as db_cursor:
+        rows = db_cursor.execute("UPDATE users SET balance = balance - %s, pending_withdraw = pending_withdraw + %s "
+                                 "WHERE user_id = %s AND balance >= %s",
+                                 [debit_amount, pending_amount, user_id, debit_amount])
+        if rows == 1:
+            entries = [(user_id, 'withdraw', -pending_amount, pending_amount, None)]
+            if debit_amount > pending_amount:
+                entries.append((user_id, 'fee', pending_amount - debit_amount, 0, None))
+            _record(db_cursor, entries)
+    util.invalidate_snapshots([user_id, ])
+    return rows == 1
+
+
+def transfer(sender_id, recipients, amount, kind='tip'):
+    """
+    Move amount from the sender to each (user_id, username) recipient in one transaction.  Recipients are
+    credited with a single multi-row upsert, creating users that don't exist yet.  Returns False without
+    changing anything if the sender can't cover amount * len(recipients).
+    """
+    amount = Decimal(amount)
+    # Sorted so concurrent transfers lock recipient rows in the same order
+    recipients = sorted((str(user_id), username) for user_id, username in recipients
+                        if str(user_id) != str(sender_id))
+    if not recipients:
+        return False
+    total = amount * len(recipients)
+
+    with db.transaction() as db_cursor:
+        rows = db_cursor.execute("UPDATE users SET balance = balance - %s WHERE user_id = %s AND balance >= %s",
+                                 [total, str(sender_id), total])
+        if rows != 1:
+            return False
+        db_cursor.executemany("INSERT INTO users (user_id, username, balance) VALUES (%s, %s, %s) "
+                              "ON DUPLICATE KEY UPDATE balance = balance + VALUES(balance)",
+                              [(user_id, username, amount) for user_id, username in recipients])
+        _record(db_cursor, [(str(sender_id), kind, -total, 0, None)] +
+                [(user_id, kind, amount, 0, str(sender_id)) for user_id, _ in recipients])
+    util.invalidate_snapshots([sender_id] + [user_id for user_id, _ in recipients])
+    return True
+
+
+def credit_deposits(deposits, cursor=None):
+    """
+    Credit a batch of on-chain deposits to the users owning the receiving addresses in one transaction.  Each
+    deposit is a (tx_hash, log_index, block_number, address, amount) tuple.  Addresses are resolved with a
+    single IN query and deposits to addresses no user owns are ignored.  Deposits already in the deposits
+    table are skipped, as are deposits at or below the owner's legacy_block_number, which the Etherscan poller
+    credited before deposits were recorded, so replaying any block range is safe.  If cursor is a
+    (name, block_number, block_hash) tuple, that indexer cursor is advanced in the same transaction.  Returns
+    the deposits that were new, as (tx_hash, log_index, block_number, user_id, address, amount) tuples.
+    """
+    new_deposits = []
+    with db.transaction() as db_cursor:
+        addresses = list({deposit[3].lower() for deposit in deposits})
+        if addresses:
+            db_cursor.execute("SELECT address, user_id, legacy_block_number FROM users "
+                              "WHERE address IN ({})".format(', '.join(['%s'] * len(addresses))), addresses)
+            owners = {address.lower(): (user_id, legacy_block) for address, user_id, legacy_block
+                      in db_cursor.fetchall()}
+            resolved = []
+            for tx_hash, log_index, block_number, address, amount in deposits:
+                user_id, legacy_block = owners.get(address.lower(), (None, None))
+                if user_id is not None and block_number > legacy_block and Decimal(amount) > 0:
+                    resolved.append((tx_hash, log_index, block_number, user_id, address.lower(), Decimal(amount)))
+            deposits = resolved
+
+        if deposits:
+            keys = [(tx_hash, log_index) for tx_hash, log_index, _, _, _, _ in deposits]
+            db_cursor.execute("SELECT tx_hash, log_index FROM deposits WHERE (tx_hash, log_index) IN ({}) "
+                              "FOR UPDATE".format(', '.join(['(%s, %s)'] * len(keys))),
+                              [value for key in keys for value in key])
+            seen = set(db_cursor.fetchall())
+            new_deposits = [deposit for deposit in deposits if (deposit[0], deposit[1]) not in seen]
+
+        if new_deposits:
+            db_cursor.executemany("INSERT INTO deposits (tx_hash, log_index, block_number, user_id, address, amount) "
+                                  "VALUES (%s, %s, %s, %s, %s, %s)", new_deposits)
+
+            totals = {}
+            for _, _, block_number, user_id, _, amount in new_deposits:
+                total, last_block = totals.get(user_id, (Decimal(0), 0))
+                totals[user_id] = (total + Decimal(amount), max(last_block, block_number))
+            db_cursor.executemany("INSERT INTO users (user_id, balance, block_number) VALUES (%s, %s, %s) "
+                                  "ON DUPLICATE KEY UPDATE balance = balance + VALUES(balance), "
+                                  "block_number = GREATEST(block_number, VALUES(block_number))",
+                                  [(user_id, total, last_block) for user_id, (total, last_block) in totals.items()])
+            _record(db_cursor, [(user_id, 'deposit', amount, 0, '{}:{}'.format(tx_hash, log_index))
+                                for tx_hash, log_index, _, user_id, _, amount in new_deposits])
+
+        if cursor is not None:
+            _set_cursor(db_cursor, *cursor)
+    util.invalidate_snapshots([deposit[3] for deposit in new_deposits])
+    return new_deposits
+
+
+def revert_deposits(after_block, cursor=None):
+    """
+    Undo every deposit credited above after_block, for when those blocks were reorganised away.
+    """
+    with db.transaction() as db_cursor:
+        db_cursor.execute("SELECT user_id, SUM(amount) FROM deposits WHERE block_number > %s "
+                          "GROUP BY user_id FOR UPDATE", [after_block, ])
+        totals = db_cursor.fetchall()
+        if totals:
+            db_cursor.executemany("UPDATE users SET balance = balance - %s WHERE user_id = %s",
+                                  [(total, user_id) for user_id, total in totals])
+            _record(db_cursor, [(user_id, 'reorg', -total, 0, 'block:{}'.format(after_block))
+                                for user_id, total in totals])
+            db_cursor.execute("DELETE FROM deposits WHERE block_number > %s", [after_block, ])
+            db_cursor.execute("UPDATE users SET block_number = %s WHERE block_number > %s",
+                              [after_block, after_block])
+        if cursor is not None:
+            _set_cursor(db_cursor, *cursor)
+    util.invalidate_snapshots([user_id for user_id, _ in totals])
+    return totals
+
+
+def _set_cursor(db_cursor, name, block_number, block_hash):
+    db_cursor.execute("INSERT INTO indexer_state (name, block_number, block_hash) VALUES (%s, %s, %s) "
+                      "ON DUPLICATE KEY UPDATE block_number = VALUES(block_number), "
+                      "block_hash = VALUES(block_hash)", [name, block_number, block_hash])
+
+
+def release_pending(payouts, ref=None, tx_hash=None):
+    """
+    Remove each confirmed (user_id, amount) payout from the users' pending withdraw in one transaction.  With
+    tx_hash, the tracked transaction being processed is marked confirmed in the same transaction and nothing is
+    released if it was already, so a retried follow-up can't release twice.  Returns whether it released.
+    """
+    with db.transaction() as db_cursor:
+        if tx_hash is not None:
+            claimed = db_cursor.execute("UPDATE pending_txs SET status = 'confirmed' "
+                                        "WHERE tx_hash = %s AND status = 'processing'", [tx_hash, ])
+            if claimed != 1:
+                return False
+        db_cursor.executemany("UPDATE users SET pending_withdraw = pending_withdraw - %s WHERE user_id = %s",
+                              [(Decimal(amount), user_id) for user_id, amount in payouts])
+        _record(db_cursor, [(user_id, 'withdrawn', 0, -Decimal(amount), ref) for user_id, amount in payouts])
+    util.invalidate_snapshots([user_id for user_id, _ in payouts])
+    return True
+
+
+def settle_batch(batch_id):
+    """
+    Mark a sent withdraw batch confirmed and release its withdrawals from the users' pending withdraw in one
+    transaction.  Does nothing for a batch already confirmed, so a retried follow-up can't release twice.
+    """
+    with db.transaction() as db_cursor:
+        claimed = db_cursor.execute("UPDATE withdrawals SET status = 'confirmed' "
+                                    "WHERE batch_id = %s AND status = 'sent'", [batch_id, ])
+        if not claimed:
+            return []
+        db_cursor.execute("SELECT user_id, amount FROM withdrawals WHERE batch_id = %s", [batch_id, ])
+        payouts = db_cursor.fetchall()
+        db_cursor.executemany("UPDATE users SET pending_withdraw = pending_withdraw - %s WHERE user_id = %s",
+                              [(amount, user_id) for user_id, amount in payouts])
+        _record(db_cursor, [(user_id, 'withdrawn', 0, -amount, 'batch:{}'.format(batch_id))
+                            for user_id, amount in payouts])
+    util.invalidate_snapshots([user_id for user_id, _ in payouts])
+    return payouts
+
+
+def _record(db_cursor, entries):
+    """
+    Append (user_id, kind, amount, pending, ref) entries to the ledger with one multi-row insert.  amount and
+    pending are the changes to the user's balance and pending withdraw.
+    """
+    if entries:
+        db_cursor.executemany("INSERT INTO ledger (user_id, kind, amount, pending, ref) VALUES (%s, %s, %s, %s, %s)",
+                              entries)
+
+
+def snapshot_balances(lag, keep):
+    """
+    Store every user's balance and pending withdraw as of the newest ledger entry older than lag seconds, built
+    from the previous snapshot plus the entries since, and drop all but the newest keep snapshots.  The lag
+    leaves time for transactions holding lower ledger IDs to commit.  Returns the ledger ID snapshotted up to.
+    """
+    with db.transaction() as db_cursor:
+        db_cursor.execute("SELECT COALESCE(MAX(ledger_id), 0) FROM ledger_snapshots")
+        last_id = db_cursor.fetchone()[0]
+        db_cursor.execute("SELECT COALESCE(MAX(id), %s) FROM ledger "
+                          "WHERE id > %s AND created_at < NOW() - INTERVAL %s SECOND", [last_id, last_id, lag])
+        snapshot_id = db_cursor.fetchone()[0]
+        if snapshot_id == last_id:
+            return last_id
+
+        db_cursor.execute("INSERT INTO ledger_snapshots (ledger_id, user_id, balance, pending_withdraw) "
+                          "SELECT %s, user_id, SUM(amount), SUM(pending) FROM ("
+                          "SELECT user_id, balance AS amount, pending_withdraw AS pending FROM ledger_snapshots "
+                          "WHERE ledger_id = %s "
+                          "UNION ALL SELECT user_id, amount, pending FROM ledger WHERE id > %s AND id <= %s"
+                          ") changes GROUP BY user_id", [snapshot_id, last_id, last_id, snapshot_id])
+        db_cursor.execute("SELECT DISTINCT ledger_id FROM ledger_snapshots ORDER BY ledger_id DESC LIMIT 1 OFFSET %s",
+                          [keep, ])
+        expired = db_cursor.fetchone()
+        if expired is not None:
+            db_cursor.execute("DELETE FROM ledger_snapshots WHERE ledger_id <= %s", [expired[0], ])
+    return snapshot_id
+
+
+def audit(from_snapshot=False):
+    """
+    Replay the ledger and return (user_id, expected_balance, expected_pending, balance, pending) for every user
+    whose row in the users table doesn't match it.  Both tables are streamed from one consistent read, so
+    the check is a single scan of each instead of a query per user.  With from_snapshot the replay starts
+    from the latest balance snapshot instead of the first entry.
+    """
+    expected = {}
+    mismatches = []
+    with db.read_snapshot() as db_conn:
+        start_id = 0
+        if from_snapshot:
+            for ledger_id, user_id, balance, pending in db.stream(
+                    db_conn, "SELECT ledger_id, user_id, balance, pending_withdraw FROM ledger_snapshots "
+                             "WHERE ledger_id = (SELECT MAX(ledger_id) FROM ledger_snapshots)", None):
+                start_id = ledger_id
+                expected[user_id] = (balance, pending)
+
+        for user_id, amount, pending in db.stream(
+                db_conn, "SELECT user_id, amount, pending FROM ledger WHERE id > %s", [start_id, ]):
+            balance_total, pending_total = expected.get(user_id, (Decimal(0), Decimal(0)))
+            expected[user_id] = (balance_total + amount, pending_total + pending)
+
+        for user_id, balance, pending in db.stream(
+                db_conn, "SELECT user_id, balance, pending_withdraw FROM users", None):
+            expected_balance, expected_pending = expected.pop(user_id, (Decimal(0), Decimal(0)))
+            if expected_balance != balance or expected_pending != pending:
+                mismatches.append((user_id, expected_balance, expected_pending, balance, pending))
+
+    # Ledger entries for users that no longer exist
+    for user_id, (expected_balance, expected_pending) in expected.items():
+        if expected_balance or expected_pending:
+            mismatches.append((user_id, expected_balance, expected_pending, None, None))
+    return mismatches
@@ -0,0 +1,85 @@
+import configparser
+import modules.rpc as rpc
+from web3 import Web3
+
+try:
+    # eth-abi 4 renamed decode_abi to decode
+    from eth_abi import decode
+except ImportError:
+    from eth_abi import decode_abi as decode
+
+config = configparser.ConfigParser()
+config.read('config.ini')
+
+CONTRACT_ADDRESS = config.get('main', 'contract')
+CHUNK_SIZE = config.getint('multicall', 'chunk_size', fallback=200)
+MULTICALL_ADDRESS = config.get('multicall', 'address', fallback=None)
+
+# First four bytes of keccak256 of each function signature
+BALANCE_OF = '0x70a08231'
+ALLOWANCE = '0xdd62ed3e'
+
+MULTICALL_ABI = [{"constant": False,
+                  "inputs": [{"components": [{"name": "target", "type": "address"},
+                                             {"name": "callData", "type": "bytes"}],
+                              "name": "calls", "type": "tuple[]"}],
+                  "name": "aggregate",
+                  "outputs": [{"name": "blockNumber", "type": "uint256"},
+                              {"name": "returnData", "type": "bytes[]"}],
+                  "payable": False, "stateMutability": "nonpayable", "type": "function"}]
+
+
+def encode_address(address):
+    return address.lower().replace('0x', '').rjust(64, '0')
+
+
+def to_int(result):
+    if result in (None, '0x', b''):
+        return 0
+    if isinstance(result, bytes):
+        return int.from_bytes(result, 'big')
+    return int(result, 16)
+
+
+def call_many(calls, block='latest'):
+    """
+    Run (to, data) calls and return the integer results in order.  With a Multicall contract configured each
+    chunk of CHUNK_SIZE calls is one aggregate eth_call, otherwise each call is its own eth_call; either way
+    every chunk goes to the node in a single JSON-RPC batch.
+    """
+    chunks = [calls[start:start + CHUNK_SIZE] for start in range(0, len(calls), CHUNK_SIZE)]
+    if not MULTICALL_ADDRESS:
+        results = []
+        for chunk in chunks:
+            results.extend(to_int(result) for result in rpc.batch([('eth_call', [{'to': to, 'data': data}, block])
+                                                                   for to, data in chunk]))
+        return results
+
+    multicall = Web3().eth.contract(abi=MULTICALL_ABI)
+    aggregate_calls = []
+    for chunk in chunks:
+        data = multicall.encodeABI(fn_name='aggregate',
+                                   args=[[(Web3.toChecksumAddress(to), Web3.toBytes(hexstr=data)) for to, data in chunk]])
+        aggregate_calls.append(('eth_call', [{'to': MULTICALL_ADDRESS, 'data': data}, block]))
+    results = []
+    for response in rpc.batch(aggregate_calls):
+        _, return_data = decode(['uint256', 'bytes[]'], Web3.toBytes(hexstr=response))
+        results.extend(to_int(result) for result in return_data)
+    return results
+
+
+def balances_of(addresses, token=CONTRACT_ADDRESS):
+    """
+    Return {address: token balance in base units} for every address.
+    """
+    balances = call_many([(token, BALANCE_OF + encode_address(address)) for address in addresses])
+    return dict(zip(addresses, balances))
+
+
+def allowances_of(addresses, spender, token=CONTRACT_ADDRESS):
+    """
+    Return {address: token allowance granted to spender in base units} for every address.
+    """
+    allowances = call_many([(token, ALLOWANCE + encode_address(address) + encode_address(spender))
+                            for address in addresses])
+    return dict(zip(addresses, allowances))
@@ -0,0 +1,148 @@
+import configparser
+import json
+import modules.rpc as rpc
+import modules.util as util
+import time
+
+config = configparser.ConfigParser()
+config.read('config.ini')
+
+STUCK_AFTER = config.getint('nonce', 'stuck_after', fallback=600)
+LOCK_TIMEOUT = config.getint('nonce', 'lock_timeout', fallback=10)
+
+
+class NonceManager(object):
+    """
+    Hands out nonces for one sending address from Redis, so any number of workers can sign transactions for
+    it at once.
+
+    Keys, all prefixed with nonce:<address>:
+      next      the next nonce never handed out
+      reserved  hash of nonce -> reservation time, until the transaction is broadcast
+      released  sorted set of nonces that were reserved but never broadcast, reused lowest first
+      inflight  hash of nonce -> JSON of the broadcast transaction, until it is confirmed
+    """
+    def __init__(self, address, w3):
+        self.address = w3.toChecksumAddress(address)
+        self.w3 = w3
+        self.redis = util.get_redis()
+        prefix = 'nonce:{}:'.format(self.address.lower())
+        self.next_key = prefix + 'next'
+        self.reserved_key = prefix + 'reserved'
+        self.released_key = prefix + 'released'
+        self.inflight_key = prefix + 'inflight'
+        self.lock_key = prefix + 'lock'
+
+    def lock(self):
+        return self.redis.lock(self.lock_key, timeout=LOCK_TIMEOUT, blocking_timeout=LOCK_TIMEOUT)
+
+    def reserve(self):
+        """
+        Reserve the next usable nonce.  Released gaps are filled before new nonces are handed out.
+        """
+        with self.lock():
+            released = self.redis.zrange(self.released_key, 0, 0)
+            if released:
+                self.redis.zrem(self.released_key, released[0])
+                nonce = int(released[0])
+            else:
+                if not self.redis.exists(self.next_key):
+                    self.redis.set(self.next_key, self.w3.eth.getTransactionCount(self.address, 'pending'))
+                nonce = self.redis.incr(self.next_key) - 1
+            self.redis.hset(self.reserved_key, str(nonce), time.time())
+            return nonce
+
+    def reserve_many(self, count):
+        """
+        Reserve count consecutive new nonces so a run of transactions can be broadcast in order.
+        """
+        with self.lock():
+            if not self.redis.exists(self.next_key):
+                self.redis.set(self.next_key, self.w3.eth.getTransactionCount(self.address, 'pending'))
+            first = self.redis.incrby(self.next_key, count) - count
+            now = time.time()
+            if count:
+                self.redis.hset(self.reserved_key, mapping={str(n): now for n in range(first, first + count)})
+            return list(range(first, first + count))
+
+    def release(self, nonce):
+        """
+        Give back a reserved nonce whose transaction was never broadcast.
+        """
+        self.redis.hdel(self.reserved_key, str(nonce))
+        self.redis.zadd(self.released_key, {str(nonce): nonce})
+
+    def record(self, nonce, tx_hash, tx):
+        """
+        Remember a broadcast transaction so it can be replaced if it gets stuck.
+        """
+        self.redis.hset(self.inflight_key, str(nonce), json.dumps({'hash': tx_hash,
+                                                                   'tx': tx,
+                                                                   'sent_at': time.time()}))
+        self.redis.hdel(self.reserved_key, str(nonce))
+
+    def confirm(self, nonce):
+        self.redis.hdel(self.inflight_key, str(nonce))
+
+    def inflight(self):
+        """
+        Return {nonce: record} for every broadcast transaction not yet confirmed.
+        """
+        return {int(nonce): json.loads(record) for nonce, record in self.redis.hgetall(self.inflight_key).items()}
+
+    def resync(self):
+        """
+        Reconcile with the chain: drop records for mined nonces and never hand out a nonce below the node's
+        pending count.  Returns the mined transaction count.
+        """
+        with self.lock():
+            mined, pending = [int(count, 16) for count in rpc.batch([
+                ('eth_getTransactionCount', [self.address, 'latest']),
+                ('eth_getTransactionCount', [self.address, 'pending']),
+            ])]
+            for nonce in self.inflight():
+                if nonce < mined:
+                    self.confirm(nonce)
+            for nonce in self.redis.hkeys(self.reserved_key):
+                if int(nonce) < mined:
+                    self.redis.hdel(self.reserved_key, nonce)
+            self.redis.zremrangebyscore(self.released_key, '-inf', mined - 1)
+            next_nonce = self.redis.get(self.next_key)
+            if next_nonce is None or int(next_nonce) < pending:
+                self.redis.set(self.next_key, pending)
+        return mined
+
+    def gaps(self, mined, age=STUCK_AFTER):
+        """
+        Return nonces between the mined count and the next nonce that nothing has been broadcast for: released
+        nonces, nonces that were never tracked, and ones whose reserving worker died more than age seconds
+        ago.  Any one of these blocks every later transaction from the address.
+        """
+        now = time.time()
+        next_nonce = int(self.redis.get(self.next_key) or mined)
+        inflight = self.inflight()
+        reserved = {int(nonce): float(at) for nonce, at in self.redis.hgetall(self.reserved_key).items()}
+        return [nonce for nonce in range(mined, next_nonce)
+                if nonce not in inflight and now - reserved.get(nonce, 0) > age]
+
+    def claim(self, nonce, age=STUCK_AFTER):
+        """
+        Reserve a specific gap nonce so it can be filled.  Returns False if another worker now owns it.
+        """
+        with self.lock():
+            if self.redis.hexists(self.inflight_key, str(nonce)):
+                return False
+            reserved_at = self.redis.hget(self.reserved_key, str(nonce))
+            if reserved_at is not None and time.time() - float(reserved_at) <= age:
+                return False
+            self.redis.zrem(self.released_key, str(nonce))
+            self.redis.hset(self.reserved_key, str(nonce), time.time())
+            return True
+
+    def stuck(self, mined, age=STUCK_AFTER):
+        """
+        Return {nonce: record} for transactions that have waited longer than age seconds without being mined.
+        """
+        now = time.time()
+        return {nonce: record for nonce, record in self.inflight().items()
+                if nonce >= mined and now - record['sent_at'] > age}
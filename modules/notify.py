@@ -0,0 +1,155 @@
+import asyncio
+import bisect
+import collections
+import configparser
+import time
+import modules.util as util
+
+config = configparser.ConfigParser()
+config.read('config.ini')
+
+GLOBAL_RATE = float(config.get('notify', 'global_rate', fallback='40'))
+DM_RATE = float(config.get('notify', 'dm_rate', fallback='1'))
+DM_BURST = config.getint('notify', 'dm_burst', fallback=5)
+REACTION_RATE = float(config.get('notify', 'reaction_rate', fallback='4'))
+WORKERS = config.getint('notify', 'workers', fallback=8)
+MAX_ROUTES = config.getint('notify', 'max_routes', fallback=10000)
+MAX_MESSAGE = 2000
+LATENCY_BUCKETS = (0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+logger = util.get_logger('notify')
+
+
+class Bucket(object):
+    """
+    Token bucket holding up to capacity sends, refilled at rate per second.
+    """
+    def __init__(self, capacity, rate):
+        self.capacity = capacity
+        self.rate = rate
+        self.tokens = capacity
+        self.updated = time.monotonic()
+        self.lock = asyncio.Lock()
+
+    async def acquire(self):
+        # The lock keeps waiters in order, so one busy route can't starve on its own bucket
+        async with self.lock:
+            while True:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                await asyncio.sleep((1 - self.tokens) / self.rate)
+
+
+class Dispatcher(object):
+    """
+    Background sender for DMs and reactions.  Every send waits on a global bucket and on a bucket for its
+    route (one per DM channel, one per channel for reactions), so work on different routes runs concurrently
+    across the worker tasks while each route stays inside Discord's limits.  DMs to a user that is already
+    queued are merged into the queued message instead of being sent separately.
+    """
+    def __init__(self, workers, global_rate):
+        self.workers = workers
+        self.global_bucket = Bucket(global_rate, global_rate)
+        self.routes = collections.OrderedDict()
+        self.pending_dms = {}
+        self.queue = None
+        self.tasks = []
+        self.metrics = collections.Counter()
+        self.latency = [0] * (len(LATENCY_BUCKETS) + 1)
+
+    def start(self, bot):
+        if not self.tasks:
+            self.queue = asyncio.Queue()
+            self.tasks = [bot.loop.create_task(self.run(bot)) for _ in range(self.workers)]
+
+    def route(self, name, capacity, rate):
+        bucket = self.routes.get(name)
+        if bucket is None:
+            bucket = self.routes[name] = Bucket(capacity, rate)
+            if len(self.routes) > MAX_ROUTES:
+                self.routes.popitem(last=False)
+        else:
+            self.routes.move_to_end(name)
+        return bucket
+
+    def dm(self, user_id, content):
+        """
+        Queue a DM to the user, merging it into a DM already waiting for them.
+        """
+        user_id = int(user_id)
+        if user_id in self.pending_dms:
+            self.pending_dms[user_id].append(content)
+            self.metrics['aggregated'] += 1
+            return
+        self.pending_dms[user_id] = [content]
+        self.queue.put_nowait(('dm', user_id, time.monotonic()))
+
+    def react(self, message, *emojis):
+        """
+        Queue reactions to a message.  They are added in the order given.
+        """
+        self.queue.put_nowait(('react', (message, emojis), time.monotonic()))
+
+    async def send_dm(self, bot, user_id):
+        contents = self.pending_dms.pop(user_id)
+        user = bot.get_user(user_id) or await bot.fetch_user(user_id)
+        bucket = self.route('dm:{}'.format(user_id), DM_BURST, DM_RATE)
+        for chunk in chunk_messages(contents):
+            await self.global_bucket.acquire()
+            await bucket.acquire()
+            await user.send(chunk)
+            self.metrics['dms'] += 1
+
+    async def send_reactions(self, message, emojis):
+        bucket = self.route('react:{}'.format(message.channel.id), 1, REACTION_RATE)
+        for emoji in emojis:
+            await self.global_bucket.acquire()
+            await bucket.acquire()
+            await message.add_reaction(emoji)
+            self.metrics['reactions'] += 1
+
+    async def run(self, bot):
+        while True:
+            kind, target, queued_at = await self.queue.get()
+            try:
+                if kind == 'dm':
+                    await self.send_dm(bot, target)
+                else:
+                    await self.send_reactions(*target)
+            except Exception as e:
+                self.metrics['errors'] += 1
+                logger.error("Error sending {} to {}: {}".format(kind, target, e))
+            finally:
+                self.latency[bisect.bisect_left(LATENCY_BUCKETS, time.monotonic() - queued_at)] += 1
+                self.queue.task_done()
+
+    def stats(self):
+        """
+        Return queue depth, send counters and a histogram of seconds from queueing to sent.  Each latency
+        bucket counts sends at or under the matching LATENCY_BUCKETS bound, the last one everything slower.
+        """
+        stats = dict(self.metrics)
+        stats['queue_depth'] = self.queue.qsize() if self.queue else 0
+        stats['latency'] = list(self.latency)
+        return stats
+
+
+def chunk_messages(contents):
+    """
+    Join queued messages with newlines into as few messages as fit Discord's length limit.
+    """
+    chunk = ''
+    for content in contents:
+        if chunk and len(chunk) + len(content) + 1 > MAX_MESSAGE:
+            yield chunk
+            chunk = ''
+        chunk = "{}\n{}".format(chunk, content) if chunk else content
+    if chunk:
+        yield chunk
+
+
+NOTIFIER = Dispatcher(WORKERS, GLOBAL_RATE)
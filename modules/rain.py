@@ -0,0 +1,60 @@
+import collections
+import configparser
+from decimal import Decimal, ROUND_DOWN
+import time
+
+config = configparser.ConfigParser()
+config.read('config.ini')
+
+ACTIVE_WINDOW = config.getint('rain', 'active_window', fallback=900)
+MAX_TRACKED = config.getint('rain', 'max_tracked', fallback=10000)
+DECIMALS = int(config.get('main', 'decimals'))
+
+
+class ActivityTracker(object):
+    """
+    Who has spoken in each guild recently, most recent last, for !rain active.  Bounded to max_users per guild.
+    """
+    def __init__(self, window, max_users):
+        self.window = window
+        self.max_users = max_users
+        self.guilds = collections.defaultdict(collections.OrderedDict)
+
+    def seen(self, guild_id, user):
+        users = self.guilds[guild_id]
+        users[user.id] = (time.monotonic(), user.name)
+        users.move_to_end(user.id)
+        if len(users) > self.max_users:
+            users.popitem(last=False)
+
+    def active(self, guild_id):
+        """
+        Return (user_id, username) for everyone seen in the guild within the window.
+        """
+        cutoff = time.monotonic() - self.window
+        active = []
+        for user_id, (last_seen, username) in reversed(self.guilds.get(guild_id, {}).items()):
+            if last_seen < cutoff:
+                break
+            active.append((user_id, username))
+        return active
+
+
+ACTIVITY = ActivityTracker(ACTIVE_WINDOW, MAX_TRACKED)
+
+
+async def role_recipients(role):
+    """
+    Return (user_id, username) for every non-bot member of the role.  role.members only sees cached members, so
+    the guild's member list is fetched first if it hasn't been yet.
+    """
+    if not role.guild.chunked:
+        await role.guild.chunk()
+    return [(member.id, member.name) for member in role.members if not member.bot]
+
+
+def split_amount(total, count):
+    """
+    Split total evenly between count users, rounded down to the token's precision.
+    """
+    return (Decimal(total) / count).quantize(Decimal(10) ** -DECIMALS, rounding=ROUND_DOWN)
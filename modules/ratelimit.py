@@ -0,0 +1,68 @@
+import configparser
+import modules.util as util
+import time
+
+config = configparser.ConfigParser()
+config.read('config.ini')
+
+# Each bucket holds up to capacity tokens and refills at rate tokens per second
+USER_CAPACITY = config.getint('ratelimit', 'user_capacity', fallback=5)
+USER_RATE = float(config.get('ratelimit', 'user_rate', fallback='0.5'))
+GUILD_CAPACITY = config.getint('ratelimit', 'guild_capacity', fallback=60)
+GUILD_RATE = float(config.get('ratelimit', 'guild_rate', fallback='5'))
+BALANCE_CAPACITY = config.getint('ratelimit', 'balance_capacity', fallback=2)
+BALANCE_RATE = float(config.get('ratelimit', 'balance_rate', fallback='0.05'))
+
+# Refill the bucket for the time since it was last touched, then take cost tokens if there are enough.
+# Runs atomically in Redis so every shard shares the same buckets.  Returns {allowed, seconds until allowed}.
+TOKEN_BUCKET = """
+local capacity = tonumber(ARGV[1])
+local rate = tonumber(ARGV[2])
+local now = tonumber(ARGV[3])
+local cost = tonumber(ARGV[4])
+local bucket = redis.call('HMGET', KEYS[1], 'tokens', 'updated')
+local tokens = tonumber(bucket[1]) or capacity
+local updated = tonumber(bucket[2]) or now
+tokens = math.min(capacity, tokens + math.max(0, now - updated) * rate)
+local allowed = 0
+local retry_after = 0
+if tokens >= cost then
+    tokens = tokens - cost
+    allowed = 1
+else
+    retry_after = (cost - tokens) / rate
+end
+redis.call('HSET', KEYS[1], 'tokens', tokens, 'updated', now)
+redis.call('EXPIRE', KEYS[1], math.ceil(capacity / rate) + 1)
+return {allowed, tostring(retry_after)}
+"""
+
+_script = None
+
+
+def take(key, capacity, rate, cost=1):
+    """
+    Take cost tokens from the named bucket.  Returns (allowed, seconds until the bucket could allow it).
+    """
+    global _script
+    if _script is None:
+        _script = util.get_redis().register_script(TOKEN_BUCKET)
+    allowed, retry_after = _script(keys=['ratelimit:{}'.format(key)], args=[capacity, rate, time.time(), cost])
+    return allowed == 1, float(retry_after)
+
+
+def check_command(user_id, guild_id, command_name):
+    """
+    Apply the per-user, per-guild and per-command buckets for one command.  Returns (allowed, retry_after).
+    """
+    buckets = [('user:{}'.format(user_id), USER_CAPACITY, USER_RATE)]
+    if guild_id is not None:
+        buckets.append(('guild:{}'.format(guild_id), GUILD_CAPACITY, GUILD_RATE))
+    if command_name == 'balance':
+        buckets.append(('balance:{}'.format(user_id), BALANCE_CAPACITY, BALANCE_RATE))
+
+    for key, capacity, rate in buckets:
+        allowed, retry_after = take(key, capacity, rate)
+        if not allowed:
+            return False, retry_after
+    return True, 0
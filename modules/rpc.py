@@ -0,0 +1,124 @@
+import bisect
+import collections
+import configparser
+import itertools
+import os
+import requests
+import threading
+import time
+
+config = configparser.ConfigParser()
+config.read('config.ini')
+ENV = config.get('main', 'env')
+
+INFURA = config.get('main', 'infura')
+INFURA_ROUTE = config.get(ENV, 'infura_route')
+RPC_URL = config.get('main', 'rpc_url', fallback="{}{}".format(INFURA_ROUTE, INFURA))
+RPC_TIMEOUT = config.getint('main', 'rpc_timeout', fallback=30)
+
+# Upper bounds in seconds of the latency histogram buckets, anything slower lands in the last (+inf) bucket
+LATENCY_BUCKETS = (0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+
+class RPCError(Exception):
+    """
+    Raised when the node returns a JSON-RPC error object.
+    """
+    def __init__(self, method, error):
+        self.method = method
+        self.code = error.get('code')
+        self.message = error.get('message')
+        super(RPCError, self).__init__("{} failed: {} {}".format(method, self.code, self.message))
+
+
+_session = None
+_session_pid = None
+_ids = itertools.count(1)
+_latency_lock = threading.Lock()
+_latency = collections.defaultdict(lambda: {'count': 0, 'total': 0.0,
+                                             'buckets': [0] * (len(LATENCY_BUCKETS) + 1)})
+
+
+def get_session():
+    """
+    Return this process' keep-alive HTTP session to the node.  A forked worker gets its own.
+    """
+    global _session, _session_pid
+    if _session is None or _session_pid != os.getpid():
+        _session = requests.Session()
+        _session.headers.update({'Content-Type': 'application/json'})
+        _session_pid = os.getpid()
+    return _session
+
+
+def record_latency(method, seconds):
+    """
+    Add one request's latency to the method's histogram.
+    """
+    with _latency_lock:
+        histogram = _latency[method]
+        histogram['count'] += 1
+        histogram['total'] += seconds
+        histogram['buckets'][bisect.bisect_left(LATENCY_BUCKETS, seconds)] += 1
+
+
+def latency_stats():
+    """
+    Return {method: {'count', 'total', 'buckets'}} for every JSON-RPC method this process has called.  Each
+    bucket counts requests at or under the matching LATENCY_BUCKETS bound, the last one everything slower.
+    """
+    with _latency_lock:
+        return {method: {'count': histogram['count'],
+                         'total': histogram['total'],
+                         'buckets': list(histogram['buckets'])}
+                for method, histogram in _latency.items()}
+
+
+def latency_middleware(make_request, w3):
+    """
+    web3 middleware recording the latency of every request made through a Web3 client.
+    """
+    def middleware(method, params):
+        start = time.monotonic()
+        try:
+            return make_request(method, params)
+        finally:
+            record_latency(method, time.monotonic() - start)
+    return middleware
+
+
+def call(method, params=None):
+    """
+    Make a single JSON-RPC call and return its result.
+    """
+    return batch([(method, params)])[0]
+
+
+def batch(calls):
+    """
+    Send a list of (method, params) calls as one JSON-RPC batch and return their results in order.
+    """
+    if not calls:
+        return []
+    payload = [{'jsonrpc': '2.0', 'id': next(_ids), 'method': method, 'params': params or []}
+               for method, params in calls]
+    start = time.monotonic()
+    r = get_session().post(RPC_URL, json=payload if len(payload) > 1 else payload[0], timeout=RPC_TIMEOUT)
+    r.raise_for_status()
+    responses = r.json()
+    elapsed = time.monotonic() - start
+    for method in set(method for method, _ in calls):
+        record_latency(method if len(payload) == 1 else 'batch:' + method, elapsed)
+    if isinstance(responses, dict):
+        responses = [responses]
+
+    by_id = {response.get('id'): response for response in responses}
+    results = []
+    for request in payload:
+        response = by_id.get(request['id'])
+        if response is None:
+            raise RPCError(request['method'], {'message': 'no response in batch'})
+        if 'error' in response:
+            raise RPCError(request['method'], response['error'])
+        results.append(response.get('result'))
+    return results
@@ -0,0 +1,84 @@
+import asyncio
+import collections
+import configparser
+import modules.db as db
+import modules.notify as notify
+import modules.rpc as rpc
+import modules.util as util
+import requests
+import time
+
+config = configparser.ConfigParser()
+config.read('config.ini')
+
+STATS_INTERVAL = config.getint('shard', 'stats_interval', fallback=60)
+STATS_TTL = STATS_INTERVAL * 5
+GATEWAY_URL = 'https://discord.com/api/v9/gateway/bot'
+
+logger = util.get_logger('shards')
+
+
+def parse_shard_ids(spec):
+    """
+    Turn a shard spec like "0-3,6" into [0, 1, 2, 3, 6].  An empty spec returns None.
+    """
+    shard_ids = []
+    for part in spec.replace(' ', '').split(','):
+        if not part:
+            continue
+        if '-' in part:
+            first, last = part.split('-')
+            shard_ids.extend(range(int(first), int(last) + 1))
+        else:
+            shard_ids.append(int(part))
+    return sorted(set(shard_ids)) or None
+
+
+def recommended_shard_count(bot_token):
+    """
+    Ask Discord how many shards the bot should run with.
+    """
+    response = requests.get(GATEWAY_URL, headers={'Authorization': 'Bot {}'.format(bot_token)}, timeout=10)
+    response.raise_for_status()
+    return response.json()['shards']
+
+
+class ShardStats(object):
+    """
+    Per-shard command throughput, reported with gateway latency every STATS_INTERVAL seconds to the log and to
+    a shard:<id> Redis hash, so every process' shards can be watched from one place.  The process' notification,
+    notify cache, JSON-RPC latency and DB pool metrics are logged with them.
+    """
+    def __init__(self):
+        self.commands = collections.Counter()
+        self.last_report = time.monotonic()
+
+    def command(self, shard_id):
+        self.commands[shard_id or 0] += 1
+
+    def report(self, bot):
+        now = time.monotonic()
+        elapsed = max(now - self.last_report, 1)
+        guilds = collections.Counter(guild.shard_id for guild in bot.guilds)
+        redis = util.get_redis()
+        for shard_id, latency in bot.latencies:
+            stats = {'latency_ms': round(latency * 1000, 1),
+                     'commands_per_min': round(self.commands[shard_id] * 60 / elapsed, 2),
+                     'guilds': guilds[shard_id]}
+            logger.info("Shard {}: {}".format(shard_id, stats))
+            redis.hset('shard:{}'.format(shard_id), mapping=stats)
+            redis.expire('shard:{}'.format(shard_id), STATS_TTL)
+        logger.info("Notifications: {}".format(notify.NOTIFIER.stats()))
+        logger.info("Notify cache: {}".format(util.NOTIFY_CACHE.stats()))
+        logger.info("RPC latency: {}".format(rpc.latency_stats()))
+        logger.info("DB pool: {}".format(db.pool_stats()))
+        self.commands.clear()
+        self.last_report = now
+
+    async def report_forever(self, bot):
+        while True:
+            await asyncio.sleep(STATS_INTERVAL)
+            try:
+                self.report(bot)
+            except Exception as e:
+                logger.error("Error reporting shard stats: {}".format(e))
@@ -1,13 +1,76 @@
 import modules.db as db
+import collections
 import discord
 import logging
 import logging.handlers
 import configparser
+from decimal import Decimal
+import redis
+import threading
+import time
 
 config = configparser.ConfigParser()
 config.read('config.ini')
 
 TOKEN = config.get('main', 'token')
+NOTIFY_CACHE_SIZE = config.getint('cache', 'notify_size', fallback=100000)
+NOTIFY_CACHE_TTL = config.getint('cache', 'notify_ttl', fallback=3600)
+REDIS_URL = config.get('redis', 'url', fallback='redis://localhost')
+SNAPSHOT_TTL = config.getint('cache', 'snapshot_ttl', fallback=300)
+
+# Only store a snapshot loaded from the DB if nothing invalidated the user since the load started
+SNAPSHOT_FILL = """
+if (redis.call('GET', KEYS[2]) or '0') ~= ARGV[1] then
+    return 0
+end
+redis.call('HSET', KEYS[1], 'address', ARGV[2], 'balance', ARGV[3], 'pending', ARGV[4], 'notify', ARGV[5])
+redis.call('EXPIRE', KEYS[1], ARGV[6])
+return 1
+"""
+
+
+class TTLCache(object):
+    """
+    Bounded, thread-safe LRU cache whose entries expire ttl seconds after they were set.
+    """
+    def __init__(self, maxsize, ttl):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._data = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is None or entry[1] < time.monotonic():
+                if entry is not None:
+                    del self._data[key]
+                self.misses += 1
+                return default
+            self._data.move_to_end(key)
+            self.hits += 1
+            return entry[0]
+
+    def set(self, key, value):
+        with self._lock:
+            self._data[key] = (value, time.monotonic() + self.ttl)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def invalidate(self, key):
+        with self._lock:
+            self._data.pop(key, None)
+
+    def stats(self):
+        with self._lock:
+            return {'size': len(self._data), 'maxsize': self.maxsize, 'hits': self.hits, 'misses': self.misses}
+
+
+# User IDs that have accepted the liability waiver.  Only positive answers are cached.
+NOTIFY_CACHE = TTLCache(NOTIFY_CACHE_SIZE, NOTIFY_CACHE_TTL)
 
 
 def get_logger(name, log_file='debug.log'):
@@ -29,6 +92,69 @@ def get_logger(name, log_file='debug.log'):
     return logger
 
 
+logger = get_logger('util')
+_redis = None
+
+
+def get_redis():
+    """
+    Return this process' Redis client, shared by the bot and the workers for cross-process state.
+    """
+    global _redis
+    if _redis is None:
+        _redis = redis.Redis.from_url(REDIS_URL, decode_responses=True)
+    return _redis
+
+
+_snapshot_script = None
+
+
+def get_snapshot(user_id):
+    """
+    Return the user's {'address', 'balance', 'pending', 'notify'} snapshot from Redis, loading it from the DB
+    on a miss.  Returns None if the user doesn't exist.
+    """
+    global _snapshot_script
+    user_key = 'user:{}'.format(user_id)
+    redis_client = get_redis()
+    cached = redis_client.hgetall(user_key)
+    if cached:
+        return {'address': cached['address'] or None,
+                'balance': Decimal(cached['balance']),
+                'pending': Decimal(cached['pending']),
+                'notify': cached['notify'] == '1'}
+
+    generation = redis_client.get('{}:gen'.format(user_key)) or '0'
+    snapshot_return = db.get_db_data("SELECT address, balance, pending_withdraw, notify FROM users "
+                                     "WHERE user_id = %s", [str(user_id), ])
+    if snapshot_return == ():
+        return None
+    address, balance, pending, notify = snapshot_return[0]
+    if _snapshot_script is None:
+        _snapshot_script = redis_client.register_script(SNAPSHOT_FILL)
+    _snapshot_script(keys=[user_key, '{}:gen'.format(user_key)],
+                     args=[generation, address or '', balance, pending, int(notify or 0), SNAPSHOT_TTL])
+    return {'address': address, 'balance': Decimal(balance), 'pending': Decimal(pending), 'notify': bool(notify)}
+
+
+def invalidate_snapshots(user_ids):
+    """
+    Drop the users' cached snapshots after a write to their rows.  Bumping the generation stops a load that
+    read the old row from caching it afterwards.  Callers have already committed the write, so a Redis error is
+    logged rather than raised; the stale snapshots expire after SNAPSHOT_TTL.
+    """
+    user_ids = set(str(user_id) for user_id in user_ids)
+    try:
+        pipeline = get_redis().pipeline(transaction=False)
+        for user_id in user_ids:
+            pipeline.delete('user:{}'.format(user_id))
+            pipeline.incr('user:{}:gen'.format(user_id))
+            pipeline.expire('user:{}:gen'.format(user_id), SNAPSHOT_TTL * 2)
+        pipeline.execute()
+    except redis.RedisError as e:
+        logger.error("Error invalidating snapshots for {}: {}".format(sorted(user_ids), e))
+
+
 def get_aliases(dict, exclude=''):
     """
     Returns list of command triggers excluding `exclude`
@@ -66,16 +192,29 @@ async def is_notified(user_id):
     """
     Checks to see if the user was notified of liability waiver.
     """
+    if NOTIFY_CACHE.get(str(user_id)):
+        return True
+
     check_user_sql = "SELECT notify FROM users WHERE user_id = %s"
     check_user_values = [user_id, ]
-    check_user_return = db.get_db_data(check_user_sql, check_user_values)
+    check_user_return = await db.get_db_data_async(check_user_sql, check_user_values)
 
     if check_user_return == () or check_user_return[0][0] == 0 or check_user_return[0][0] is None:
         return False
 
+    NOTIFY_CACHE.set(str(user_id), True)
     return True
 
 
+async def warm_notify_cache():
+    """
+    Load notified users into the cache with one query so the first message from each doesn't hit the DB.
+    """
+    notified_sql = "SELECT user_id FROM users WHERE notify = 1 LIMIT %s"
+    notified_return = await db.get_db_data_async(notified_sql, [NOTIFY_CACHE_SIZE, ])
+    for row in notified_return:
+        NOTIFY_CACHE.set(row[0], True)
+    return len(notified_return)
 
 
 async def mark_notified(user_id, user_name):
@@ -83,7 +222,9 @@ async def mark_notified(user_id, user_name):
     Update DB to mark the user as notified of liability waiver.
     """
     insert_user_sql = ("INSERT INTO users (user_id, username, balance, notify) "
-                       "VALUES (%s, %s, '0', 1) "
+                       "VALUES (%s, %s, 0, 1) "
                        "ON DUPLICATE KEY UPDATE notify = 1")
     insert_user_values = [user_id, user_name]
-    db.set_db_data(insert_user_sql, insert_user_values)
\ No newline at end of file
+    await db.set_db_data_async(insert_user_sql, insert_user_values)
+    NOTIFY_CACHE.invalidate(str(user_id))
+    await db.run_async(invalidate_snapshots, [user_id, ])
\ No newline at end of file
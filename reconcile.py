@@ -0,0 +1,90 @@
+import argparse
+import configparser
+import csv
+from decimal import Decimal
+import modules.db as db
+import modules.ledger as ledger
+import modules.multicall as multicall
+import sys
+
+config = configparser.ConfigParser()
+config.read('config.ini')
+
+MASTER = config.get('main', 'master')
+TOKEN = config.get('main', 'token')
+DECIMALS = Decimal(10**18)
+
+
+def load_users():
+    """
+    Return (user_id, address, balance, pending) for every user with a deposit address.
+    """
+    return db.get_db_data("SELECT user_id, address, balance, pending_withdraw FROM users WHERE address LIKE '0x%'",
+                          None)
+
+
+def reconcile():
+    """
+    Read every deposit address' token balance and allowance to the master in bulk and compare the tokens the
+    bot holds against what the users table says it owes.  Returns (rows, totals).
+    """
+    users = load_users()
+    addresses = [address for _, address, _, _ in users]
+    balances = multicall.balances_of(addresses + [MASTER])
+    allowances = multicall.allowances_of(addresses, MASTER)
+
+    rows = []
+    for user_id, address, balance, pending in users:
+        rows.append({'user_id': user_id,
+                     'address': address,
+                     'db_balance': balance,
+                     'db_pending': pending,
+                     'onchain_balance': Decimal(balances[address]) / DECIMALS,
+                     'allowance': Decimal(allowances[address]) / DECIMALS,
+                     'unsweepable': balances[address] > allowances[address]})
+
+    liabilities = sum((row['db_balance'] + row['db_pending'] for row in rows), Decimal(0))
+    liabilities += sum((Decimal(row[0]) for row in db.get_db_data(
+        "SELECT balance + pending_withdraw FROM users WHERE address IS NULL OR address NOT LIKE '0x%'", None)),
+        Decimal(0))
+    assets = Decimal(balances[MASTER]) / DECIMALS + sum((row['onchain_balance'] for row in rows), Decimal(0))
+    totals = {'liabilities': liabilities, 'assets': assets, 'difference': assets - liabilities}
+    return rows, totals
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Compare on-chain {} holdings with the users table.'.format(TOKEN))
+    parser.add_argument('--csv', metavar='FILE', help='write the per-address report to FILE')
+    parser.add_argument('--ledger', action='store_true',
+                        help='also check every balance in the users table against a replay of the ledger')
+    parser.add_argument('--from-snapshot', action='store_true',
+                        help='start the ledger replay from the latest balance snapshot')
+    args = parser.parse_args(argv)
+
+    mismatches = []
+    if args.ledger:
+        mismatches = ledger.audit(from_snapshot=args.from_snapshot)
+        for user_id, expected_balance, expected_pending, balance, pending in mismatches:
+            print("User {} has {} {} ({} pending) but the ledger says {} ({} pending)".format(
+                user_id, balance, TOKEN, pending, expected_balance, expected_pending))
+        print("Ledger mismatches: {}".format(len(mismatches)))
+
+    rows, totals = reconcile()
+    if args.csv:
+        with open(args.csv, 'w', newline='') as report:
+            writer = csv.DictWriter(report, fieldnames=list(rows[0]) if rows else ['user_id'])
+            writer.writeheader()
+            writer.writerows(rows)
+
+    for row in rows:
+        if row['unsweepable']:
+            print("{address} (user {user_id}) holds {onchain_balance} {0} but only allows the master "
+                  "{allowance}".format(TOKEN, **row))
+    print("Owed to users: {} {}".format(totals['liabilities'], TOKEN))
+    print("Held on-chain: {} {}".format(totals['assets'], TOKEN))
+    print("Difference:    {} {}".format(totals['difference'], TOKEN))
+    return 0 if totals['difference'] >= 0 and not mismatches else 1
+
+
+if __name__ == '__main__':
+    sys.exit(main())
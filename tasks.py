@@ -1,11 +1,18 @@
 from celery import Celery
+from celery.signals import worker_process_init, worker_process_shutdown
+import collections
 import configparser
 import modules.db as db
+import modules.keys as keys
+import modules.gas as gas
+import modules.ledger as ledger
+import modules.multicall as multicall
+import modules.nonce as nonce
+import modules.rpc as rpc
 from decimal import Decimal
 import discord
-import eth_keyfile
-from time import sleep
 import json
+import uuid
 import modules.util as util
 from web3 import Web3, HTTPProvider
 
@@ -22,8 +29,59 @@ INFURA = config.get('main', 'infura')
 INFURA_ROUTE = config.get(ENV, 'infura_route')
 BOT_TOKEN = config.get('main', 'bot_token')
 CHAIN_ID = config.get(ENV, 'chain_id')
+NONCE_MAINTAIN_INTERVAL = config.getint('nonce', 'maintain_interval', fallback=60)
+SETTLEMENT_MODE = config.get('settlement', 'mode', fallback='single')
+DISPERSE_ADDRESS = config.get('settlement', 'disperse', fallback=None)
+BATCH_SIZE = config.getint('settlement', 'batch_size', fallback=100)
+BATCH_WINDOW = config.getint('settlement', 'batch_window', fallback=300)
+SETTLE_INTERVAL = config.getint('settlement', 'settle_interval', fallback=30)
+SETTLE_TIMEOUT = config.getint('settlement', 'settle_timeout', fallback=3600)
+CONFIRM_INTERVAL = config.getint('confirm', 'interval', fallback=15)
+CONFIRM_BATCH = config.getint('confirm', 'batch_size', fallback=500)
+CONFIRM_RETRY = config.getint('confirm', 'retry_after', fallback=600)
+ADDRESS_POOL_SIZE = config.getint('address_pool', 'size', fallback=20)
+ADDRESS_POOL_LOW_WATERMARK = config.getint('address_pool', 'low_watermark', fallback=5)
+ADDRESS_POOL_INTERVAL = config.getint('address_pool', 'fill_interval', fallback=300)
+SWEEP_INTERVAL = config.getint('sweep', 'interval', fallback=3600)
+SWEEP_THRESHOLD = Decimal(config.get('sweep', 'threshold', fallback='1'))
+SWEEP_MAX_GAS_PRICE = Decimal(config.get('sweep', 'max_gas_price', fallback='50'))
+LEDGER_SNAPSHOT_INTERVAL = config.getint('ledger', 'snapshot_interval', fallback=3600)
+LEDGER_SNAPSHOT_LAG = config.getint('ledger', 'snapshot_lag', fallback=60)
+LEDGER_SNAPSHOT_KEEP = config.getint('ledger', 'snapshot_keep', fallback=48)
+WORKER_STATS_INTERVAL = config.getint('worker', 'stats_interval', fallback=60)
 
 queue = Celery('tasks', broker='redis://localhost//')
+queue.conf.beat_schedule = {
+    'confirm-transactions': {
+        'task': 'tasks.confirm_transactions',
+        'schedule': CONFIRM_INTERVAL,
+    },
+    'fill-address-pool': {
+        'task': 'tasks.fill_address_pool',
+        'schedule': ADDRESS_POOL_INTERVAL,
+    },
+    'sweep-deposits': {
+        'task': 'tasks.sweep_deposits',
+        'schedule': SWEEP_INTERVAL,
+    },
+    'maintain-master-nonces': {
+        'task': 'tasks.maintain_master_nonces',
+        'schedule': NONCE_MAINTAIN_INTERVAL,
+    },
+    'snapshot-ledger': {
+        'task': 'tasks.snapshot_ledger',
+        'schedule': LEDGER_SNAPSHOT_INTERVAL,
+    },
+    'report-stats': {
+        'task': 'tasks.report_stats',
+        'schedule': WORKER_STATS_INTERVAL,
+    },
+}
+if SETTLEMENT_MODE == 'batch':
+    queue.conf.beat_schedule['settle-withdrawals'] = {
+        'task': 'tasks.settle_withdrawals',
+        'schedule': SETTLE_INTERVAL,
+    }
 bot = discord.Client()
 
 logger = util.get_logger("task")
@@ -31,41 +89,82 @@ logger = util.get_logger("task")
 with open('static/abi.json', 'r') as abi_file:
     ABI = json.load(abi_file)
 
+with open('static/disperse_abi.json', 'r') as abi_file:
+    DISPERSE_ABI = json.load(abi_file)
+
+
+_w3 = None
+_contracts = {}
+
+
+def get_w3():
+    """
+    Return this process' Web3 client.  It reuses one keep-alive session to the node and records per-method
+    latency in modules.rpc.
+    """
+    global _w3
+    if _w3 is None:
+        _w3 = Web3(HTTPProvider(rpc.RPC_URL, request_kwargs={'timeout': rpc.RPC_TIMEOUT}, session=rpc.get_session()))
+        _w3.middleware_onion.add(rpc.latency_middleware, 'latency')
+    return _w3
+
+
+def get_contract(address=CONTRACT_ADDRESS, abi=None):
+    """
+    Return a cached contract object, the token contract by default.
+    """
+    if address not in _contracts:
+        w3 = get_w3()
+        _contracts[address] = w3.eth.contract(w3.toChecksumAddress(address), abi=abi or ABI)
+    return _contracts[address]
+
+
+@worker_process_init.connect
+def reset_clients(**kwargs):
+    """
+    Forked worker processes must not share the parent's HTTP connections.  Decrypt the master key up
+    front so the first task doesn't pay for it.
+    """
+    global _w3
+    _w3 = None
+    _contracts.clear()
+    get_master_key()
+
+
+@worker_process_shutdown.connect
+def clear_keys(**kwargs):
+    """
+    Zero decrypted keys when a worker process exits.
+    """
+    keys.KEYS.clear()
+
 
 def set_balance(user_id, amount):
     """
     Set the balance to the provided amount.
     """
-    set_balance_sql = "UPDATE users SET balance = %s WHERE user_id = %s"
-    set_balance_values = [amount, user_id]
-    db.set_db_data(set_balance_sql, set_balance_values)
+    ledger.set_balance(user_id, balance=amount)
 
 
 def set_pending(user_id, amount):
     """
     Set the user's pending balance to the provided amount.
     """
-    set_pending_sql = "UPDATE users SET pending_withdraw = %s WHERE user_id = %s"
-    set_pending_values = [amount, user_id]
-    db.set_db_data(set_pending_sql, set_pending_values)
+    ledger.set_balance(user_id, pending=amount)
 
 
 def add_pending(user_id, amount):
     """
     Add the provided amount to the user's pending balance
     """
-    _, pending = get_balance(user_id)
-    new_pending = pending + Decimal(amount)
-    set_pending(user_id, new_pending)
+    ledger.adjust_pending(user_id, Decimal(amount))
 
 
 def remove_pending(user_id, amount):
     """
-    Add the provided amount to the user's pending balance
+    Remove the provided amount from the user's pending balance
     """
-    _, pending = get_balance(user_id)
-    new_pending = pending - Decimal(amount)
-    set_pending(user_id, new_pending)
+    ledger.adjust_pending(user_id, -Decimal(amount))
 
 
 def get_balance(user_id):
@@ -76,8 +175,7 @@ def get_balance(user_id):
         get_balance_sql = "SELECT balance, pending_withdraw FROM users WHERE user_id = %s"
         get_balance_values = [user_id, ]
         balance_return = db.get_db_data(get_balance_sql, get_balance_values)
-        balance = Decimal(balance_return[0][0])
-        pending = Decimal(balance_return[0][1])
+        balance, pending = balance_return[0]
         return balance, pending
     except Exception as e:
         logger.info("error getting balance: {}".format(e))
@@ -86,15 +184,9 @@ def get_balance(user_id):
 
 def remove_balance(user_id, amount):
     """
-    Remove the provided amount from the user's balance.
+    Remove the provided amount from the user's balance.  Returns False if the balance doesn't cover it.
     """
-    current_balance_sql = "SELECT balance FROM users WHERE user_id = %s"
-    current_balance_values = [user_id, ]
-    current_balance_return = db.get_db_data(current_balance_sql, current_balance_values)
-
-    new_balance = Decimal(current_balance_return[0][0]) - Decimal(amount)
-
-    set_balance(user_id, new_balance)
+    return ledger.debit(user_id, amount)
 
 
 def own_account(address):
@@ -116,9 +208,7 @@ def get_master_key():
     Retrieve the private key for the master account from the keystore file
     """
     try:
-        master_keyfile = json.load(open('keyfiles/master.json', 'rb'))
-        master_key = eth_keyfile.decode_keyfile_json(master_keyfile, b'')
-        return master_key
+        return keys.KEYS.get('master', 'keyfiles/master.json', pin=True)
     except Exception as e:
         logger.error("Error retrieving master key: {}".format(e))
         return False
@@ -129,95 +219,322 @@ def get_priv_key(address):
     Retrieve the private key from the keystore file
     """
     try:
-        read_keyfile = json.load(open('keyfiles/{}.json'.format(address), 'rb'))
-        key = eth_keyfile.decode_keyfile_json(read_keyfile, b'')
-        return key
+        return keys.KEYS.get(address.lower(), 'keyfiles/{}.json'.format(address))
     except Exception as e:
         logger.error("Error retrieving private key for address {}: {}".format(address, e))
         return False
 
 
+def sign_from_master(w3, tx, master_key, tx_nonce=None):
+    """
+    Sign a transaction from the master account using a nonce reserved from the shared allocator, so
+    concurrent workers never collide.  Pass tx_nonce to use one already reserved.  Returns the signed
+    transaction; the nonce used is set on tx.
+    """
+    nonces = nonce.NonceManager(MASTER, w3)
+    tx['nonce'] = nonces.reserve() if tx_nonce is None else tx_nonce
+    try:
+        return w3.eth.account.signTransaction(tx, master_key)
+    except Exception:
+        nonces.release(tx['nonce'])
+        raise
+
+
+def broadcast_from_master(w3, signed, tx):
+    """
+    Broadcast a transaction signed by sign_from_master.  Returns the hex transaction hash.
+    """
+    nonces = nonce.NonceManager(MASTER, w3)
+    try:
+        tx_hash = w3.toHex(w3.eth.sendRawTransaction(signed.rawTransaction))
+    except Exception as e:
+        if 'nonce too low' in str(e).lower():
+            # Something else used this nonce, don't hand it out again
+            nonces.resync()
+        else:
+            nonces.release(tx['nonce'])
+        raise
+    nonces.record(tx['nonce'], tx_hash, tx)
+    return tx_hash
+
+
+def send_from_master(w3, tx, master_key, tx_nonce=None):
+    """
+    Sign and broadcast a transaction from the master account.  Returns the hex transaction hash and the nonce
+    used.
+    """
+    signed = sign_from_master(w3, tx, master_key, tx_nonce)
+    return broadcast_from_master(w3, signed, tx), tx['nonce']
+
+
+@queue.task()
+def maintain_master_nonces():
+    """
+    Resync the master nonce allocator with the chain, fill nonce gaps left by failed or crashed tasks with
+    empty self-transfers and re-broadcast stuck transactions at a higher gas price.
+    """
+    w3 = get_w3()
+    master = w3.toChecksumAddress(MASTER)
+    master_key = w3.toHex(get_master_key())
+    nonces = nonce.NonceManager(master, w3)
+    mined = nonces.resync()
+
+    for gap in nonces.gaps(mined):
+        if not nonces.claim(gap):
+            continue
+        tx = dict(chainId=int(CHAIN_ID), nonce=gap, gas=21000, to=master, value=0, **gas.fee_params())
+        try:
+            signed = w3.eth.account.signTransaction(tx, master_key)
+            nonces.record(gap, w3.toHex(w3.eth.sendRawTransaction(signed.rawTransaction)), tx)
+            logger.info("Filled master nonce gap {}".format(gap))
+        except Exception as e:
+            nonces.release(gap)
+            logger.error("Error filling master nonce gap {}: {}".format(gap, e))
+
+    for stuck_nonce, record in nonces.stuck(mined).items():
+        tx = record['tx']
+        gas.bump_fees(tx, gas.fetch_fees())
+        try:
+            signed = w3.eth.account.signTransaction(tx, master_key)
+            replacement_hash = w3.toHex(w3.eth.sendRawTransaction(signed.rawTransaction))
+            nonces.record(stuck_nonce, replacement_hash, tx)
+            # Keep the old hash tracked too, it can still be the one that gets mined
+            db.set_db_data("INSERT IGNORE INTO pending_tx_hashes (tx_hash, pending_hash) "
+                           "SELECT %s, pending_hash FROM pending_tx_hashes WHERE tx_hash = %s",
+                           [replacement_hash, record['hash']])
+            logger.info("Replaced stuck master transaction {} at nonce {}".format(record['hash'], stuck_nonce))
+        except Exception as e:
+            logger.error("Error replacing stuck master transaction {}: {}".format(record['hash'], e))
+
+
 @queue.task()
 def send_tokens(to, amount, author_id):
     """
-    Transfer the provided amount of tokens to the provided account
+    Broadcast a transfer of the provided amount of tokens to the provided account.  The pending balance is
+    released by confirm_transactions once it is mined.
     """
     try:
-        w3 = Web3(HTTPProvider("{}{}".format(INFURA_ROUTE, INFURA)))
-
-        contract = w3.eth.contract(w3.toChecksumAddress(CONTRACT_ADDRESS), abi=ABI)
+        w3 = get_w3()
+        contract = get_contract()
         master = w3.toChecksumAddress(MASTER)
         master_key = w3.toHex(get_master_key())
         to = w3.toChecksumAddress(to)
         if not (own_account(to)) and to.lower() != master.lower():
-            send_amount = float(amount) * (10**18)
+            send_amount = Decimal(amount) * (10**18)
 
-            send_tx = contract.functions.transfer(to, int(send_amount)).buildTransaction(dict(
+            send_call = contract.functions.transfer(to, int(send_amount))
+            send_tx = send_call.buildTransaction(dict(
                     chainId=int(CHAIN_ID),
-                    gas=140000,
-                    gasPrice=w3.eth.gasPrice,
-                    nonce=w3.eth.getTransactionCount(master)
+                    gas=gas.estimate(send_call, master, default=140000),
+                    **gas.fee_params()
             ))
-            sent = w3.eth.account.signTransaction(send_tx, master_key)
-            send_hash = w3.eth.sendRawTransaction(sent.rawTransaction)
-            logger.info("Generated transaction {} - waiting for confirmations.".format(w3.toHex(send_hash)))
-
-            try:
-                w3.eth.waitForTransactionReceipt(w3.toHex(send_hash), timeout=18000)
-                remove_pending(author_id, amount)
-                return True
-            except Exception as e:
-                return False
+            send_hash, send_nonce = send_from_master(w3, send_tx, master_key)
+            track_transaction(send_hash, 'withdraw', {'author_id': author_id, 'amount': str(amount)}, send_nonce)
+            logger.info("Generated transaction {} - waiting for confirmations.".format(send_hash))
+            return send_hash
         else:
             return False
     except Exception as e:
         logger.debug("error: {}".format(e))
 
 
+def queue_withdraw(to, amount, author_id):
+    """
+    Queue a withdraw to be paid out in the next settlement batch.
+    """
+    queue_sql = "INSERT INTO withdrawals (user_id, address, amount) VALUES (%s, %s, %s)"
+    queue_values = [author_id, to.lower(), Decimal(amount)]
+    db.set_db_data(queue_sql, queue_values)
+
+
+def approve_disperse(w3, contract, master, master_key, amount):
+    """
+    Make sure the disperse contract may move at least amount of the master's tokens.  Returns False while an
+    approval is still being mined.
+    """
+    disperse = w3.toChecksumAddress(DISPERSE_ADDRESS)
+    if contract.functions.allowance(master, disperse).call() >= amount:
+        return True
+    if db.get_db_data("SELECT tx_hash FROM pending_txs "
+                      "WHERE kind = 'approve_disperse' AND status IN ('pending', 'processing')", None) != ():
+        return False
+    approve_call = contract.functions.approve(disperse, 2**256 - 1)
+    approve_tx = approve_call.buildTransaction(dict(
+        chainId=int(CHAIN_ID),
+        gas=gas.estimate(approve_call, master, default=140000),
+        **gas.fee_params()
+    ))
+    approve_hash, approve_nonce = send_from_master(w3, approve_tx, master_key)
+    track_transaction(approve_hash, 'approve_disperse', {}, approve_nonce)
+    return False
+
+
+def requeue_batch(batch_id):
+    """
+    Put an unpaid batch's withdrawals back in the queue.
+    """
+    db.set_db_data("UPDATE withdrawals SET status = 'queued', batch_id = NULL, tx_hash = NULL "
+                   "WHERE batch_id = %s", [batch_id, ])
+
+
+@queue.task()
+def settle_withdrawals():
+    """
+    Pay queued withdrawals in one disperseToken transaction once BATCH_SIZE have queued up or the oldest has
+    waited BATCH_WINDOW seconds.  Pending balances are released by confirm_transactions once the batch is mined.
+    """
+    # Batches left claimed but untracked by a worker that died before this claim became transactional
+    stale = db.update_db_data("UPDATE withdrawals SET status = 'queued', batch_id = NULL "
+                              "WHERE status = 'sending' AND tx_hash IS NULL "
+                              "AND created_at < NOW() - INTERVAL %s SECOND", [SETTLE_TIMEOUT, ])
+    if stale:
+        logger.error("Requeued {} withdrawals from abandoned batches".format(stale))
+
+    ready_sql = ("SELECT COUNT(*), COALESCE(TIMESTAMPDIFF(SECOND, MIN(created_at), NOW()), 0) "
+                 "FROM withdrawals WHERE status = 'queued'")
+    queued, oldest = db.get_db_data(ready_sql, None)[0]
+    if queued == 0 or (queued < BATCH_SIZE and oldest < BATCH_WINDOW):
+        return False
+
+    w3 = get_w3()
+    contract = get_contract()
+    disperse = get_contract(DISPERSE_ADDRESS, DISPERSE_ABI)
+    master = w3.toChecksumAddress(MASTER)
+    master_key = w3.toHex(get_master_key())
+    if not approve_disperse(w3, contract, master, master_key, contract.functions.balanceOf(master).call()):
+        return False
+
+    # Claim, sign and track the batch in one transaction.  A crash before the commit leaves the withdrawals
+    # queued, one after it leaves the batch tracked by its hash whether or not it was broadcast, so a paid
+    # batch is never requeued and an unpaid one is never stranded.
+    batch_id = uuid.uuid4().hex
+    signed = None
+    try:
+        with db.transaction() as db_cursor:
+            db_cursor.execute("UPDATE withdrawals SET status = 'sending', batch_id = %s "
+                              "WHERE status = 'queued' ORDER BY id LIMIT %s", [batch_id, BATCH_SIZE])
+            db_cursor.execute("SELECT user_id, address, amount FROM withdrawals WHERE batch_id = %s", [batch_id, ])
+            payouts = db_cursor.fetchall()
+            if not payouts:
+                return False
+
+            recipients = [w3.toChecksumAddress(address) for _, address, _ in payouts]
+            values = [int(Decimal(amount) * (10**18)) for _, _, amount in payouts]
+            batch_call = disperse.functions.disperseToken(contract.address, recipients, values)
+            batch_tx = batch_call.buildTransaction(dict(
+                chainId=int(CHAIN_ID),
+                gas=gas.estimate(batch_call, master),
+                **gas.fee_params()
+            ))
+            signed = sign_from_master(w3, batch_tx, master_key)
+            batch_hash = w3.toHex(signed.hash)
+            db_cursor.execute("UPDATE withdrawals SET status = 'sent', tx_hash = %s WHERE batch_id = %s",
+                              [batch_hash, batch_id])
+            _track(db_cursor, batch_hash, 'settlement', {'batch_id': batch_id}, batch_tx['nonce'])
+    except Exception as e:
+        logger.error("Error preparing withdraw batch {}, leaving it queued: {}".format(batch_id, e))
+        if signed is not None:
+            nonce.NonceManager(MASTER, w3).release(batch_tx['nonce'])
+        return False
+
+    try:
+        broadcast_from_master(w3, signed, batch_tx)
+    except Exception as e:
+        # confirm_transactions requeues the batch once its nonce is used by something else
+        logger.error("Error broadcasting withdraw batch {}: {}".format(batch_hash, e))
+        return False
+    logger.info("Sent {} withdrawals in batch {} - waiting for confirmations.".format(len(payouts), batch_hash))
+    return batch_hash
+
+
 @queue.task()
 def forward_to_master(address, amount):
     """
     Forward tokens to master account after receipt
     """
-    w3 = Web3(HTTPProvider("{}{}".format(INFURA_ROUTE, INFURA)))
-    contract = w3.eth.contract(w3.toChecksumAddress(CONTRACT_ADDRESS), abi=ABI)
+    w3 = get_w3()
+    contract = get_contract()
     master = w3.toChecksumAddress(MASTER)
     address = w3.toChecksumAddress(address)
     master_key = w3.toHex(get_master_key())
     try:
-        send_amount = float(amount) * (10**18)
+        send_amount = Decimal(amount) * (10**18)
 
-        send_tx = contract.functions.transferFrom(address, master, int(send_amount)).buildTransaction(dict(
+        send_call = contract.functions.transferFrom(address, master, int(send_amount))
+        send_tx = send_call.buildTransaction(dict(
             chainId=int(CHAIN_ID),
-            gas=140000,
-            gasPrice=w3.eth.gasPrice,
-            nonce=w3.eth.getTransactionCount(master)
+            gas=gas.estimate(send_call, master, default=140000),
+            **gas.fee_params()
         ))
-        sent = w3.eth.account.signTransaction(send_tx, master_key)
-        send_hash = w3.eth.sendRawTransaction(sent.rawTransaction)
-
-        w3.eth.waitForTransactionReceipt(w3.toHex(send_hash), timeout=18000)
+        send_hash, send_nonce = send_from_master(w3, send_tx, master_key)
+        track_transaction(send_hash, 'forward', {'address': address, 'amount': str(amount)}, send_nonce)
     except Exception as e:
         logger.error("Error forwarding {} {} to master from address {}: {}".format(amount, TOKEN, address, e))
-    finally:
-        return
+
+
+@queue.task()
+def sweep_deposits():
+    """
+    Consolidate every deposit address holding at least SWEEP_THRESHOLD tokens into the master account.
+    Balances are read in batched calls and the transferFroms are sent as one run of consecutive nonces.
+    Nothing is sent while the gas price is above SWEEP_MAX_GAS_PRICE gwei.
+    """
+    w3 = get_w3()
+    fees = gas.fee_params()
+    if gas.max_fee(fees) > w3.toWei(SWEEP_MAX_GAS_PRICE, 'gwei'):
+        logger.info("Skipping sweep, gas price {} gwei is over the ceiling".format(
+            w3.fromWei(gas.max_fee(fees), 'gwei')))
+        return 0
+
+    addresses = [row[0] for row in db.get_db_data("SELECT address FROM users WHERE address LIKE '0x%'", None)]
+    in_flight = {json.loads(row[0])['address'].lower() for row in
+                 db.get_db_data("SELECT payload FROM pending_txs "
+                                "WHERE kind = 'forward' AND status IN ('pending', 'processing')", None)}
+    threshold = int(SWEEP_THRESHOLD * (10**18))
+    balances = multicall.balances_of(addresses)
+    allowances = multicall.allowances_of(addresses, MASTER)
+    # transferFrom can't move more than the address approved
+    to_sweep = sorted((address, min(balance, allowances[address])) for address, balance in balances.items()
+                      if min(balance, allowances[address]) >= threshold and address.lower() not in in_flight)
+    if not to_sweep:
+        return 0
+
+    contract = get_contract()
+    master = w3.toChecksumAddress(MASTER)
+    master_key = w3.toHex(get_master_key())
+    nonces = nonce.NonceManager(master, w3)
+    reserved = nonces.reserve_many(len(to_sweep))
+    swept = 0
+    for (address, balance), sweep_nonce in zip(to_sweep, reserved):
+        address = w3.toChecksumAddress(address)
+        try:
+            sweep_call = contract.functions.transferFrom(address, master, balance)
+            sweep_tx = sweep_call.buildTransaction(dict(
+                chainId=int(CHAIN_ID),
+                gas=gas.estimate(sweep_call, master, default=140000),
+                **fees
+            ))
+            sweep_hash, _ = send_from_master(w3, sweep_tx, master_key, sweep_nonce)
+            amount = Decimal(balance) / (10**18)
+            track_transaction(sweep_hash, 'forward', {'address': address, 'amount': str(amount)}, sweep_nonce)
+            swept += 1
+        except Exception as e:
+            # An unused nonce left behind here is filled by maintain_master_nonces
+            logger.error("Error sweeping {}: {}".format(address, e))
+    logger.info("Swept {} of {} deposit addresses".format(swept, len(to_sweep)))
+    return swept
 
 
 @queue.task()
 def set_account(user_id, address):
     """
-    Sets the user's account in the DB and returns True if it was set successfully.
+    Start setting up the user's account.  The address is stored once the master has funded it and it has
+    approved the master, see allow_master and approve_master.
     """
     try:
-        allowed = allow_master(address)
-        if allowed:
-            address = address.lower()
-            update_account_sql = "UPDATE users SET address = %s WHERE user_id = %s"
-            update_account_values = [address, user_id]
-            db.set_db_data(update_account_sql, update_account_values)
+        if allow_master(user_id, address):
             return True
-        else:
-            mark_error(user_id)
+        mark_error(user_id)
         return False
 
     except Exception as e:
@@ -225,69 +542,282 @@ def set_account(user_id, address):
         return False
 
 
-def mark_error(user_id):
+def mark_error(user_id, address=None):
     """
-    Mark that there was an error in the DB.
+    Mark that there was an error in the DB.  Pool addresses have no user yet, so the pool row is marked.
     """
+    if user_id is None:
+        db.set_db_data("UPDATE address_pool SET status = 'error' WHERE address = %s", [address.lower(), ])
+        return
     update_account_sql = "UPDATE users SET address = 'ERROR' WHERE user_id = %s"
     update_account_values = [user_id, ]
     db.set_db_data(update_account_sql, update_account_values)
+    util.invalidate_snapshots([user_id, ])
+
+
+def get_address_pool_depth():
+    """
+    Return the number of pool addresses in each status.
+    """
+    return dict(db.get_db_data("SELECT status, COUNT(*) FROM address_pool GROUP BY status", None))
 
 
-def allow_master(address):
+@queue.task()
+def fill_address_pool():
     """
-    Allow the master address to spend on behalf of the provided address
+    Top the pool of ready deposit addresses back up to ADDRESS_POOL_SIZE.  New addresses are funded and
+    approve the master through the usual tracked transactions and become ready once both are mined.
+    """
+    fill_lock = util.get_redis().lock('address_pool:fill', timeout=600)
+    if not fill_lock.acquire(blocking=False):
+        return 0
+    try:
+        depth = get_address_pool_depth()
+        missing = ADDRESS_POOL_SIZE - depth.get('ready', 0) - depth.get('funding', 0)
+        logger.info("Address pool depth: {}, generating {}".format(depth, max(missing, 0)))
+
+        w3 = get_w3()
+        for _ in range(missing):
+            new_account = w3.eth.account.create('')
+            address = w3.toChecksumAddress(new_account.address)
+            keys.write_keyfile(address, new_account.key)
+            db.set_db_data("INSERT INTO address_pool (address) VALUES (%s)", [address.lower(), ])
+            if not allow_master(None, address):
+                mark_error(None, address)
+        return max(missing, 0)
+    finally:
+        fill_lock.release()
+
+
+def allow_master(user_id, address):
+    """
+    Broadcast the funding transaction that lets the provided address pay for its approve transaction.
     """
     # It is necessary to fund the slave account with 0.01 ETH so they can sign the approve transaction to allow control
-    w3 = Web3(HTTPProvider("{}{}".format(INFURA_ROUTE, INFURA)))
-    contract_address = w3.toChecksumAddress(CONTRACT_ADDRESS)
-    contract = w3.eth.contract(contract_address, abi=ABI)
-    master = w3.toChecksumAddress(MASTER)
+    w3 = get_w3()
     address = w3.toChecksumAddress(address)
     master_key = w3.toHex(get_master_key())
-    private_key = w3.toHex(get_priv_key(address))
-    master_nonce = w3.eth.getTransactionCount(master)
 
     try:
-        fund = w3.eth.account.signTransaction(dict(
+        fund_hash, fund_nonce = send_from_master(w3, dict(
             chainId=int(CHAIN_ID),
-            nonce=master_nonce,
-            gasPrice=w3.eth.gasPrice,
             gas=21000,
             to=address,
-            value=w3.toWei(0.001, 'ether')
-        ), master_key
-        )
-        w3.eth.sendRawTransaction(fund.rawTransaction)
-        fund_hash = fund.hash
+            value=w3.toWei(0.001, 'ether'),
+            **gas.fee_params()
+        ), master_key)
+        track_transaction(fund_hash, 'fund', {'user_id': user_id, 'address': address}, fund_nonce)
+        return True
+    except Exception as e:
+        logger.error("Error setting address: {}".format(e))
+        return False
 
-        funded = w3.eth.waitForTransactionReceipt(fund_hash, timeout=18000)
 
-        if not funded.status:
-            logger.error("Error funding account from master on hash {}".format(w3.toHex(fund_hash)))
-            return False
+def approve_master(user_id, address):
+    """
+    Once funded, broadcast the provided address' approval for the master to move its tokens.
+    """
+    w3 = get_w3()
+    contract = get_contract()
+    master = w3.toChecksumAddress(MASTER)
+    private_key = w3.toHex(get_priv_key(address))
 
-        # Once funded, allow the master to sign transactions for all accounts
-        approve_tx = contract.functions.approve(master, (1000 * 10**18)).buildTransaction(dict(
-            chainId=int(CHAIN_ID),
-            gas=140000,
-            gasPrice=w3.eth.gasPrice,
-            nonce=w3.eth.getTransactionCount(address)
-        ))
-        sleep(1)
+    approve_call = contract.functions.approve(master, (1000 * 10**18))
+    approve_tx = approve_call.buildTransaction(dict(
+        chainId=int(CHAIN_ID),
+        gas=gas.estimate(approve_call, address, default=140000),
+        nonce=w3.eth.getTransactionCount(address),
+        **gas.fee_params()
+    ))
+    approve = w3.eth.account.signTransaction(approve_tx, private_key)
+    # The deposit key isn't needed again once the approval is signed
+    keys.KEYS.evict(address.lower())
+    approve_hash = w3.toHex(w3.eth.sendRawTransaction(approve.rawTransaction))
+    track_transaction(approve_hash, 'approve', {'user_id': user_id, 'address': address})
+
+
+def track_transaction(tx_hash, kind, payload, master_nonce=None):
+    """
+    Record a broadcast transaction for confirm_transactions to follow up on.  master_nonce is set for
+    transactions sent from the master account.
+    """
+    with db.transaction() as db_cursor:
+        _track(db_cursor, tx_hash, kind, payload, master_nonce)
 
-        approve = w3.eth.account.signTransaction(approve_tx, private_key)
-        approve_hash = w3.eth.sendRawTransaction(approve.rawTransaction)
 
-        receipt = w3.eth.waitForTransactionReceipt(w3.toHex(approve_hash), timeout=18000)
-        if not receipt.status:
-            logger.error("Error approving the master to move funds on hash {}".format(w3.toHex(approve_hash)))
-            return False
+def _track(db_cursor, tx_hash, kind, payload, master_nonce):
+    db_cursor.execute("INSERT INTO pending_txs (tx_hash, kind, payload, nonce) VALUES (%s, %s, %s, %s)",
+                      [tx_hash, kind, json.dumps(payload), master_nonce])
+    db_cursor.execute("INSERT INTO pending_tx_hashes (tx_hash, pending_hash) VALUES (%s, %s)", [tx_hash, tx_hash])
 
-        return True
+
+def on_withdraw(success, payload):
+    """
+    Release the pending balance of a mined withdraw.  The release also marks the tracked transaction confirmed,
+    so it happens at most once however often the follow-up is retried.
+    """
+    if success:
+        ledger.release_pending([(payload['author_id'], payload['amount'])], tx_hash=payload['tx_hash'])
+    else:
+        logger.error("Withdraw of {} {} for user {} failed".format(payload['amount'], TOKEN, payload['author_id']))
+
+
+def on_forward(success, payload):
+    """
+    Log forwards to the master that reverted.
+    """
+    if not success:
+        logger.error("Error forwarding {} {} to master from address {}".format(payload['amount'], TOKEN,
+                                                                                payload['address']))
+
+
+def on_fund(success, payload):
+    """
+    Once the funding transaction is mined, have the new address approve the master.
+    """
+    if not success:
+        logger.error("Error funding account {} from master".format(payload['address']))
+        mark_error(payload['user_id'], payload['address'])
+        return
+    try:
+        approve_master(payload['user_id'], payload['address'])
     except Exception as e:
-        logger.error("Error setting address: {}".format(e))
-        return False
+        logger.error("Error approving the master for {}: {}".format(payload['address'], e))
+        mark_error(payload['user_id'], payload['address'])
+
+
+def on_approve(success, payload):
+    """
+    Once the approval is mined, store the address so the user can use it, or mark a pool address ready.
+    """
+    if not success:
+        logger.error("Error approving the master to move funds from {}".format(payload['address']))
+        mark_error(payload['user_id'], payload['address'])
+        return
+    if payload['user_id'] is None:
+        db.set_db_data("UPDATE address_pool SET status = 'ready' WHERE address = %s", [payload['address'].lower(), ])
+        return
+    update_account_sql = "UPDATE users SET address = %s WHERE user_id = %s"
+    update_account_values = [payload['address'].lower(), payload['user_id']]
+    db.set_db_data(update_account_sql, update_account_values)
+    util.invalidate_snapshots([payload['user_id'], ])
+
+
+def on_settlement(success, payload):
+    """
+    Release pending balances for a mined withdraw batch, or requeue it if it reverted.
+    """
+    if not success:
+        logger.error("Withdraw batch {} reverted, requeueing".format(payload['batch_id']))
+        requeue_batch(payload['batch_id'])
+        return
+    ledger.settle_batch(payload['batch_id'])
+
+
+def on_approve_disperse(success, payload):
+    """
+    Log disperse approvals that reverted.
+    """
+    if not success:
+        logger.error("Error approving the disperse contract")
+
+
+# Follow-up run by confirm_transactions for each kind of tracked transaction, called as (success, payload) with
+# the tracked transaction's tx_hash added to payload
+FOLLOW_UPS = {
+    'withdraw': on_withdraw,
+    'forward': on_forward,
+    'fund': on_fund,
+    'approve': on_approve,
+    'settlement': on_settlement,
+    'approve_disperse': on_approve_disperse,
+}
+
+
+@queue.task()
+def confirm_transactions():
+    """
+    Poll receipts for every hash broadcast for the least recently checked tracked transactions in one batched
+    JSON-RPC call and run the follow-up for each one that was mined.  A master transaction whose nonce was
+    used by some other transaction is treated as failed.  A transaction is only marked done once its
+    follow-up succeeds; follow-ups that raise, or whose worker died, are retried.
+    """
+    db.update_db_data("UPDATE pending_txs SET status = 'pending' WHERE status = 'processing' "
+                      "AND checked_at < NOW() - INTERVAL %s SECOND", [CONFIRM_RETRY, ])
+    pending = db.get_db_data("SELECT tx_hash, kind, payload, nonce FROM pending_txs WHERE status = 'pending' "
+                             "ORDER BY checked_at LIMIT %s", [CONFIRM_BATCH, ])
+    if pending == ():
+        return 0
+
+    hashes = collections.defaultdict(list)
+    for tx_hash, pending_hash in db.get_db_data(
+            "SELECT tx_hash, pending_hash FROM pending_tx_hashes WHERE pending_hash IN ({})".format(
+                ', '.join(['%s'] * len(pending))), [row[0] for row in pending]):
+        hashes[pending_hash].append(tx_hash)
+
+    # Read the mined nonce before the receipts, so a nonce counted as mined always has its receipt
+    mined = int(rpc.call('eth_getTransactionCount', [MASTER, 'latest']), 16)
+    all_hashes = [tx_hash for row in pending for tx_hash in hashes.get(row[0], [row[0]])]
+    receipts = dict(zip(all_hashes, rpc.batch([('eth_getTransactionReceipt', [tx_hash]) for tx_hash in all_hashes])))
+
+    w3 = get_w3()
+    nonces = nonce.NonceManager(MASTER, w3)
+    confirmed = 0
+    unresolved = []
+    for tx_hash, kind, payload, master_nonce in pending:
+        receipt = next((receipts[mined_hash] for mined_hash in hashes.get(tx_hash, [tx_hash])
+                        if receipts.get(mined_hash)), None)
+        if receipt is not None:
+            success = int(receipt['status'], 16) == 1
+        elif master_nonce is not None and master_nonce < mined:
+            logger.error("Nonce {} of {} {} was used by another transaction".format(master_nonce, kind, tx_hash))
+            success = False
+        else:
+            unresolved.append(tx_hash)
+            continue
+
+        # Claim the follow-up so an overlapping run can't repeat it
+        claimed = db.update_db_data("UPDATE pending_txs SET status = 'processing', checked_at = NOW() "
+                                    "WHERE tx_hash = %s AND status = 'pending'", [tx_hash, ])
+        if claimed != 1:
+            continue
+        try:
+            FOLLOW_UPS[kind](success, dict(json.loads(payload), tx_hash=tx_hash))
+        except Exception as e:
+            logger.error("Error in {} follow-up for {}, will retry: {}".format(kind, tx_hash, e))
+            db.set_db_data("UPDATE pending_txs SET status = 'pending' WHERE tx_hash = %s", [tx_hash, ])
+            continue
+        db.set_db_data("UPDATE pending_txs SET status = %s WHERE tx_hash = %s",
+                       ['confirmed' if success else 'failed', tx_hash])
+        if master_nonce is not None:
+            nonces.confirm(master_nonce)
+        confirmed += 1
+
+    if unresolved:
+        # Move them to the back of the queue so they can't starve newer transactions
+        db.set_db_data("UPDATE pending_txs SET checked_at = NOW() WHERE tx_hash IN ({})".format(
+            ', '.join(['%s'] * len(unresolved))), unresolved)
+    return confirmed
+
+
+@queue.task()
+def snapshot_ledger():
+    """
+    Snapshot every user's balance from the ledger so audits can replay from the latest snapshot.
+    """
+    snapshot_id = ledger.snapshot_balances(LEDGER_SNAPSHOT_LAG, LEDGER_SNAPSHOT_KEEP)
+    logger.info("Ledger snapshotted up to entry {}".format(snapshot_id))
+    return snapshot_id
+
+
+@queue.task()
+def report_stats():
+    """
+    Log JSON-RPC latency and DB pool metrics for the worker process that runs this.  Each prefork child keeps
+    its own counters, so this is a sample of one process rather than a total.
+    """
+    logger.info("RPC latency: {}".format(rpc.latency_stats()))
+    logger.info("DB pool: {}".format(db.pool_stats()))
 
 
 if __name__ == '__main__':
@@ -0,0 +1,56 @@
+"""
+Shared setup for the tests.  Every module reads config.ini from the working directory when imported, so a
+config built from exampleconfig.ini is written to a scratch directory and the tests run from there.
+"""
+import configparser
+import os
+import sys
+import tempfile
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+try:
+    import MySQLdb  # noqa: F401
+except ImportError:
+    import pymysql
+    pymysql.install_as_MySQLdb()
+
+TEST_CONFIG = {
+    'main': {'infura': 'test', 'contract': '0x' + '11' * 20, 'master': '0x' + '22' * 20,
+             'etherscan_key': 'test', 'fee': '1', 'token': 'TEST', 'decimals': '8', 'min_tip': '1',
+             'bot_owner': '1', 'bot_id': '2', 'bot_token': 'test'},
+    'db': {'schema': 'erc20bot_test', 'host': 'localhost', 'user': 'test', 'pw': 'test'},
+    'indexer': {'start_block': '100', 'confirmations': '2', 'reorg_depth': '8', 'batch_size': '50'},
+}
+
+WORK_DIR = tempfile.mkdtemp(prefix='erc20bot-tests-')
+config = configparser.ConfigParser()
+config.read(os.path.join(ROOT, 'exampleconfig.ini'))
+for section, values in TEST_CONFIG.items():
+    config[section].update(values)
+with open(os.path.join(WORK_DIR, 'config.ini'), 'w') as config_file:
+    config.write(config_file)
+os.symlink(os.path.join(ROOT, 'static'), os.path.join(WORK_DIR, 'static'))
+os.mkdir(os.path.join(WORK_DIR, 'keyfiles'))
+os.chdir(WORK_DIR)
+
+import pytest  # noqa: E402
+from fakes import FakeDB  # noqa: E402
+
+
+@pytest.fixture
+def fake_db(monkeypatch):
+    """
+    Replace modules.db's query helpers with an in-memory FakeDB, and snapshot invalidation (Redis) with a no-op.
+    """
+    import modules.db as db
+    import modules.util as util
+    fake = FakeDB()
+    monkeypatch.setattr(db, 'transaction', fake.transaction)
+    monkeypatch.setattr(db, 'get_db_data', fake.get_db_data)
+    monkeypatch.setattr(db, 'set_db_data', fake.set_db_data)
+    monkeypatch.setattr(db, 'update_db_data', fake.update_db_data)
+    monkeypatch.setattr(util, 'invalidate_snapshots', lambda user_ids: None)
+    return fake
@@ -0,0 +1,293 @@
+"""
+In-memory stand-ins for MySQL and an Ethereum JSON-RPC node, so the modules can be exercised without either.
+"""
+from contextlib import contextmanager
+import copy
+from decimal import Decimal
+import http.server
+import json
+import re
+import threading
+
+
+class FakeDB(object):
+    """
+    Just enough of the bot's schema to run the statements ledger and the indexer issue.  Each statement is
+    matched against HANDLERS; anything else raises, so a query change shows up as a failing test rather than a
+    silently wrong result.  statements counts round trips (executemany counts once, like a multi-row insert).
+    """
+    def __init__(self):
+        self.users = {}
+        self.deposits = {}
+        self.ledger = []
+        self.indexer_state = {}
+        self.pending_txs = {}
+        self.statements = 0
+
+    def add_user(self, user_id, balance=0, address=None, legacy_block_number=0):
+        self.users[str(user_id)] = {'user_id': str(user_id), 'username': None, 'balance': Decimal(balance),
+                                    'pending_withdraw': Decimal(0), 'address': address, 'block_number': 0,
+                                    'legacy_block_number': legacy_block_number}
+
+    def balance(self, user_id):
+        return self.users[str(user_id)]['balance']
+
+    @contextmanager
+    def transaction(self):
+        state = copy.deepcopy((self.users, self.deposits, self.ledger, self.indexer_state, self.pending_txs))
+        try:
+            yield FakeCursor(self)
+        except Exception:
+            self.users, self.deposits, self.ledger, self.indexer_state, self.pending_txs = state
+            raise
+
+    def get_db_data(self, db_call, values):
+        db_cursor = FakeCursor(self)
+        db_cursor.execute(db_call, values)
+        return db_cursor.fetchall()
+
+    def set_db_data(self, db_call, values):
+        FakeCursor(self).execute(db_call, values)
+
+    def update_db_data(self, db_call, values):
+        return FakeCursor(self).execute(db_call, values)
+
+    def _user(self, user_id):
+        if user_id not in self.users:
+            self.add_user(user_id)
+        return self.users[user_id]
+
+    def debit_if_covered(self, amount, user_id, minimum):
+        user = self.users.get(user_id)
+        if user is None or user['balance'] < Decimal(minimum):
+            return 0, ()
+        user['balance'] -= Decimal(amount)
+        return 1, ()
+
+    def debit(self, amount, user_id):
+        if user_id not in self.users:
+            return 0, ()
+        self.users[user_id]['balance'] -= Decimal(amount)
+        return 1, ()
+
+    def release(self, amount, user_id):
+        self.users[user_id]['pending_withdraw'] -= Decimal(amount)
+        return 1, ()
+
+    def confirm_processing(self, tx_hash):
+        if self.pending_txs.get(tx_hash) != 'processing':
+            return 0, ()
+        self.pending_txs[tx_hash] = 'confirmed'
+        return 1, ()
+
+    def upsert_tip(self, user_id, username, amount):
+        user = self._user(user_id)
+        user['username'] = user['username'] or username
+        user['balance'] += Decimal(amount)
+        return 1, ()
+
+    def upsert_deposit(self, user_id, amount, block_number):
+        user = self._user(user_id)
+        user['balance'] += Decimal(amount)
+        user['block_number'] = max(user['block_number'], block_number)
+        return 1, ()
+
+    def record(self, user_id, kind, amount, pending, ref):
+        self.ledger.append((user_id, kind, Decimal(amount), Decimal(pending), ref))
+        return 1, ()
+
+    def owners(self, *addresses):
+        return 0, [(user['address'], user['user_id'], user['legacy_block_number']) for user in self.users.values()
+                   if user['address'] is not None and user['address'].lower() in addresses]
+
+    def seen_deposits(self, *keys):
+        pairs = set(zip(keys[::2], keys[1::2]))
+        return 0, [key for key in self.deposits if key in pairs]
+
+    def insert_deposit(self, tx_hash, log_index, block_number, user_id, address, amount):
+        self.deposits[(tx_hash, log_index)] = {'block_number': block_number, 'user_id': user_id,
+                                               'address': address, 'amount': Decimal(amount)}
+        return 1, ()
+
+    def deposit_totals(self, after_block):
+        totals = {}
+        for deposit in self.deposits.values():
+            if deposit['block_number'] > after_block:
+                totals[deposit['user_id']] = totals.get(deposit['user_id'], Decimal(0)) + deposit['amount']
+        return 0, sorted(totals.items())
+
+    def delete_deposits(self, after_block):
+        doomed = [key for key, deposit in self.deposits.items() if deposit['block_number'] > after_block]
+        for key in doomed:
+            del self.deposits[key]
+        return len(doomed), ()
+
+    def rewind_users(self, block_number, after_block):
+        rows = 0
+        for user in self.users.values():
+            if user['block_number'] > after_block:
+                user['block_number'] = block_number
+                rows += 1
+        return rows, ()
+
+    def set_cursor(self, name, block_number, block_hash):
+        self.indexer_state[name] = (block_number, block_hash)
+        return 1, ()
+
+    def get_cursor(self, name):
+        return 0, [self.indexer_state[name]] if name in self.indexer_state else ()
+
+    HANDLERS = [
+        (r"UPDATE users SET balance = balance - %s WHERE user_id = %s AND balance >= %s", debit_if_covered),
+        (r"UPDATE users SET balance = balance - %s WHERE user_id = %s", debit),
+        (r"UPDATE users SET pending_withdraw = pending_withdraw - %s WHERE user_id = %s", release),
+        (r"UPDATE pending_txs SET status = 'confirmed' WHERE tx_hash = %s AND status = 'processing'",
+         confirm_processing),
+        (r"INSERT INTO users \(user_id, username, balance\) VALUES \(%s, %s, %s\) ON DUPLICATE KEY .*", upsert_tip),
+        (r"INSERT INTO users \(user_id, balance, block_number\) VALUES \(%s, %s, %s\) ON DUPLICATE KEY .*",
+         upsert_deposit),
+        (r"INSERT INTO ledger \(user_id, kind, amount, pending, ref\) VALUES .*", record),
+        (r"SELECT address, user_id, legacy_block_number FROM users WHERE address IN \(.*\)", owners),
+        (r"SELECT tx_hash, log_index FROM deposits WHERE \(tx_hash, log_index\) IN \(.*\) FOR UPDATE",
+         seen_deposits),
+        (r"INSERT INTO deposits \(tx_hash, log_index, block_number, user_id, address, amount\) VALUES .*",
+         insert_deposit),
+        (r"SELECT user_id, SUM\(amount\) FROM deposits WHERE block_number > %s GROUP BY user_id FOR UPDATE",
+         deposit_totals),
+        (r"DELETE FROM deposits WHERE block_number > %s", delete_deposits),
+        (r"UPDATE users SET block_number = %s WHERE block_number > %s", rewind_users),
+        (r"INSERT INTO indexer_state \(name, block_number, block_hash\) VALUES .*", set_cursor),
+        (r"SELECT block_number, block_hash FROM indexer_state WHERE name = %s", get_cursor),
+    ]
+
+    def run(self, db_call, values):
+        db_call = ' '.join(db_call.split())
+        for pattern, handler in self.HANDLERS:
+            if re.fullmatch(pattern, db_call):
+                return handler(self, *(values or ()))
+        raise NotImplementedError("FakeDB can't run: {}".format(db_call))
+
+
+class FakeCursor(object):
+    def __init__(self, fake_db):
+        self.db = fake_db
+        self.rows = ()
+        self.rowcount = 0
+
+    def execute(self, db_call, values=None):
+        self.db.statements += 1
+        self.rowcount, self.rows = self.db.run(db_call, values)
+        self.rows = tuple(tuple(row) for row in self.rows)
+        return self.rowcount
+
+    def executemany(self, db_call, values):
+        self.db.statements += 1
+        self.rowcount = sum(self.db.run(db_call, row)[0] for row in values)
+        return self.rowcount
+
+    def fetchall(self):
+        return self.rows
+
+    def fetchone(self):
+        return self.rows[0] if self.rows else None
+
+    def close(self):
+        pass
+
+
+class FakeNode(object):
+    """
+    A chain of blocks served over JSON-RPC from a local HTTP server, enough for the indexer: eth_blockNumber,
+    eth_getBlockByNumber, eth_getLogs and eth_getTransactionReceipt, including batched requests.  reorg()
+    replaces the chain from a block onwards, changing those blocks' hashes and logs.  Like hosted nodes,
+    eth_getLogs refuses ranges wider than max_log_range blocks when it is set.
+    """
+    def __init__(self, contract, head, max_log_range=None):
+        self.contract = contract.lower()
+        self.max_log_range = max_log_range
+        self.log_ranges = []
+        self.fork = 0
+        self.fork_block = 0
+        self.head = head
+        self.logs = {}
+        self.requests = []
+        node = self
+
+        class Handler(http.server.BaseHTTPRequestHandler):
+            def do_POST(self):
+                request = json.loads(self.rfile.read(int(self.headers['Content-Length'])))
+                if isinstance(request, list):
+                    response = [node.handle(item) for item in request]
+                else:
+                    response = node.handle(request)
+                body = json.dumps(response).encode()
+                self.send_response(200)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        self.server = http.server.ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        self.url = 'http://127.0.0.1:{}'.format(self.server.server_address[1])
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self.thread.start()
+
+    def close(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def block_hash(self, block_number):
+        return '0x{:032x}{:032x}'.format(self.fork if block_number >= self.fork_block else 0, block_number)
+
+    def transfer(self, block_number, to_address, amount):
+        """
+        Add a Transfer of amount whole tokens to to_address in the block.  Returns its transaction hash.
+        """
+        logs = self.logs.setdefault(block_number, [])
+        tx_hash = '0x{:08x}{:08x}{:048x}'.format(self.fork, block_number, len(logs))
+        logs.append({'address': self.contract,
+                     'topics': ['0xddf252ad1be2c89b69c2b068fc378daa952ba7f163c4a11628f55a4df523b3ef',
+                                '0x' + '0' * 64, '0x' + to_address.lower()[2:].rjust(64, '0')],
+                     'data': hex(amount * 10**18),
+                     'blockNumber': hex(block_number),
+                     'transactionHash': tx_hash,
+                     'logIndex': hex(len(logs))})
+        return tx_hash
+
+    def reorg(self, from_block):
+        """
+        Replace every block from from_block on with new, empty ones.
+        """
+        self.fork += 1
+        self.fork_block = from_block
+        self.logs = {block: logs for block, logs in self.logs.items() if block < from_block}
+
+    def handle(self, request):
+        self.requests.append(request['method'])
+        params = request.get('params', [])
+        if request['method'] == 'eth_blockNumber':
+            result = hex(self.head)
+        elif request['method'] == 'eth_getBlockByNumber':
+            block_number = int(params[0], 16)
+            result = {'number': params[0], 'hash': self.block_hash(block_number)} if block_number <= self.head \
+                else None
+        elif request['method'] == 'eth_getLogs':
+            query = params[0]
+            from_block, to_block = int(query['fromBlock'], 16), int(query['toBlock'], 16)
+            if self.max_log_range is not None and to_block - from_block + 1 > self.max_log_range:
+                return {'jsonrpc': '2.0', 'id': request['id'],
+                        'error': {'code': -32005, 'message': 'block range too large'}}
+            self.log_ranges.append((from_block, to_block))
+            result = [log for block in range(from_block, to_block + 1)
+                      for log in self.logs.get(block, []) if log['address'] == query['address'].lower()]
+        elif request['method'] == 'eth_getTransactionReceipt':
+            logs = [log for block_logs in self.logs.values() for log in block_logs
+                    if log['transactionHash'] == params[0]]
+            result = {'transactionHash': params[0], 'status': '0x1', 'logs': logs} if logs else None
+        else:
+            return {'jsonrpc': '2.0', 'id': request['id'],
+                    'error': {'code': -32601, 'message': 'method not found'}}
+        return {'jsonrpc': '2.0', 'id': request['id'], 'result': result}
@@ -0,0 +1,100 @@
+from decimal import Decimal
+import time
+
+import pytest
+
+import backfill
+from fakes import FakeNode
+import modules.indexer as indexer
+import modules.rpc as rpc
+
+ALICE = '0x' + 'aa' * 20
+BOB = '0x' + 'bb' * 20
+
+
+@pytest.fixture
+def node(monkeypatch):
+    node = FakeNode(indexer.CONTRACT_ADDRESS, head=1000)
+    monkeypatch.setattr(rpc, 'RPC_URL', node.url)
+    yield node
+    node.close()
+
+
+@pytest.fixture
+def users(fake_db):
+    fake_db.add_user('alice', address=ALICE)
+    fake_db.add_user('bob', address=BOB)
+    return fake_db
+
+
+def test_backfill_credits_every_chunk_and_checkpoints(node, users):
+    for block in range(100, 200, 7):
+        node.transfer(block, ALICE, 1)
+    node.transfer(150, BOB, 4)
+
+    assert backfill.backfill(100, 199, 'backfill', workers=3, chunk_size=10) == (100, 16)
+
+    assert users.balance('alice') == Decimal(15)
+    assert users.balance('bob') == Decimal(4)
+    assert users.indexer_state['backfill'] == (199, None)
+
+
+def test_backfill_splits_ranges_the_node_refuses(node, users):
+    node.max_log_range = 8
+    node.transfer(101, ALICE, 1)
+    node.transfer(130, ALICE, 2)
+    node.transfer(159, BOB, 3)
+
+    assert backfill.fetch_range(100, 131)[1]
+    assert backfill.backfill(100, 159, 'backfill', workers=2, chunk_size=30) == (60, 3)
+
+    assert users.balance('alice') == Decimal(3)
+    assert users.balance('bob') == Decimal(3)
+    assert all(to_block - from_block < 8 for from_block, to_block in node.log_ranges)
+
+
+def test_next_chunk_size_adapts_to_splits_and_sparse_ranges():
+    assert backfill.next_chunk_size(1000, True, 0) == 500
+    assert backfill.next_chunk_size(1, True, 0) == 1
+    assert backfill.next_chunk_size(1000, False, 0) == 2000
+    assert backfill.next_chunk_size(backfill.MAX_CHUNK_SIZE, False, 0) == backfill.MAX_CHUNK_SIZE
+    assert backfill.next_chunk_size(1000, False, backfill.TARGET_LOGS) == 1000
+
+
+def test_main_resumes_from_the_checkpoint(node, users, capsys):
+    node.transfer(120, ALICE, 1)
+    node.transfer(160, ALICE, 2)
+    users.indexer_state['backfill'] = (150, None)
+
+    assert backfill.main(['--from', '100', '--to', '200']) == 0
+
+    assert min(from_block for from_block, _ in node.log_ranges) == 151
+    assert users.balance('alice') == Decimal(2)
+    assert users.indexer_state['backfill'] == (200, None)
+    assert 'Scanned blocks 151-200' in capsys.readouterr().out
+
+
+def test_backfill_skips_deposits_the_etherscan_poller_credited(node, users):
+    users.users['alice']['legacy_block_number'] = 130
+    node.transfer(125, ALICE, 1)
+    node.transfer(130, ALICE, 2)
+    node.transfer(135, ALICE, 4)
+
+    assert backfill.backfill(100, 199, 'backfill') == (100, 1)
+    assert users.balance('alice') == Decimal(4)
+
+
+@pytest.mark.parametrize('workers', [1, 4])
+def test_backfill_throughput_benchmark(node, users, workers):
+    node.head = 20000
+    node.max_log_range = 2000
+    for block in range(1, 20000, 4):
+        node.transfer(block, ALICE if block % 8 == 1 else BOB, 1)
+
+    started = time.perf_counter()
+    blocks, credited = backfill.backfill(0, 19999, 'backfill', workers=workers, chunk_size=500)
+    elapsed = time.perf_counter() - started
+
+    print("\n{} workers: {} blocks and {} deposits in {:.2f}s, {:.0f} blocks/s over {} eth_getLogs calls".format(
+        workers, blocks, credited, elapsed, blocks / elapsed, len(node.log_ranges)))
+    assert (blocks, credited) == (20000, 5000)
@@ -0,0 +1,104 @@
+import asyncio
+import collections
+import time
+
+import pytest
+
+import modules.currency as currency
+
+User = collections.namedtuple('User', ['id', 'name'])
+MENTION_COUNTS = [1, 10, 50, 100, 500]
+ROUNDS = 20
+
+
+class FakeBot(object):
+    """
+    Counts the cache lookups the parser falls back to for mentions discord didn't parse.
+    """
+    def __init__(self):
+        self.lookups = 0
+
+    def get_user(self, user_id):
+        self.lookups += 1
+        return User(user_id, 'user{}'.format(user_id))
+
+
+def make_message(mentions, author=1):
+    users = [User(1000 + i, 'user{}'.format(1000 + i)) for i in range(mentions)]
+    # Every user is mentioned twice to exercise dedup
+    words = ['<@{}>'.format(user.id) for user in users] * 2
+    return {'content': 'hey !tip {} 1 thanks'.format(' '.join(words)), 'author': author, 'mentions': users}
+
+
+async def legacy_set_tip_list(message, bot):
+    """
+    The parser set_tip_list replaced, kept as the benchmark baseline.
+    """
+    message['msg_list'] = message['content'].lower().split(' ')
+    message['starting_point'] = -1
+
+    for alias in currency.aliases.TIP['TRIGGER']:
+        if ("!" + alias) in message['msg_list']:
+            message['starting_point'] = message['msg_list'].index("!" + alias)
+
+    if message['starting_point'] == -1:
+        return None
+
+    first_user_flag = False
+    users_to_tip = []
+
+    for t_index in range(message['starting_point'] + 1, len(message['msg_list'])):
+        if (first_user_flag
+                and len(message['msg_list'][t_index]) > 0
+                and str(message['msg_list'][t_index][0:2]) != "<@"):
+            message['last_user'] = t_index
+            break
+        if (len(message['msg_list'][t_index]) > 0
+                and str(message['msg_list'][t_index][0:2]) == "<@"
+                and message['msg_list'][t_index] != ("<@" + str(message['author']) + ">")
+                and message['msg_list'][t_index] != ("<@" + str(currency.BOT_ID) + ">")):
+            if not first_user_flag:
+                first_user_flag = True
+            user = message['msg_list'][t_index][2:-1]
+            username = bot.get_user(int(user))
+            user_dict = {'user': user, 'username': username.name}
+            if user_dict not in users_to_tip:
+                users_to_tip.append(user_dict)
+
+    return users_to_tip
+
+
+def test_set_tip_list_dedups_and_skips_author_and_bot():
+    message = {'content': '!tip <@5> <@!5> <@1> <@{}> <@6> 2 for lunch'.format(currency.BOT_ID),
+               'author': 1, 'mentions': [User(5, 'five')]}
+    bot = FakeBot()
+
+    users = asyncio.run(currency.set_tip_list(message, bot))
+
+    assert users == [{'user': '5', 'username': 'five'}, {'user': '6', 'username': 'user6'}]
+    assert message['last_user'] == 6
+    assert bot.lookups == 1
+
+
+def test_set_tip_list_without_trigger():
+    assert asyncio.run(currency.set_tip_list({'content': 'hello <@5>', 'author': 1, 'mentions': []},
+                                             FakeBot())) is None
+
+
+@pytest.mark.parametrize('mentions', MENTION_COUNTS)
+def test_set_tip_list_benchmark(mentions):
+    async def run(parser):
+        bot = FakeBot()
+        messages = [make_message(mentions) for _ in range(ROUNDS)]
+        started = time.perf_counter()
+        for message in messages:
+            users = await parser(message, bot)
+        return users, (time.perf_counter() - started) / ROUNDS, bot.lookups // ROUNDS
+
+    users, elapsed, lookups = asyncio.run(run(currency.set_tip_list))
+    _, legacy_elapsed, legacy_lookups = asyncio.run(run(legacy_set_tip_list))
+
+    print("\n{} mentions: {:.3f}ms and {} user lookups, was {:.3f}ms and {} lookups".format(
+        mentions, elapsed * 1000, lookups, legacy_elapsed * 1000, legacy_lookups))
+    assert [user['user'] for user in users] == [str(1000 + i) for i in range(mentions)]
+    assert lookups == 0
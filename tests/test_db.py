@@ -0,0 +1,51 @@
+import asyncio
+import time
+
+import modules.db as db
+import modules.util as util
+
+QUERY_SECONDS = 0.005
+COMMANDS = 1000
+HEARTBEAT = 0.01
+
+
+def slow_get_db_data(db_call, values):
+    # Stands in for a MySQLdb query: blocks the calling thread
+    time.sleep(QUERY_SECONDS)
+    return ((values[0] % 2, ), )
+
+
+async def heartbeat(stop, lags):
+    while not stop.is_set():
+        started = time.monotonic()
+        await asyncio.sleep(HEARTBEAT)
+        lags.append(time.monotonic() - started - HEARTBEAT)
+
+
+async def run_commands():
+    stop = asyncio.Event()
+    lags = []
+    beat = asyncio.ensure_future(heartbeat(stop, lags))
+    await asyncio.sleep(HEARTBEAT * 2)
+    started = time.monotonic()
+    results = await asyncio.gather(*(util.is_notified(user_id) for user_id in range(COMMANDS)))
+    elapsed = time.monotonic() - started
+    stop.set()
+    await beat
+    return results, elapsed, lags
+
+
+def test_event_loop_stays_responsive_under_concurrent_commands(monkeypatch):
+    monkeypatch.setattr(db, 'get_db_data', slow_get_db_data)
+    monkeypatch.setattr(util, 'NOTIFY_CACHE', util.TTLCache(COMMANDS, 60))
+
+    results, elapsed, lags = asyncio.run(run_commands())
+
+    print("\n{} commands with {}ms queries on {} DB threads: {:.2f}s total, heartbeat lag max {:.1f}ms "
+          "(inline queries would block the loop for {:.1f}s)".format(
+              COMMANDS, QUERY_SECONDS * 1000, db.DB_POOL_SIZE, elapsed, max(lags) * 1000,
+              COMMANDS * QUERY_SECONDS))
+    assert results == [user_id % 2 == 1 for user_id in range(COMMANDS)]
+    assert len(lags) > 10
+    # Scheduling the whole burst takes one loop pass; after that the loop never waits on a query
+    assert max(lags) < 0.25
@@ -0,0 +1,92 @@
+from decimal import Decimal
+
+import pytest
+
+from fakes import FakeNode
+import modules.indexer as indexer
+import modules.rpc as rpc
+
+ALICE = '0x' + 'aa' * 20
+BOB = '0x' + 'bb' * 20
+STRANGER = '0x' + 'cc' * 20
+
+
+@pytest.fixture
+def node(monkeypatch):
+    node = FakeNode(indexer.CONTRACT_ADDRESS, head=130)
+    monkeypatch.setattr(rpc, 'RPC_URL', node.url)
+    yield node
+    node.close()
+
+
+@pytest.fixture
+def users(fake_db):
+    fake_db.add_user('alice', address=ALICE)
+    fake_db.add_user('bob', address=BOB)
+    return fake_db
+
+
+def test_index_once_credits_deposits_to_known_addresses(node, users):
+    node.transfer(105, ALICE, 5)
+    node.transfer(110, STRANGER, 7)
+    node.transfer(125, BOB, 3)
+    node.transfer(129, BOB, 1)
+
+    # start_block is 100 and two confirmations are needed, so blocks 100-128 are ready
+    assert indexer.index_once() == 29
+    assert users.balance('alice') == Decimal(5)
+    assert users.balance('bob') == Decimal(3)
+    assert users.indexer_state['deposits'] == (128, node.block_hash(128))
+
+    assert indexer.index_once() == 0
+    node.head = 131
+    assert indexer.index_once() == 1
+    assert users.balance('bob') == Decimal(4)
+
+
+def test_replaying_blocks_does_not_credit_twice(node, users):
+    node.transfer(105, ALICE, 5)
+    indexer.index_once()
+    users.indexer_state['deposits'] = (99, None)
+
+    indexer.index_once()
+    assert users.balance('alice') == Decimal(5)
+
+
+def test_reorg_reverts_recent_deposits_and_reindexes(node, users):
+    node.transfer(105, ALICE, 5)
+    node.transfer(125, BOB, 3)
+    indexer.index_once()
+    assert users.balance('bob') == Decimal(3)
+
+    # Blocks from 123 on are replaced: bob's deposit is gone and alice got one in the new fork instead
+    node.reorg(123)
+    node.transfer(124, ALICE, 2)
+    node.head = 135
+
+    # The cursor's block hash no longer matches, so the last reorg_depth (8) blocks are rewound
+    assert indexer.index_once() == 0
+    assert users.balance('bob') == Decimal(0)
+    assert users.indexer_state['deposits'] == (120, None)
+    assert ('bob', 'reorg', Decimal(-3), Decimal(0), 'block:120') in users.ledger
+
+    assert indexer.index_once() == 13
+    assert users.balance('alice') == Decimal(7)
+    assert users.balance('bob') == Decimal(0)
+    assert users.indexer_state['deposits'] == (133, node.block_hash(133))
+
+
+def test_get_cursor_requires_start_block(users, monkeypatch):
+    monkeypatch.setattr(indexer, 'START_BLOCK', None)
+    with pytest.raises(ValueError):
+        indexer.get_cursor()
+
+
+def test_get_receipt_transfers_batches_receipts(node):
+    tx_hashes = [node.transfer(101 + i, ALICE, i + 1) for i in range(5)] + ['0x' + '00' * 32]
+
+    transfers = indexer.get_receipt_transfers(tx_hashes, chunk_size=4)
+
+    assert [(block_number, address, amount) for _, _, block_number, address, amount in transfers] == \
+        [(101 + i, ALICE, Decimal(i + 1)) for i in range(5)]
+    assert node.requests.count('eth_getTransactionReceipt') == 6
@@ -0,0 +1,63 @@
+import json
+import os
+import time
+
+import eth_keyfile
+
+import modules.keys as keys
+
+TASKS = 5
+
+
+def make_keyfile(name, iterations=None):
+    """
+    Write a keyfile with the bot's KDF settings, or a cheap one if iterations is given.
+    """
+    key = os.urandom(32)
+    if iterations is None:
+        keys.write_keyfile(name, key)
+    else:
+        with open('keyfiles/{}.json'.format(name), 'w') as keyfile:
+            json.dump(eth_keyfile.create_keyfile_json(key, b'', iterations=iterations), keyfile)
+    return key, 'keyfiles/{}.json'.format(name)
+
+
+def test_keystore_evicts_and_zeroes_least_recently_used():
+    store = keys.KeyStore(max_keys=2, ttl=60)
+    files = [make_keyfile('evict{}'.format(i), iterations=1) for i in range(3)]
+
+    for i, (key, keyfile_path) in enumerate(files):
+        assert store.get(str(i), keyfile_path) == key
+        if i == 0:
+            evicted = store._keys['0'][0]
+
+    assert list(store._keys) == ['1', '2']
+    assert evicted == bytearray(32)
+    assert store.get('2', files[2][1]) == files[2][0]
+    assert store.get('0', files[0][1]) == files[0][0]
+    assert store.stats() == {'cached': 2, 'pinned': 0, 'hits': 1, 'misses': 4}
+
+
+def test_keystore_task_latency_benchmark():
+    key, keyfile_path = make_keyfile('bench')
+
+    started = time.perf_counter()
+    for _ in range(TASKS):
+        # What every task did before: read the keyfile and run its KDF
+        with open(keyfile_path) as keyfile:
+            assert eth_keyfile.decode_keyfile_json(json.load(keyfile), b'') == key
+    before = (time.perf_counter() - started) / TASKS
+
+    store = keys.KeyStore(keys.MAX_CACHED_KEYS, keys.KEY_TTL)
+    started = time.perf_counter()
+    assert store.get('bench', keyfile_path) == key
+    first = time.perf_counter() - started
+    started = time.perf_counter()
+    for _ in range(TASKS):
+        assert store.get('bench', keyfile_path) == key
+    after = (time.perf_counter() - started) / TASKS
+
+    print("\nKey lookup per task: {:.1f}ms decoding every time, {:.1f}ms on first use then {:.3f}ms cached".format(
+        before * 1000, first * 1000, after * 1000))
+    assert store.stats()['misses'] == 1
+    assert after < before
@@ -0,0 +1,75 @@
+from decimal import Decimal
+import time
+
+import pytest
+import redis
+
+import modules.ledger as ledger
+import modules.util as util
+
+invalidate_snapshots = util.invalidate_snapshots
+
+
+def test_transfer_credits_every_recipient_and_records_it(fake_db):
+    fake_db.add_user('1', balance=10)
+    fake_db.add_user('2', balance=1)
+
+    assert ledger.transfer('1', [('2', 'two'), ('3', 'three'), ('1', 'self')], Decimal('2.5'))
+
+    assert fake_db.balance('1') == Decimal(5)
+    assert fake_db.balance('2') == Decimal('3.5')
+    assert fake_db.balance('3') == Decimal('2.5')
+    assert sorted(entry[:3] for entry in fake_db.ledger) == [('1', 'tip', Decimal(-5)),
+                                                             ('2', 'tip', Decimal('2.5')),
+                                                             ('3', 'tip', Decimal('2.5'))]
+
+
+def test_transfer_changes_nothing_when_sender_cannot_cover_it(fake_db):
+    fake_db.add_user('1', balance=1)
+
+    assert not ledger.transfer('1', [('2', 'two'), ('3', 'three')], 1)
+
+    assert fake_db.balance('1') == Decimal(1)
+    assert '2' not in fake_db.users
+    assert fake_db.ledger == []
+
+
+def test_transfer_succeeds_when_snapshot_invalidation_fails(fake_db, monkeypatch):
+    def unreachable():
+        raise redis.ConnectionError('redis is down')
+    monkeypatch.setattr(util, 'invalidate_snapshots', invalidate_snapshots)
+    monkeypatch.setattr(util, 'get_redis', unreachable)
+    fake_db.add_user('1', balance=2)
+
+    assert ledger.transfer('1', [('2', 'two')], 1)
+    assert fake_db.balance('2') == Decimal(1)
+
+
+def test_release_pending_releases_a_tracked_withdraw_once(fake_db):
+    fake_db.add_user('1')
+    fake_db.users['1']['pending_withdraw'] = Decimal(5)
+    fake_db.pending_txs['0xabc'] = 'processing'
+
+    assert ledger.release_pending([('1', 2)], tx_hash='0xabc')
+    assert fake_db.pending_txs['0xabc'] == 'confirmed'
+    # A retried follow-up, e.g. after the worker died before confirm_transactions recorded it as done
+    assert not ledger.release_pending([('1', 2)], tx_hash='0xabc')
+
+    assert fake_db.users['1']['pending_withdraw'] == Decimal(3)
+    assert [entry[:4] for entry in fake_db.ledger] == [('1', 'withdrawn', Decimal(0), Decimal(-2))]
+
+
+@pytest.mark.parametrize('recipients', [1, 10, 100, 1000])
+def test_transfer_benchmark(fake_db, recipients):
+    fake_db.add_user('sender', balance=recipients)
+    fake_db.statements = 0
+
+    started = time.perf_counter()
+    assert ledger.transfer('sender', [(user_id, 'user{}'.format(user_id)) for user_id in range(recipients)], 1)
+    elapsed = time.perf_counter() - started
+
+    # The old path read then wrote each recipient and the sender on their own connections
+    print("\n{} recipients: {} statements in one transaction (was {} statements and {} commits), {:.2f}ms".format(
+        recipients, fake_db.statements, recipients * 2 + 2, recipients + 1, elapsed * 1000))
+    assert fake_db.statements == 3
+    assert fake_db.balance('sender') == 0
@@ -0,0 +1,89 @@
+"""
+Batched settlement against per-user sends.  The offline benchmark measures what differs exactly without a
+chain: transactions, calldata, intrinsic gas, signing time and confirmation round trips.  Set
+SETTLEMENT_BENCH_RPC to a dev node (e.g. a mainnet fork) where the master holds tokens and has approved the
+disperse contract, with SETTLEMENT_BENCH_TOKEN, SETTLEMENT_BENCH_DISPERSE and SETTLEMENT_BENCH_MASTER, to
+also compare full gas estimates from the node.
+"""
+import json
+import os
+import time
+
+from eth_account import Account
+from eth_utils import to_checksum_address
+import pytest
+from web3 import Web3, HTTPProvider
+
+RECIPIENT_COUNTS = [1, 10, 100]
+TX_GAS = 21000
+
+with open('static/abi.json') as abi_file:
+    ABI = json.load(abi_file)
+with open('static/disperse_abi.json') as abi_file:
+    DISPERSE_ABI = json.load(abi_file)
+
+
+def intrinsic_gas(data):
+    """
+    Gas charged before execution: the base transaction cost plus calldata (EIP-2028).
+    """
+    data = bytes.fromhex(data[2:])
+    return TX_GAS + sum(16 if byte else 4 for byte in data)
+
+
+def payouts(count):
+    recipients = [to_checksum_address('0x{:040x}'.format(0x1000 + i)) for i in range(count)]
+    return recipients, [(i + 1) * 10**18 for i in range(count)]
+
+
+def signed_tx(key, to, data, nonce):
+    return Account.sign_transaction({'to': to, 'data': data, 'nonce': nonce, 'gas': 1000000, 'chainId': 1,
+                                     'maxFeePerGas': 10**10, 'maxPriorityFeePerGas': 10**9, 'value': 0}, key)
+
+
+@pytest.mark.parametrize('count', RECIPIENT_COUNTS)
+def test_settlement_benchmark(count):
+    w3 = Web3()
+    token = w3.eth.contract(address=to_checksum_address('0x' + '11' * 20), abi=ABI)
+    disperse = w3.eth.contract(address=to_checksum_address('0x' + '33' * 20), abi=DISPERSE_ABI)
+    key = os.urandom(32)
+    recipients, values = payouts(count)
+
+    started = time.perf_counter()
+    single_data = [token.encodeABI(fn_name='transfer', args=[to, value]) for to, value in zip(recipients, values)]
+    for nonce, data in enumerate(single_data):
+        signed_tx(key, token.address, data, nonce)
+    single_time = time.perf_counter() - started
+
+    started = time.perf_counter()
+    batch_data = disperse.encodeABI(fn_name='disperseToken', args=[token.address, recipients, values])
+    signed_tx(key, disperse.address, batch_data, 0)
+    batch_time = time.perf_counter() - started
+
+    single_gas = sum(intrinsic_gas(data) for data in single_data)
+    batch_gas = intrinsic_gas(batch_data)
+    print("\n{} withdrawals: per-user {} txs, {} intrinsic gas, {} receipts to follow, {:.1f}ms to build and sign; "
+          "batched 1 tx, {} intrinsic gas, 1 receipt, {:.1f}ms".format(
+              count, count, single_gas, count, single_time * 1000, batch_gas, batch_time * 1000))
+    if count > 1:
+        assert batch_gas < single_gas
+        assert batch_time < single_time
+
+
+@pytest.mark.skipif(not os.environ.get('SETTLEMENT_BENCH_RPC'), reason='needs SETTLEMENT_BENCH_RPC')
+@pytest.mark.parametrize('count', RECIPIENT_COUNTS)
+def test_settlement_gas_on_node(count):
+    w3 = Web3(HTTPProvider(os.environ['SETTLEMENT_BENCH_RPC']))
+    token = w3.eth.contract(address=os.environ['SETTLEMENT_BENCH_TOKEN'], abi=ABI)
+    disperse = w3.eth.contract(address=os.environ['SETTLEMENT_BENCH_DISPERSE'], abi=DISPERSE_ABI)
+    sender = {'from': os.environ['SETTLEMENT_BENCH_MASTER']}
+    recipients, values = payouts(count)
+    values = [1 for _ in values]
+
+    single_gas = sum(token.functions.transfer(to, value).estimateGas(sender) for to, value in zip(recipients, values))
+    batch_gas = disperse.functions.disperseToken(token.address, recipients, values).estimateGas(sender)
+
+    print("\n{} withdrawals: per-user {} gas, batched {} gas ({:.0f}%)".format(
+        count, single_gas, batch_gas, batch_gas * 100 / single_gas))
+    if count > 1:
+        assert batch_gas < single_gas